@@ -0,0 +1,229 @@
+# dcasync.py - asyncio serial transport for GRBL
+# Released under GPL3 or later
+#
+# The blocking routines in dcserial read the port inline, so whichever function
+# happens to be reading gets whatever GRBL says next - including probe results,
+# alarms and status reports meant for somebody else.
+#
+# Here a single reader task owns the port. It classifies every line GRBL sends:
+#  - "ok" and "error:" resolve the future of the command they answer. GRBL
+#    answers in order, so that is always the oldest command outstanding.
+#  - Feedback that belongs to a command ([PRB:...], [GC:...], $ settings etc.)
+#    is attached to the result of the command being executed.
+#  - Status reports, probe results, alarms and messages are also passed to any
+#    subscribers for that kind of line.
+# Several coroutines can share one port this way without losing or mixing up
+# replies. Commands are streamed using character counting, so they queue up in
+# GRBL's receive buffer rather than waiting for each other's round trips.
+#
+# Example:
+#   async def main():
+#       transport = GRBLTransport(serial.Serial('/dev/ttyACM0', 115200))
+#       await transport.start()
+#       transport.subscribe("status", print)
+#       await transport.command("G0 X10")
+#       transport.realtime(b"?")
+#       result = await transport.command("G38.2 Z-100 F100")
+#       print(result.probe)
+#       await transport.close()
+#   asyncio.run(main())
+
+import asyncio
+from collections import deque
+from dcserial import GRBL_RX_BUFFER_SIZE, LineBuffer, clean_gcode_line
+
+# Kinds of line the reader task recognises
+LINE_KINDS = ("ok", "error", "status", "probe", "alarm", "message", "feedback", "banner", "other")
+
+
+# Raised in place of a command result when GRBL rejects a line
+class GRBLError(Exception):
+    def __init__(self, line, response):
+        super().__init__(f"GRBL {response} for: {line}")
+        self.line = line
+        self.response = response
+
+# Raised for every outstanding command when GRBL resets. GRBL throws away its
+# receive buffer when this happens, so those commands will never be answered.
+class GRBLReset(Exception):
+    pass
+
+
+# Work out what kind of line GRBL has sent us
+def classify_line(line):
+    if line == "ok":
+        return "ok"
+    if line.startswith("error:"):
+        return "error"
+    if line.startswith("<"):
+        return "status"
+    if line.startswith("[PRB:"):
+        return "probe"
+    if line.startswith("ALARM:"):
+        return "alarm"
+    if line.startswith("[MSG:"):
+        return "message"
+    if line.startswith("[") or line.startswith("$"):
+        return "feedback"
+    if line.startswith("Grbl "):
+        return "banner"
+    return "other"
+
+# Turn a "[PRB:x,y,z:1]" line into ((x, y, z), success)
+def parse_probe(line):
+    body = line.strip("[]")[4:]
+    coords, _, success = body.rpartition(":")
+    return tuple(float(v) for v in coords.split(",")), success == "1"
+
+
+# The outcome of a command: the line sent, GRBL's "ok", and any feedback lines
+# GRBL produced while executing it
+class CommandResult:
+    def __init__(self, line):
+        self.line = line
+        self.response = None
+        self.feedback = []
+
+    # The ((x, y, z), success) from a probing command, or None
+    @property
+    def probe(self):
+        for line in self.feedback:
+            if line.startswith("[PRB:"):
+                return parse_probe(line)
+        return None
+
+    def __repr__(self):
+        return f"CommandResult({self.line!r}, {self.response!r}, {self.feedback!r})"
+
+
+class GRBLTransport:
+    def __init__(self, ser, rx_buffer_size=GRBL_RX_BUFFER_SIZE):
+        self.ser = ser
+        # Short timeout so the reader notices when it is asked to stop
+        self.ser.timeout = 0.1
+        self.rx_buffer_size = rx_buffer_size
+        # (CommandResult, future) for each command GRBL has not answered yet
+        self.pending = deque()
+        self.buffered_bytes = 0
+        self.subscribers = {kind: [] for kind in LINE_KINDS}
+        self.reader = None
+        self.running = False
+        self.space = None
+        self.write_lock = None
+        self.loop = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.space = asyncio.Condition()
+        self.write_lock = asyncio.Lock()
+        self.running = True
+        self.reader = asyncio.create_task(self._read_lines())
+
+    async def close(self):
+        self.running = False
+        if self.reader:
+            await self.reader
+            self.reader = None
+        self._fail_pending(GRBLReset("Transport closed"))
+        self.ser.close()
+
+    # Call callback(line) from the event loop for every line of the given kind.
+    # Returns a function that cancels the subscription.
+    def subscribe(self, kind, callback):
+        if kind not in self.subscribers:
+            raise ValueError(f"Unknown line kind {kind}, choose from {', '.join(LINE_KINDS)}")
+        self.subscribers[kind].append(callback)
+        return lambda: self.subscribers[kind].remove(callback)
+
+    # Wait for the next line of the given kind, such as "alarm" or "status"
+    async def wait_for(self, kind, timeout=None):
+        future = self.loop.create_future()
+
+        def deliver(line):
+            if not future.done():
+                future.set_result(line)
+
+        unsubscribe = self.subscribe(kind, deliver)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            unsubscribe()
+
+    # Send a realtime command such as b"?", b"!", b"~" or b"\x18". These bypass
+    # GRBL's receive buffer so they don't need to be counted or answered.
+    def realtime(self, byte):
+        self.ser.write(byte)
+
+    # Send one line of GCODE and wait for GRBL to answer it. Raises GRBLError if
+    # GRBL rejects it, GRBLReset if a reset means it never will.
+    async def command(self, line, timeout=None):
+        future = await self.send(line)
+        return await asyncio.wait_for(future, timeout)
+
+    # Queue one line of GCODE without waiting for the answer. Waits only for room
+    # in GRBL's receive buffer, and returns a future for the CommandResult.
+    async def send(self, line):
+        line = clean_gcode_line(line)
+        size = len(line) + 1
+        if size > self.rx_buffer_size:
+            raise ValueError(f"GCODE line too long for GRBL receive buffer: {line}")
+        async with self.write_lock:
+            async with self.space:
+                await self.space.wait_for(lambda: self.buffered_bytes + size <= self.rx_buffer_size)
+                self.buffered_bytes += size
+            result = CommandResult(line)
+            future = self.loop.create_future()
+            self.pending.append((result, future))
+            await self.loop.run_in_executor(None, self.ser.write, (line + "\n").encode('ascii'))
+        return future
+
+    # Fail every outstanding command and forget about the receive buffer contents
+    def _fail_pending(self, exception):
+        while self.pending:
+            result, future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(exception)
+        self.buffered_bytes = 0
+
+    async def _release_space(self, size):
+        async with self.space:
+            self.buffered_bytes = max(0, self.buffered_bytes - size)
+            self.space.notify_all()
+
+    # The one and only reader of the serial port. Lines cut short by the read
+    # timeout are put back together before they are handled.
+    async def _read_lines(self):
+        lines = LineBuffer(self.ser)
+        while self.running:
+            raw = await self.loop.run_in_executor(None, lines.readline)
+            if raw is None:
+                continue
+            line = raw.decode('ascii', errors='ignore').strip()
+            if line:
+                await self._handle_line(line)
+
+    async def _handle_line(self, line):
+        kind = classify_line(line)
+        if kind in ("ok", "error"):
+            if self.pending:
+                result, future = self.pending.popleft()
+                result.response = line
+                await self._release_space(len(result.line) + 1)
+                if not future.done():
+                    if kind == "ok":
+                        future.set_result(result)
+                    else:
+                        future.set_exception(GRBLError(result.line, line))
+        elif kind in ("probe", "feedback") and self.pending:
+            # GRBL only produces these while executing the oldest command
+            self.pending[0][0].feedback.append(line)
+        elif kind == "banner":
+            self._fail_pending(GRBLReset(line))
+            async with self.space:
+                self.space.notify_all()
+
+        for callback in list(self.subscribers[kind]):
+            try:
+                callback(line)
+            except Exception as e:
+                print("Subscriber for", kind, "failed:", e)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# dccalibrate.py - Fits the delta stage geometry in dcstage to probe measurements
+# Released under GPL3 or later
+#
+# The stage_radius, stage_height, lever_length and base_radius in dcstage.py are
+# design values. Printed flexures never match them exactly, and the error shows up
+# as a bowl-shaped Z deviation when the TCP is moved around a flat surface.
+#
+# Feed this a CSV file of probe samples, one per line:
+#   a,b,c,z
+# where a,b,c are the tower (GRBL X,Y,Z) positions reported when the probe
+# touched, and z is the known height of the surface at that point (0 for a flat
+# slide). Lines starting with # are ignored.
+#
+# The geometry is found by a vectorised Levenberg-Marquardt fit that makes the
+# forward kinematics of every sample land on the surface. The result is written
+# to dcstage_geometry.json, which dcstage loads at startup.
+
+import argparse
+import json
+import math
+import sys
+import time
+import numpy as np
+import dcstage
+
+# The stage joints sit at these angles around the TCP and the base
+JOINT_ANGLES = np.array([0, 2 * math.pi / 3, 4 * math.pi / 3])
+
+# Step used for numerical derivatives, in mm
+DERIVATIVE_STEP = 1e-6
+
+
+# Read the a,b,c,z probe samples from a CSV file.
+# Returns (towers, z) as an (N,3) array and an (N,) array.
+def load_samples(file_path):
+    rows = []
+    with open(file_path, 'r') as file:
+        for line in file:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            values = [float(v) for v in line.replace(',', ' ').split()]
+            if len(values) != 4:
+                raise ValueError(f"Expected a,b,c,z but got: {line}")
+            rows.append(values)
+    samples = np.array(rows, dtype=float).reshape(-1, 4)
+    return samples[:, :3], samples[:, 3]
+
+
+# Vectorised version of dcstage.calculate_joint_positions.
+# tcp is an (N,3) array of TCP locations, geometry is a dict of the dcstage
+# parameters. Returns an (N,3) array of tower displacements. Unreachable
+# positions come back as NaN.
+def joint_positions(tcp, geometry):
+    radius = geometry["stage_radius"]
+    height = geometry["stage_height"]
+    lever = geometry["lever_length"]
+    base = geometry["base_radius"]
+    arm = math.sqrt(lever**2 + height**2)
+
+    cos_a = np.cos(JOINT_ANGLES)
+    sin_a = np.sin(JOINT_ANGLES)
+    # Stage joint and base joint positions, shape (N,3) for each coordinate
+    tx = tcp[:, 0:1] + radius * cos_a
+    ty = tcp[:, 1:2] + radius * sin_a
+    tz = tcp[:, 2:3]
+    bx = base * cos_a
+    by = base * sin_a
+    # Distance from each base pivot to its TCP pivot
+    l = np.sqrt((tx - bx)**2 + (ty - by)**2 + (tz + height)**2)
+    # Distance in XY plane, TCP pivot minus base pivot
+    d_tx = np.sqrt(tx**2 + ty**2) - base
+    # Law of Cosines for the angle at the base pivot, as in dcstage.lever_displacement
+    with np.errstate(invalid='ignore'):
+        alpha = np.arccos((l**2 + lever**2 - arm**2) / (2 * l * lever))
+    theta = alpha + np.arctan(d_tx / (tz + height))
+    return lever * np.cos(theta)
+
+
+# Forward kinematics: find the TCP locations that put the towers at the given
+# displacements. Newton's method on every sample at once, with the 3x3 Jacobians
+# found numerically. Returns an (N,3) array.
+def tcp_positions(towers, geometry, iterations=20):
+    tcp = np.zeros_like(towers)
+    for _ in range(iterations):
+        error = joint_positions(tcp, geometry) - towers
+        jacobian = np.empty(towers.shape + (3,))
+        for axis in range(3):
+            shifted = tcp.copy()
+            shifted[:, axis] += DERIVATIVE_STEP
+            jacobian[:, :, axis] = (joint_positions(shifted, geometry) - towers - error) / DERIVATIVE_STEP
+        step = np.linalg.solve(jacobian, error[:, :, np.newaxis])[:, :, 0]
+        tcp -= step
+        if not np.any(np.abs(step) > 1e-12):
+            break
+    return tcp
+
+
+# Work out the residuals for a set of samples. GRBL tower positions are relative to
+# the towers at TCP (0,0,0) because deltacontrol zeroes them there, so we add that
+# back on before running the forward kinematics.
+def residuals(towers, surface_z, geometry, z_offset):
+    zero = joint_positions(np.zeros((1, 3)), geometry)
+    tcp = tcp_positions(towers + zero, geometry)
+    return tcp[:, 2] - surface_z - z_offset
+
+
+# Levenberg-Marquardt fit of the named geometry parameters plus a constant Z offset
+# for the surface. Z-only measurements can't pin down every parameter on their own,
+# so each parameter is gently held towards its starting value by prior_weight
+# (residual per mm of change). Returns (geometry, z_offset, residuals, iterations used).
+def fit_geometry(towers, surface_z, geometry, fit_names, iterations=50, prior_weight=1e-4, tolerance=1e-12):
+    geometry = dict(geometry)
+    start = np.array([geometry[name] for name in fit_names])
+    # The surface offset starts off at the average error so it doesn't swamp the rest
+    z_offset = np.nanmean(residuals(towers, surface_z, geometry, 0.0))
+    params = np.append(start, z_offset)
+
+    def evaluate(p):
+        trial = dict(geometry)
+        trial.update(zip(fit_names, p[:-1]))
+        r = residuals(towers, surface_z, trial, p[-1])
+        return np.concatenate((r, prior_weight * (p[:-1] - start)))
+
+    r = evaluate(params)
+    cost = np.sum(r**2)
+    damping = 1e-3
+    used = 0
+    for used in range(1, iterations + 1):
+        # Numerical Jacobian, one batched forward kinematic solve per parameter
+        jacobian = np.empty((len(r), len(params)))
+        for i in range(len(params)):
+            shifted = params.copy()
+            shifted[i] += DERIVATIVE_STEP * max(1.0, abs(params[i]))
+            jacobian[:, i] = (evaluate(shifted) - r) / (shifted[i] - params[i])
+        jtj = jacobian.T @ jacobian
+        gradient = jacobian.T @ r
+
+        # Increase the damping until the step actually improves things
+        while damping < 1e12:
+            step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj) + 1e-12), -gradient)
+            trial = params + step
+            trial_r = evaluate(trial)
+            trial_cost = np.sum(trial_r**2)
+            if np.isfinite(trial_cost) and trial_cost < cost:
+                damping = max(damping / 3, 1e-12)
+                break
+            damping *= 4
+        else:
+            break
+
+        improvement = cost - trial_cost
+        params, r, cost = trial, trial_r, trial_cost
+        if improvement < tolerance * max(cost, 1e-30) or np.max(np.abs(step)) < 1e-12:
+            break
+
+    geometry.update(zip(fit_names, params[:-1]))
+    return geometry, params[-1], r[:len(surface_z)], used
+
+
+# Write the geometry where dcstage.load_geometry will find it
+def write_geometry(file_path, geometry, z_offset, r, fit_names):
+    output = {name: float(geometry[name]) for name in dcstage.GEOMETRY_NAMES}
+    output["fitted"] = list(fit_names)
+    output["z_offset"] = float(z_offset)
+    output["samples"] = int(len(r))
+    output["rms_residual"] = float(np.sqrt(np.mean(r**2)))
+    output["max_residual"] = float(np.max(np.abs(r)))
+    output["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    with open(file_path, 'w') as file:
+        json.dump(output, file, indent=2)
+        file.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fit delta stage geometry to probe measurements of a known surface"
+    )
+    parser.add_argument("samples", help="CSV file of a,b,c,z probe samples")
+    parser.add_argument("-o", "--output", default=dcstage.GEOMETRY_FILE,
+                        help="Geometry file to write (default: the one dcstage loads)")
+    parser.add_argument("--fit", default=",".join(dcstage.GEOMETRY_NAMES),
+                        help="Comma separated list of parameters to fit")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="Maximum number of fit iterations")
+    parser.add_argument("--prior-weight", type=float, default=1e-4,
+                        help="How hard to hold parameters near their current values (per mm)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report the fit but don't write the geometry file")
+    args = parser.parse_args()
+
+    fit_names = [name.strip() for name in args.fit.split(",") if name.strip()]
+    for name in fit_names:
+        if name not in dcstage.GEOMETRY_NAMES:
+            parser.error(f"Unknown parameter {name}, choose from {', '.join(dcstage.GEOMETRY_NAMES)}")
+
+    towers, surface_z = load_samples(args.samples)
+    if len(surface_z) < len(fit_names) + 1:
+        sys.exit(f"Need at least {len(fit_names) + 1} samples to fit {len(fit_names)} parameters and a Z offset")
+
+    start = {name: getattr(dcstage, name) for name in dcstage.GEOMETRY_NAMES}
+    r_start = residuals(towers, surface_z, start, 0.0)
+    r_start = r_start - np.mean(r_start)
+    geometry, z_offset, r, used = fit_geometry(towers, surface_z, start, fit_names,
+                                                args.iterations, args.prior_weight)
+
+    print(f"Fitted {len(surface_z)} samples in {used} iterations\n")
+    for name in dcstage.GEOMETRY_NAMES:
+        print(f"{name:>14}: {start[name]:10.5f} -> {geometry[name]:10.5f}")
+    print(f"{'z_offset':>14}: {z_offset:10.5f}\n")
+    print(f"RMS residual: {np.sqrt(np.mean(r_start**2)):.6f} -> {np.sqrt(np.mean(r**2)):.6f}")
+    print(f"Max residual: {np.max(np.abs(r_start)):.6f} -> {np.max(np.abs(r)):.6f}\n")
+    for (a, b, c), z, res in zip(towers, surface_z, r):
+        print(f"  A{a:9.4f} B{b:9.4f} C{c:9.4f}  Z{z:9.4f}  residual {res:+.6f}")
+
+    if not args.dry_run:
+        write_geometry(args.output, geometry, z_offset, r, fit_names)
+        print("\nWrote", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# dccore.py - Headless delta stage controller with a local socket command API
+# Released under GPL3 or later
+#
+# Everything deltacontrol knows about driving the stage, without the window:
+# the TCP position the user sees, the machine offsets set by zeroing axes, the
+# kinematics in dcstage and dccalibrate, and the GRBL serial port. Nothing here
+# imports graphics.py, so it runs on machines without a display and starts up
+# without paying for Tk.
+#
+# Run it on its own to serve the controller on a Unix domain socket:
+#   dccore.py --port /dev/ttyACM1 --socket /tmp/deltacontrol.sock
+# Clients send one JSON object per line and get one JSON object back per line:
+#   {"cmd": "move", "x": 0.1, "y": 0, "z": 0.05, "id": 7}
+#   {"ok": true, "id": 7, "result": {"x": 0.1, "y": 0.0, "z": 0.05}}
+# or on failure
+#   {"ok": false, "id": 7, "error": "GRBL error:9 for: G0 X..."}
+# The "id" is optional and is passed back unchanged. Commands are listed in
+# COMMANDS below. From the shell, give the command and key=value arguments:
+#   dccore.py --socket /tmp/deltacontrol.sock move x=0.1 z=0.05
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import numpy as np
+import dcserial
+import dcstatus
+import dcstage
+import dccalibrate
+from dcasync import GRBLError
+
+DEFAULT_PORT = '/dev/ttyACM1'
+DEFAULT_BAUD = 115200
+DEFAULT_SOCKET = '/tmp/deltacontrol.sock'
+
+# Tower feed rate for jogs if GRBL doesn't tell us its max rates
+JOG_FEED = 1000
+# GRBL's X, Y and Z max rate settings (mm/min). Jogs go at the slowest.
+MAX_RATE_SETTINGS = (110, 111, 112)
+# GRBL's realtime jog cancel and soft reset commands
+JOG_CANCEL = b"\x85"
+SOFT_RESET = b"\x18"
+# How long to wait for GRBL to answer a status request (s)
+STATUS_TIMEOUT = 0.25
+
+
+# The delta stage and the GRBL board driving it. Methods that talk to GRBL hold
+# a lock, so several threads (or socket clients) can share one controller.
+# jog_feed is the tower feed rate for jogs, or None to use GRBL's max rate.
+class DeltaController:
+    def __init__(self, ser=None, jog_feed=None):
+        self.ser = ser
+        self.jog_feed = jog_feed
+        self.lock = threading.RLock()
+        # The TCP position the user sees
+        self.position = [0.0, 0.0, 0.0]
+        # The "machine offsets" which hold position when the user redefines an axis to zero
+        self.mc_offset = [0.0, 0.0, 0.0]
+        # Actual start positions of the delta towers. In theory zero, but in
+        # practice may be small roundings or plain wrong
+        self.tower_zero_offset = (0, 0, 0)
+        # Status reports with the machine position, and the work offset they leave out
+        self.telemetry = dcstatus.TelemetryBuffer(1024)
+        self.last_status = None
+
+    # Open the port, or find GRBL on any port that looks like a GRBL board (or
+    # any port at all, with scan_all). open_port can be given to do it some
+    # other way, such as dcserial.initialize_with_retry with its port picker.
+    def connect(self, baudrate=DEFAULT_BAUD, port=DEFAULT_PORT, open_port=None, scan_all=False):
+        if open_port:
+            self.ser = open_port()
+        else:
+            self.ser = dcserial.find_grbl(baudrate, port, scan_all=scan_all)
+        if self.ser is None:
+            raise OSError(f"Could not find GRBL on {port} or any other serial port")
+        return self.ser
+
+    # Get going with the stage where it is. This assumes the machine *was* zeroed,
+    # which is an iffy thing to do.
+    def start(self):
+        with self.lock:
+            dcserial.wait_for_data_pause(self.ser)
+            # Issue GRBL G92 command to set the current work axes to (0,0,0)
+            dcserial.send_GRBL_command(self.ser, "G92 X0 Y0 Z0\n")
+            if self.jog_feed is None:
+                self.jog_feed = self.max_rate()
+            print("Jog feed: ", self.jog_feed)
+        # Find out where the virtual towers are when the TCP is at (0,0,0)
+        # This is subtracted from any positioning so movement is relative to (0,0,0)
+        self.tower_zero_offset = dcstage.calculate_joint_positions((0, 0, 0))
+        print("Tower zero offset: ", self.tower_zero_offset)
+
+    # The slowest of GRBL's tower max rates, or JOG_FEED if it doesn't say
+    def max_rate(self):
+        with self.lock:
+            settings = dcserial.read_grbl_settings(self.ser)
+        rates = [settings[n] for n in MAX_RATE_SETTINGS if settings.get(n, 0) > 0]
+        return min(rates) if rates else JOG_FEED
+
+    def close(self):
+        with self.lock:
+            if self.ser:
+                self.ser.close()
+
+    # ---- Kinematics ----
+
+    # Work out the tower positions for the TCP at user coordinates pos
+    def tower_positions(self, pos):
+        # Combine the user coordinates with machine coordinates
+        # Note: Y is inverted in this hardware, so we flip it.
+        x_mc, y_mc, z_mc = self.mc_offset
+        towers = dcstage.calculate_joint_positions((x_mc + pos[0], y_mc - pos[1], z_mc + pos[2]))
+        # Subtract the zero offset from each axis. This should not do anything.
+        # However, it has saved our bacon when things were misconfigured.
+        return tuple(t - o for t, o in zip(towers, self.tower_zero_offset))
+
+    # Turn tower positions reported by GRBL back into user coordinates for the TCP
+    def tcp_from_towers(self, towers):
+        geometry = {name: getattr(dcstage, name) for name in dcstage.GEOMETRY_NAMES}
+        absolute = np.array([[t + o for t, o in zip(towers, self.tower_zero_offset)]])
+        x, y, z = dccalibrate.tcp_positions(absolute, geometry)[0]
+        x_mc, y_mc, z_mc = self.mc_offset
+        return (float(x - x_mc), float(y_mc - y), float(z - z_mc))
+
+    # ---- Talking to GRBL ----
+
+    # Send one line and return GRBL's answer, raising GRBLError if it's an error
+    def send(self, line):
+        with self.lock:
+            response = dcserial.send_GRBL_command_ok(self.ser, line.strip() + "\n")
+        if response.startswith("error:"):
+            raise GRBLError(line.strip(), response)
+        return response
+
+    # Move the TCP to pos (x, y, z) with a G0 move of the towers
+    def move_to(self, pos):
+        x, y, z = self.tower_positions(pos)
+        self.send(f"G0 X{x:.5f} Y{y:.5f} Z{z:.5f}")
+        self.position = list(pos)
+
+    # Jog the TCP to pos. GRBL answers as soon as the jog is planned, and it can
+    # be cancelled part way with cancel_jog(). For the short distances we jog, the
+    # straight line the towers take is close enough to a straight line for the TCP.
+    def jog_to(self, pos):
+        x, y, z = self.tower_positions(pos)
+        self.send(f"$J=G90 X{x:.5f} Y{y:.5f} Z{z:.5f} F{self.jog_feed or JOG_FEED:g}")
+        self.position = list(pos)
+
+    def jog_by(self, dx=0.0, dy=0.0, dz=0.0):
+        self.jog_to([p + d for p, d in zip(self.position, (dx, dy, dz))])
+
+    # Stop a jog where it is. This is a realtime byte so it doesn't wait for the lock.
+    def cancel_jog(self):
+        self.ser.write(JOG_CANCEL)
+
+    # Stop whatever GRBL is doing at once
+    def soft_reset(self):
+        self.ser.write(SOFT_RESET)
+
+    # Move the XY axes to zero first, then the Z
+    def go_home(self):
+        self.move_to((0, 0, self.position[2]))
+        self.move_to((0, 0, 0))
+
+    # Make the current position read as zero on the given axes, e.g. "xy" or "z",
+    # by adjusting the machine offsets. The stage doesn't move.
+    def zero_axes(self, axes):
+        for axis in axes.lower():
+            i = "xyz".index(axis)
+            self.mc_offset[i] += self.position[i]
+            self.position[i] = 0.0
+
+    # Unlock the CNC driver from fault state. DANGER DANGER!
+    def unlock(self):
+        with self.lock:
+            # Because we don't know what will happen, we just wait for data to
+            # cease being sent to us by GRBL rather than look for "ok"
+            dcserial.send_GRBL_command(self.ser, "$X\n")
+            # Set current position as workplace zero coordinates.
+            dcserial.send_GRBL_command_ok(self.ser, "G92 X0 Y0 Z0\n")
+            # Display the machine position and error state on the console
+            dcserial.send_GRBL_command(self.ser, "?\n")
+
+    # Seek and rehome the CNC driver, move up a bit, and set zero
+    def rehome(self):
+        with self.lock:
+            # Issue GRBL home axes command and wait for the OK
+            dcserial.send_GRBL_command_ok(self.ser, "$H\n")
+            # Set current position as workplace zero coordinates
+            # before we move up for elbow room.
+            dcserial.send_GRBL_command_ok(self.ser, "G92 X0 Y0 Z0\n")
+            # Move up a bit on the Z axis to give arms room to manoeuvre
+            dcserial.send_GRBL_command_ok(self.ser, "G0 X2 Y2 Z2\n")
+            # Set current position as workplace zero coordinates.
+            dcserial.send_GRBL_command_ok(self.ser, "G92 X0 Y0 Z0\n")
+            # Display on the console what the CNC thinks it is doing
+            dcserial.send_GRBL_command(self.ser, "?\n")
+
+    # Wait up to timeout seconds for a status report, passing anything else to the console
+    def read_status_report(self, timeout=STATUS_TIMEOUT):
+        deadline = time.time() + timeout
+        self.ser.timeout = timeout
+        while time.time() < deadline:
+            line = self.ser.readline().decode('ascii', errors='ignore').strip()
+            if not line:
+                continue
+            report = dcstatus.parse_status_report(line)
+            if report is not None:
+                self.telemetry.append(report)
+                return report
+            print(": ", line)
+        return None
+
+    # Ask GRBL for a status report. Returns the state and tower work positions,
+    # or None if GRBL didn't answer.
+    def status(self, timeout=STATUS_TIMEOUT):
+        with self.lock:
+            self.ser.write(b"?")
+            if self.read_status_report(timeout) is None:
+                return None
+        latest = self.telemetry.latest()
+        if np.isnan(latest["wpos_x"]):
+            return None
+        return latest["state"], (latest["wpos_x"], latest["wpos_y"], latest["wpos_z"])
+
+    # As status(), but None if nothing has changed since the last time
+    def status_changed(self, timeout=STATUS_TIMEOUT):
+        status = self.status(timeout)
+        if status is None or status == self.last_status:
+            return None
+        self.last_status = status
+        return status
+
+    # Ask GRBL where the towers are once it has stopped moving. GRBL only includes
+    # the work coordinate offset in some status reports, so we keep asking until
+    # we have it. Returns the tower work positions, or None if GRBL didn't tell us in time.
+    def query_tower_positions(self, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = self.status(min(STATUS_TIMEOUT, max(deadline - time.time(), 0.01)))
+            if status is not None and status[0] not in ("Run", "Jog", "Hold"):
+                return status[1]
+            time.sleep(0.02)
+        return None
+
+    # Find out where the TCP really is, and make that the current position.
+    # Returns the position, or None if GRBL didn't say.
+    def update_position(self, timeout=2):
+        towers = self.query_tower_positions(timeout)
+        if towers is None:
+            return None
+        tcp = self.tcp_from_towers(towers)
+        if np.all(np.isfinite(tcp)):
+            self.position = list(tcp)
+        return self.position
+
+    def position_dict(self):
+        return dict(zip("xyz", (float(p) for p in self.position)))
+
+
+# ---- Socket API ----
+
+def _target(controller, request):
+    return [float(request.get(axis, current)) for axis, current in zip("xyz", controller.position)]
+
+def _move(controller, request):
+    controller.move_to(_target(controller, request))
+    return controller.position_dict()
+
+def _jog(controller, request):
+    controller.jog_by(*(float(request.get("d" + axis, 0.0)) for axis in "xyz"))
+    return controller.position_dict()
+
+def _jog_to(controller, request):
+    controller.jog_to(_target(controller, request))
+    return controller.position_dict()
+
+def _cancel(controller, request):
+    controller.cancel_jog()
+    controller.update_position()
+    return controller.position_dict()
+
+def _zero(controller, request):
+    controller.zero_axes(request.get("axes", "xyz"))
+    return {"position": controller.position_dict(), "mc_offset": controller.mc_offset}
+
+def _home(controller, request):
+    controller.go_home()
+    return controller.position_dict()
+
+def _status(controller, request):
+    status = controller.status()
+    if status is None:
+        raise TimeoutError("No status report from GRBL")
+    state, towers = status
+    return {"state": state, "towers": towers, "tcp": dict(zip("xyz", controller.tcp_from_towers(towers)))}
+
+# Command name -> function(controller, request) returning the result
+COMMANDS = {
+    "ping": lambda controller, request: "pong",
+    "position": lambda controller, request: controller.position_dict(),
+    "where": lambda controller, request: dict(zip("xyz", controller.update_position() or [None] * 3)),
+    "move": _move,              # x, y, z: absolute TCP position, missing axes stay put
+    "jog": _jog,                # dx, dy, dz: relative jog
+    "jog_to": _jog_to,          # x, y, z: absolute jog
+    "cancel": _cancel,          # Cancel a jog, and return where it stopped
+    "zero": _zero,              # axes: e.g. "xy" or "z"
+    "home": _home,              # Move the TCP to 0,0,0
+    "rehome": lambda controller, request: controller.rehome(),
+    "unlock": lambda controller, request: controller.unlock(),
+    "reset": lambda controller, request: controller.soft_reset(),
+    "status": _status,
+    "gcode": lambda controller, request: controller.send(request["line"]),
+}
+
+
+# Run one request on the controller and build the reply
+def dispatch(controller, request):
+    reply = {"ok": True}
+    if isinstance(request, dict) and "id" in request:
+        reply["id"] = request["id"]
+    try:
+        command = COMMANDS[request["cmd"]]
+        reply["result"] = command(controller, request)
+    except KeyError as e:
+        reply = dict(reply, ok=False, error=f"Missing or unknown {e}")
+    except Exception as e:
+        reply = dict(reply, ok=False, error=str(e))
+    return reply
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            if not raw.strip():
+                continue
+            try:
+                request = json.loads(raw)
+            except ValueError as e:
+                reply = {"ok": False, "error": f"Bad JSON: {e}"}
+            else:
+                reply = dispatch(self.server.controller, request)
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+# Serves a controller on a Unix domain socket, one thread per client
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, controller, path=DEFAULT_SOCKET):
+        self.controller = controller
+        # A socket file left behind by a server that didn't shut down cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ControlHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+# Talks to a ControlServer. Raises RuntimeError if a command fails.
+class ControlClient:
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def command(self, cmd, **args):
+        self.file.write((json.dumps(dict(args, cmd=cmd)) + "\n").encode())
+        self.file.flush()
+        reply = json.loads(self.file.readline())
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return reply.get("result")
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+# Turn key=value arguments from the command line into a request
+def parse_arguments(words):
+    request = {}
+    for word in words:
+        key, _, value = word.partition("=")
+        try:
+            request[key] = float(value)
+        except ValueError:
+            request[key] = value
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the delta stage controller on a Unix socket, or send it a command"
+    )
+    parser.add_argument("command", nargs="?", help="Send this command to a running server and print the reply")
+    parser.add_argument("args", nargs="*", help="key=value arguments for the command")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix domain socket path")
+    parser.add_argument("--port", default=DEFAULT_PORT, help="Serial port for GRBL (searched for if not there)")
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD, help="Serial baud rate")
+    parser.add_argument("--scan-all", action="store_true",
+                        help="If GRBL isn't on --port, look on every serial port, not just ones on Arduino-like USB chips")
+    parser.add_argument("--jog-feed", type=float, help="Tower feed rate for jogs (default: GRBL's max rate)")
+    args = parser.parse_args()
+
+    if args.command:
+        client = ControlClient(args.socket)
+        try:
+            print(json.dumps(client.command(args.command, **parse_arguments(args.args))))
+        except RuntimeError as e:
+            sys.exit(str(e))
+        finally:
+            client.close()
+        return
+
+    controller = DeltaController(jog_feed=args.jog_feed)
+    controller.connect(args.baud, args.port, scan_all=args.scan_all)
+    controller.start()
+    server = ControlServer(controller, args.socket)
+    print("Serving delta stage on", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        controller.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,171 @@
 # dcserial.py - Serial port routines used by deltacontrol Control Panel
 # Released under GPL3 or later by vik@diamondage.co.nz 2024
-# Uses the free Zelle portable graphics library
+# Uses the free Zelle portable graphics library for picking a port, but only
+# loads it when that is needed so the rest works without a display.
 
+import time
+import math
+import json
+import csv
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import serial
 import serial.tools.list_ports
-from graphics import *
 
+# GRBL's serial receive buffer size. The character counting streamer keeps it full.
+GRBL_RX_BUFFER_SIZE = 128
+# While GRBL is quiet, the streamer asks for a status report at most this often (s)
+# to see if it's still busy. States that mean it still has what it was sent in hand,
+# including a feed hold, which can last as long as the user likes:
+STREAM_STATUS_INTERVAL = 0.5
+BUSY_STATES = ("Run", "Jog", "Hold", "Home")
+
+# Latency histograms have this many logarithmic bins per decade, from 10us to 100s
+LATENCY_BINS_PER_DECADE = 10
+LATENCY_MIN_DECADE = -5
+LATENCY_DECADES = 7
+# How many individual command timings to keep for dumping
+LATENCY_RECORDS = 10000
+
+# Longest we wait for a board to identify itself. An Arduino bootloader takes a
+# second or two after the port is opened resets it.
+IDENTIFY_TIMEOUT = 4.0
+# How often to ask with $I, for boards that don't reset when the port is opened
+IDENTIFY_INTERVAL = 0.5
+# USB serial chips on the boards that run GRBL, as (vendor id, product id), or
+# None for any product from that vendor: Arduinos, and the CH340, FTDI and CP210x
+# chips on their clones. Other ports are only tried if asked to scan them all.
+GRBL_USB_IDS = {(0x2341, None), (0x2A03, None), (0x1A86, 0x7523), (0x0403, 0x6001), (0x10C4, 0xEA60)}
+
+
+# Open a port and wait for GRBL to identify itself, either with its "Grbl x.y"
+# startup banner or by answering $I. Returns the open port as soon as it does,
+# with the version in ser.grbl_version, or None if it never does.
+# Gives up early if the stop event is set, e.g. another port won the race.
+def identify_grbl(port, baudrate, timeout=IDENTIFY_TIMEOUT, stop=None):
+    try:
+        ser = serial.Serial(port, baudrate, timeout=0.05)
+    except (serial.SerialException, OSError):
+        return None
+    start_time = time.monotonic()
+    next_query = start_time + IDENTIFY_INTERVAL
+    version = None
+    try:
+        while time.monotonic() - start_time < timeout and not (stop and stop.is_set()):
+            response = ser.readline().decode('ascii', errors='ignore').strip()
+            if response.startswith("Grbl "):
+                version = response.split()[1]
+                break
+            if response.startswith("[VER:"):
+                version = response[5:].split(":")[0]
+                # Swallow the rest of the $I answer
+                while response != "ok" and time.monotonic() - start_time < timeout:
+                    response = ser.readline().decode('ascii', errors='ignore').strip()
+                break
+            if time.monotonic() > next_query:
+                ser.write(b"$I\n")
+                next_query = time.monotonic() + IDENTIFY_INTERVAL
+    except (serial.SerialException, OSError):
+        version = None
+    if version is None:
+        ser.close()
+        return None
+    ser.timeout = None
+    ser.grbl_version = version
+    return ser
+
+# True if a port from serial.tools.list_ports is on a USB chip GRBL boards use
+def looks_like_grbl(port_info):
+    return (port_info.vid, port_info.pid) in GRBL_USB_IDS or (port_info.vid, None) in GRBL_USB_IDS
+
+# Look for GRBL on the suggested port, then on every port that looks like a GRBL
+# board at once (or every port, with scan_all), and return the first port that
+# identifies itself (or None). Ports that lose the race are closed. We write
+# $I to the ports we try, so unrelated devices are left alone unless scan_all.
+def find_grbl(baudrate, suggested_port=None, timeout=IDENTIFY_TIMEOUT, scan_all=False):
+    if suggested_port:
+        ser = identify_grbl(suggested_port, baudrate, timeout)
+        if ser:
+            print("Found GRBL", ser.grbl_version, "on", ser.port)
+            return ser
+    ports = [port.device for port in serial.tools.list_ports.comports()
+             if port.device != suggested_port and (scan_all or looks_like_grbl(port))]
+    if not ports:
+        return None
+    stop = threading.Event()
+    found = None
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        attempts = [pool.submit(identify_grbl, port, baudrate, timeout, stop) for port in ports]
+        for attempt in as_completed(attempts):
+            ser = attempt.result()
+            if ser is None:
+                continue
+            if found is None:
+                found = ser
+                stop.set()
+                print("Found GRBL", ser.grbl_version, "on", ser.port)
+            else:
+                ser.close()
+    return found
+
+# Keeps a connection to GRBL open, finding the board again if it goes away,
+# for instance after being unplugged or if it comes back on a different port.
+class GRBLConnection:
+    def __init__(self, baudrate, suggested_port=None, timeout=IDENTIFY_TIMEOUT, scan_all=False):
+        self.baudrate = baudrate
+        self.suggested_port = suggested_port
+        self.timeout = timeout
+        self.scan_all = scan_all
+        self.ser = None
+
+    def connect(self):
+        self.ser = find_grbl(self.baudrate, self.suggested_port, self.timeout, self.scan_all)
+        if self.ser:
+            # Next time, try where we found it first
+            self.suggested_port = self.ser.port
+        return self.ser
+
+    # Keep trying to find the board. retries=None means forever.
+    def reconnect(self, retries=None, delay=1.0):
+        self.close()
+        attempt = 0
+        while retries is None or attempt < retries:
+            if self.connect():
+                return self.ser
+            attempt += 1
+            time.sleep(delay)
+        raise serial.SerialException("Could not find GRBL on any serial port")
+
+    # Run operation(ser), reconnecting and trying again once if the port has failed
+    def run(self, operation):
+        if self.ser is None or not self.ser.is_open:
+            self.reconnect()
+        try:
+            return operation(self.ser)
+        except (serial.SerialException, OSError) as e:
+            print("Lost GRBL connection:", e)
+            self.reconnect()
+            return operation(self.ser)
+
+    def close(self):
+        if self.ser:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.ser = None
+
+
+# Find GRBL, or failing that open the suggested port, or failing that ask the
+# user which port to use. search=False skips looking for GRBL, for when that has
+# already been done elsewhere.
+def initialize_with_retry(baudrate, suggested_port=None, scan_all=False, search=True):
+    # Quickest of all is a board that tells us it is GRBL
+    ser = find_grbl(baudrate, suggested_port, scan_all=scan_all) if search else None
+    if ser:
+        return ser
 
-def initialize_with_retry(baudrate, suggested_port=None):
     if suggested_port:
         try:
             ser = serial.Serial(suggested_port, baudrate)
@@ -15,6 +173,9 @@ def initialize_with_retry(baudrate, suggested_port=None):
         except serial.SerialException:
             pass
 
+    # Only needed for the port picker, and it opens a Tk window on import
+    from graphics import GraphWin, Text, Point
+
     while True:
         # Get available serial ports
         available_ports = serial.tools.list_ports.comports()
@@ -68,29 +229,44 @@ def receive_string(ser):
     response = ser.readline().decode('ascii').strip()
     return response
 
-# Wait forever for an "ok" response from the serial port.
+# Wait forever for an "ok" response from the serial port. GRBL answers
+# "error:" instead if it rejects the command, so we stop for that too. If GRBL
+# is reset the command will never be answered, so its banner ends the wait.
+# Returns the response.
 def send_string_wait_ok(ser):
     while True:
         response = receive_string(ser)
         print("Wait for OK", response)
-        if response == "ok":
-            break
+        if response == "ok" or response.startswith("error:") or response.startswith("Grbl "):
+            return response
+        if response.startswith("<"):
+            latency_stats.note_status(response)
 
 # Wait for serial data to stop coming in for 2 seconds, sending rsponses
 # to the console. This is used to absorb initialisation information
-# after a controller reset.
-def wait_for_data_pause(ser):
+# after a controller reset. If GRBL has already identified itself, there is
+# no need to wait for the banner so we only catch any stragglers.
+# If a command was sent at sent_time, the first "ok" or "error:" is recorded
+# in latency_stats as its answer, to within the 0.1s we check at.
+def wait_for_data_pause(ser, quiet_time=None, sent_time=None):
+    if quiet_time is None:
+        quiet_time = 0.2 if hasattr(ser, "grbl_version") else 2
     start_time = time.time()
     while True:
         if ser.in_waiting > 0:
           response = receive_string(ser)
           print(": ", response)
           start_time = time.time()
+          if response.startswith("<"):
+            latency_stats.note_status(response)
+          elif sent_time is not None and (response == "ok" or response.startswith("error:")):
+            latency_stats.record_response(0, sent_time, 0, response == "ok")
+            sent_time = None
 
         # Wait until no data has been received for a bit
         # This lets the initialisation data scroll past
         time.sleep(0.1)
-        if time.time() - start_time >= 2:
+        if time.time() - start_time >= quiet_time:
           break
 
 # Sends a command to the GRBL hardware on the serial port.
@@ -98,12 +274,342 @@ def wait_for_data_pause(ser):
 # success code.
 def send_GRBL_command(ser,GRBL_command):
     print(GRBL_command, end="")
+    sent_time = time.monotonic()
     ser.write(GRBL_command.encode())
-    wait_for_data_pause(ser)
+    latency_stats.record_send(len(GRBL_command))
+    wait_for_data_pause(ser, sent_time=sent_time)
 
 # Sends a GRBL command to the serial port. Waits for an
-# "ok" before returning. Will wait indefinitely.
+# "ok" (or "error:") before returning it. Will wait indefinitely.
 def send_GRBL_command_ok(ser,GRBL_command):
     print(GRBL_command, end="")
+    sent_time = time.monotonic()
     ser.write(GRBL_command.encode())
-    send_string_wait_ok(ser)
+    latency_stats.record_send(len(GRBL_command))
+    response = send_string_wait_ok(ser)
+    latency_stats.record_response(0, sent_time, 0, response == "ok")
+    return response
+
+# Ask GRBL for its settings with $$. Returns them as {number: value}, e.g.
+# {110: 4.0} for the X max rate, or whatever was read if GRBL doesn't finish.
+def read_grbl_settings(ser):
+    ser.write(b"$$\n")
+    settings = {}
+    while True:
+        response = receive_string(ser)
+        if not response or response == "ok" or response.startswith("error:"):
+            return settings
+        number, equals, value = response[1:].partition("=")
+        if response.startswith("$") and equals:
+            try:
+                settings[int(number)] = float(value.split()[0])
+                continue
+            except (ValueError, IndexError):
+                pass
+        print(": ", response)
+
+# Collects the time between sending each command and GRBL answering it, along
+# with throughput counters. Timings go into fixed logarithmic histograms plus a
+# bounded list of recent commands, so it costs next to nothing to leave running.
+# Each command is recorded with the state and free planner blocks from the most
+# recent status report, to tell USB round trips from a full planner.
+class LatencyStats:
+    def __init__(self, records=LATENCY_RECORDS):
+        self.bins = LATENCY_BINS_PER_DECADE * LATENCY_DECADES
+        self.reset(records)
+
+    # Start counting again, keeping as many records as before unless told otherwise
+    def reset(self, records=None):
+        if records is None:
+            records = self.records.maxlen
+        self.start_time = time.monotonic()
+        self.commands = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.status_reports = 0
+        # Time from send to "ok"/"error:", and between successive answers
+        self.latency_histogram = [0] * self.bins
+        self.interval_histogram = [0] * self.bins
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.last_response_time = None
+        self.state = ""
+        self.planner_free = -1
+        # (number, sent time, latency, bytes queued ahead, ok, state, planner blocks free)
+        self.records = deque(maxlen=records)
+
+    def _bin(self, seconds):
+        if seconds <= 0:
+            return 0
+        index = int((math.log10(seconds) - LATENCY_MIN_DECADE) * LATENCY_BINS_PER_DECADE)
+        return min(max(index, 0), self.bins - 1)
+
+    # Upper edge of each histogram bin, in seconds
+    def bin_edges(self):
+        return [10 ** (LATENCY_MIN_DECADE + (i + 1) / LATENCY_BINS_PER_DECADE) for i in range(self.bins)]
+
+    def record_send(self, size):
+        self.bytes_sent += size
+
+    # Remember the state and planner space from a "<...>" status report
+    def note_status(self, report):
+        self.status_reports += 1
+        fields = report.strip("<>").split("|")
+        self.state = fields[0]
+        for field in fields[1:]:
+            if field.startswith("Bf:"):
+                self.planner_free = int(field[3:].split(",")[0])
+
+    def record_response(self, number, sent_time, queued_bytes, ok):
+        now = time.monotonic()
+        latency = now - sent_time
+        self.commands += 1
+        if not ok:
+            self.errors += 1
+        self.latency_histogram[self._bin(latency)] += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if self.last_response_time is not None:
+            self.interval_histogram[self._bin(now - self.last_response_time)] += 1
+        self.last_response_time = now
+        self.records.append((number, sent_time - self.start_time, latency, queued_bytes, ok,
+                             self.state, self.planner_free))
+
+    # Latency below which the given fraction of commands were answered, from the histogram
+    def percentile(self, fraction):
+        target = fraction * self.commands
+        count = 0
+        for edge, n in zip(self.bin_edges(), self.latency_histogram):
+            count += n
+            if count >= target and count > 0:
+                return min(edge, self.latency_max)
+        return 0.0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start_time
+        return {
+            "elapsed": elapsed,
+            "commands": self.commands,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "status_reports": self.status_reports,
+            "commands_per_second": self.commands / elapsed if elapsed > 0 else 0.0,
+            "latency_mean": self.latency_total / self.commands if self.commands else 0.0,
+            "latency_p50": self.percentile(0.5),
+            "latency_p99": self.percentile(0.99),
+            "latency_max": self.latency_max,
+        }
+
+    def report(self):
+        s = self.summary()
+        return (f"{s['commands']} commands, {s['errors']} errors, {s['commands_per_second']:.1f} commands/s, "
+                f"latency mean {1000 * s['latency_mean']:.1f}ms p50 {1000 * s['latency_p50']:.1f}ms "
+                f"p99 {1000 * s['latency_p99']:.1f}ms max {1000 * s['latency_max']:.1f}ms")
+
+    def dump_json(self, file_path):
+        output = self.summary()
+        output["histogram_bin_edges"] = self.bin_edges()
+        output["latency_histogram"] = self.latency_histogram
+        output["interval_histogram"] = self.interval_histogram
+        output["records"] = [list(r) for r in self.records]
+        with open(file_path, 'w') as file:
+            json.dump(output, file)
+
+    # One row per recent command, for plotting in a spreadsheet
+    def dump_csv(self, file_path):
+        with open(file_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["number", "sent", "latency", "queued_bytes", "ok", "state", "planner_free"])
+            writer.writerows(self.records)
+
+# Always on, shared by everything in this module
+latency_stats = LatencyStats()
+
+# Reads whole lines from a port with a read timeout. If the timeout runs out
+# part way through a line, pyserial's readline() returns what it has so far.
+# That is kept here until the rest of the line arrives.
+class LineBuffer:
+    def __init__(self, ser):
+        self.ser = ser
+        self.partial = b""
+
+    # The next whole line, or None if the port timed out before one arrived
+    def readline(self):
+        raw = self.ser.readline()
+        if not raw.endswith(b"\n"):
+            self.partial += raw
+            return None
+        raw, self.partial = self.partial + raw, b""
+        return raw
+
+# Strip comments and whitespace from a GCODE line so it takes up as little of
+# GRBL's receive buffer as possible. Returns an empty string if nothing is left.
+# Raises ValueError for a "(" comment that isn't closed or a ")" that wasn't opened.
+def clean_gcode_line(line):
+    line = line.split(';', 1)[0]
+    while '(' in line:
+        start = line.index('(')
+        end = line.find(')', start)
+        if end < 0:
+            raise ValueError(f"Unclosed comment in GCODE line: {line.strip()}")
+        line = line[:start] + line[end + 1:]
+    if ')' in line:
+        raise ValueError(f"')' without '(' in GCODE line: {line.strip()}")
+    return line.strip()
+
+# Streams GCODE to GRBL using the character counting protocol.
+# Rather than waiting for an "ok" after every line, we keep track of how many
+# bytes are sitting unprocessed in GRBL's receive buffer and send the next line
+# as soon as it fits. This keeps the planner fed so moves run back to back.
+# Every "ok" or "error:" is matched to the oldest line still in the buffer.
+# Anything else GRBL says (status reports, probe results, alarms, messages) is
+# passed to line_callback if one is supplied.
+# The port must have a read timeout, or a quiet GRBL would block us forever.
+class GRBLStreamer:
+    def __init__(self, ser, rx_buffer_size=GRBL_RX_BUFFER_SIZE, line_callback=None, verbose=False,
+                 echo_errors=True, stats=None):
+        if ser.timeout is None:
+            raise ValueError("GRBLStreamer needs a serial port with a read timeout")
+        self.ser = ser
+        self.stats = latency_stats if stats is None else stats
+        self.rx_buffer_size = rx_buffer_size
+        self.line_callback = line_callback
+        self.verbose = verbose
+        self.echo_errors = echo_errors
+        # (line number, line, time sent, bytes queued ahead of it) not yet acknowledged, oldest first
+        self.pending = deque()
+        self.buffered_bytes = 0
+        self.sent = 0
+        self.acknowledged = 0
+        # (line number, line, error response) for every line GRBL rejected
+        self.errors = []
+        self.alarms = []
+        self.start_time = None
+        self.last_ack_time = None
+        # True when the last status report said GRBL was busy, until it's been counted
+        self.busy = False
+        self.last_status_request = 0.0
+        self.lines = LineBuffer(ser)
+
+    # Read and handle one response line from GRBL. Returns False if no whole
+    # line arrived before the serial port timed out.
+    def read_response(self):
+        raw = self.lines.readline()
+        if raw is None:
+            return False
+        response = raw.decode('ascii', errors='ignore').strip()
+        if not response:
+            return True
+        if response == "ok" or response.startswith("error:"):
+            if not self.pending:
+                # Reply to something we didn't send, such as after a reset
+                print("Unexpected response:", response)
+                return True
+            number, line, sent_time, queued_bytes = self.pending.popleft()
+            self.buffered_bytes -= len(line) + 1
+            self.acknowledged += 1
+            self.last_ack_time = time.monotonic()
+            self.stats.record_response(number, sent_time, queued_bytes, response == "ok")
+            if response != "ok":
+                self.errors.append((number, line, response))
+                if self.echo_errors:
+                    print("GRBL", response, "for line", number, ":", line)
+            elif self.verbose:
+                print("ok:", line)
+        else:
+            if response.startswith("<"):
+                self.stats.note_status(response)
+                self.busy = response[1:].split("|")[0].split(":")[0] in BUSY_STATES
+            elif response.startswith("ALARM:"):
+                self.alarms.append(response)
+                print("GRBL", response)
+            if self.line_callback:
+                self.line_callback(response)
+            elif self.verbose:
+                print(": ", response)
+        return True
+
+    # Handle any responses that have already arrived without waiting for more
+    def poll(self):
+        while self.ser.in_waiting > 0:
+            self.read_response()
+
+    # True if a line would fit in GRBL's receive buffer right now
+    def has_room(self, line):
+        return self.buffered_bytes + len(clean_gcode_line(line)) + 1 <= self.rx_buffer_size
+
+    # Queue one line of GCODE. Blocks only while GRBL's receive buffer is too
+    # full to accept it. Returns False if the line was empty after cleaning.
+    # number is reported with any error, and defaults to a count of lines sent.
+    def send(self, line, timeout=30, number=None):
+        line = clean_gcode_line(line)
+        if not line:
+            return False
+        if len(line) + 1 > self.rx_buffer_size:
+            raise ValueError(f"GCODE line too long for GRBL receive buffer: {line}")
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        self.poll()
+        while self.buffered_bytes + len(line) + 1 > self.rx_buffer_size:
+            self.wait_for_ack(timeout)
+        sent_time = time.monotonic()
+        self.ser.write((line + "\n").encode('ascii'))
+        self.stats.record_send(len(line) + 1)
+        self.sent += 1
+        self.pending.append((self.sent if number is None else number, line, sent_time, self.buffered_bytes))
+        self.buffered_bytes += len(line) + 1
+        return True
+
+    # Read responses until GRBL acknowledges another line. A long move can keep
+    # it from answering for longer than timeout, so while the port is quiet we
+    # ask for status reports, and one saying GRBL is busy restarts the timeout.
+    # Raises TimeoutError if it goes timeout seconds without either.
+    def wait_for_ack(self, timeout=30):
+        acknowledged = self.acknowledged
+        deadline = time.monotonic() + timeout
+        while self.acknowledged == acknowledged:
+            if self.read_response():
+                if self.busy:
+                    self.busy = False
+                    deadline = time.monotonic() + timeout
+                continue
+            now = time.monotonic()
+            if now > deadline:
+                raise TimeoutError(f"GRBL stopped responding with {len(self.pending)} lines outstanding")
+            if now - self.last_status_request >= STREAM_STATUS_INTERVAL:
+                self.last_status_request = now
+                self.ser.write(b"?")
+
+    # Wait for every line sent so far to be acknowledged. timeout is how long
+    # GRBL may go without acknowledging a line or reporting that it's busy.
+    def wait_all(self, timeout=30):
+        while self.pending:
+            self.wait_for_ack(timeout)
+
+    # Stream an iterable of GCODE lines, then wait for them all to complete
+    def stream(self, lines, timeout=30):
+        for line in lines:
+            self.send(line, timeout)
+        self.wait_all(timeout)
+        return len(self.errors) == 0
+
+    # Acknowledged commands per second since streaming started
+    def commands_per_second(self):
+        if self.start_time is None or self.last_ack_time is None:
+            return 0.0
+        elapsed = self.last_ack_time - self.start_time
+        return self.acknowledged / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        return (f"{self.acknowledged}/{self.sent} commands acknowledged, "
+                f"{len(self.errors)} errors, {self.commands_per_second():.1f} commands/s")
+
+# Stream a list or file of GCODE lines to GRBL at full speed and report on it.
+# The port needs a read timeout so we can notice if GRBL goes quiet.
+def stream_GRBL_commands(ser, lines):
+    if ser.timeout is None:
+        ser.timeout = 1
+    streamer = GRBLStreamer(ser)
+    streamer.stream(lines)
+    print(streamer.report())
+    return streamer
@@ -2,6 +2,8 @@
 # Released under GPL3 or later by vik@diamondage.co.nz 2024
 
 import math
+import os
+import json
 
 # In the CNC world, the tip is often referred to as the Tool Control Point (TCP)
 # The "towers" are the driven axes. GRBL is driving AX BY CZ
@@ -13,6 +15,35 @@ lever_length = 35   # distance from hinge to pivot.
 arm_length = math.sqrt(lever_length**2+stage_height**2) # Distance from driven pivot to stage
 base_radius = 35    # mm (base radius, happens to be the same on OpenFlexure Delta)
 
+# Printed flexures never quite match the numbers above. dccalibrate.py fits them
+# to probe measurements and writes them here, and we pick them up on startup.
+GEOMETRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dcstage_geometry.json")
+GEOMETRY_NAMES = ("stage_radius", "stage_height", "lever_length", "base_radius")
+
+# Load calibrated stage geometry from a JSON parameter file, if there is one.
+# Any of the GEOMETRY_NAMES found in the file replace the defaults, and the arm
+# length is recalculated to suit. Returns True if a file was loaded.
+def load_geometry(filename=GEOMETRY_FILE):
+    global stage_radius, stage_height, lever_length, base_radius, arm_length
+    try:
+        with open(filename, 'r') as file:
+            params = json.load(file)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print("Ignoring unreadable stage geometry file", filename, ":", e)
+        return False
+
+    stage_radius = float(params.get("stage_radius", stage_radius))
+    stage_height = float(params.get("stage_height", stage_height))
+    lever_length = float(params.get("lever_length", lever_length))
+    base_radius = float(params.get("base_radius", base_radius))
+    arm_length = math.sqrt(lever_length**2+stage_height**2)
+    print("Loaded stage geometry from", filename)
+    return True
+
+load_geometry()
+
 
 # Calculate the points for each centre joint of the equilateral triangle of the
 # stage given a central xyz coordinate
@@ -0,0 +1,190 @@
+# dcstatus.py - Background GRBL status polling with a telemetry history
+# Released under GPL3 or later
+#
+# GRBL answers the "?" realtime byte with a status report such as
+#   <Run|MPos:1.000,2.000,0.500|Bf:15,128|FS:500,0|WCO:0.000,0.000,0.000>
+# Realtime bytes bypass the receive buffer, so polling doesn't get in the way
+# of commands being streamed. StatusPoller sends "?" at a fixed rate from a
+# background thread and keeps the parsed reports in a fixed size NumPy ring buffer.
+#
+# Whoever is reading the serial port hands status lines to poller.handle_line(),
+# for example by passing it as the line_callback of a dcserial.GRBLStreamer or
+# subscribing it to "status" lines on a dcasync.GRBLTransport. If nothing else is
+# reading the port, StatusPoller(ser, read_port=True) reads it itself.
+
+import threading
+import time
+import numpy as np
+
+# GRBL won't usefully report much faster than this
+MAX_POLL_RATE = 50.0
+
+# Machine states in the order they are stored in the telemetry buffer
+STATE_NAMES = ("Unknown", "Idle", "Run", "Hold", "Jog", "Alarm", "Door", "Check", "Home", "Sleep")
+
+# Columns of the telemetry buffer
+TELEMETRY_FIELDS = ("time", "state",
+                    "mpos_x", "mpos_y", "mpos_z",
+                    "wpos_x", "wpos_y", "wpos_z",
+                    "feed", "spindle", "planner_blocks", "rx_bytes")
+
+
+# Parse a GRBL 1.1 status report into a dictionary. Positions come back as
+# (x, y, z) tuples, and only the fields present in the report are included.
+# Returns None if the line isn't a status report.
+def parse_status_report(line):
+    line = line.strip()
+    if not (line.startswith("<") and line.endswith(">")):
+        return None
+    fields = line[1:-1].split("|")
+    # "Hold:0" and "Door:1" carry a sub-state we don't need
+    report = {"state": fields[0].split(":")[0]}
+    for field in fields[1:]:
+        name, _, value = field.partition(":")
+        try:
+            numbers = tuple(float(v) for v in value.split(","))
+        except ValueError:
+            continue
+        if name in ("MPos", "WPos", "WCO"):
+            report[name.lower()] = numbers
+        elif name == "Bf" and len(numbers) == 2:
+            report["planner_blocks"], report["rx_bytes"] = numbers
+        elif name == "FS" and len(numbers) == 2:
+            report["feed"], report["spindle"] = numbers
+        elif name == "F":
+            report["feed"] = numbers[0]
+    return report
+
+
+# A fixed size history of status reports. The oldest reports are overwritten once
+# it fills up, so memory use never grows.
+class TelemetryBuffer:
+    def __init__(self, size=4096):
+        self.size = size
+        self.data = np.full((size, len(TELEMETRY_FIELDS)), np.nan)
+        self.count = 0
+        self.lock = threading.Lock()
+        # GRBL only sends the work coordinate offset now and again, so remember it.
+        # None until GRBL has told us.
+        self.wco = None
+
+    # Add a parsed status report, filling in whichever of MPos or WPos GRBL left out.
+    # That needs the work coordinate offset, so until we have it, it's left as NaN.
+    def append(self, report, timestamp=None):
+        row = np.full(len(TELEMETRY_FIELDS), np.nan)
+        row[0] = time.monotonic() if timestamp is None else timestamp
+        state = report.get("state", "Unknown")
+        row[1] = STATE_NAMES.index(state) if state in STATE_NAMES else 0
+        if "wco" in report:
+            self.wco = report["wco"]
+        mpos = report.get("mpos")
+        wpos = report.get("wpos")
+        if self.wco is not None:
+            if mpos is not None and wpos is None:
+                wpos = tuple(m - o for m, o in zip(mpos, self.wco))
+            elif wpos is not None and mpos is None:
+                mpos = tuple(w + o for w, o in zip(wpos, self.wco))
+        if mpos is not None:
+            row[2:5] = mpos[:3]
+        if wpos is not None:
+            row[5:8] = wpos[:3]
+        for column, name in enumerate(TELEMETRY_FIELDS[8:], 8):
+            if name in report:
+                row[column] = report[name]
+        with self.lock:
+            self.data[self.count % self.size] = row
+            self.count += 1
+
+    # The most recent report as a dictionary, or None if there hasn't been one
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            row = self.data[(self.count - 1) % self.size].copy()
+        latest = dict(zip(TELEMETRY_FIELDS, row.tolist()))
+        latest["state"] = STATE_NAMES[int(row[1])]
+        return latest
+
+    # Up to the last n reports as an (n, len(TELEMETRY_FIELDS)) array, oldest first
+    def history(self, n=None):
+        with self.lock:
+            available = min(self.count, self.size)
+            n = available if n is None else min(n, available)
+            end = self.count % self.size
+            indices = (np.arange(end - n, end)) % self.size
+            return self.data[indices].copy()
+
+    # One column of the history by name, such as "mpos_z" or "planner_blocks"
+    def column(self, name, n=None):
+        return self.history(n)[:, TELEMETRY_FIELDS.index(name)]
+
+
+# Polls GRBL for status reports from a background thread
+class StatusPoller:
+    def __init__(self, ser, rate=10.0, history=4096, read_port=False):
+        self.ser = ser
+        self.interval = 1.0 / min(rate, MAX_POLL_RATE)
+        self.telemetry = TelemetryBuffer(history)
+        self.read_port = read_port
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.reports = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.threads = [threading.Thread(target=self._poll, daemon=True)]
+        if self.read_port:
+            self.threads.append(threading.Thread(target=self._read, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    # Feed a line from the serial port. Anything other than a status report is ignored.
+    def handle_line(self, line):
+        report = parse_status_report(line)
+        if report is not None:
+            self.telemetry.append(report)
+            self.reports += 1
+
+    def latest(self):
+        return self.telemetry.latest()
+
+    def history(self, n=None):
+        return self.telemetry.history(n)
+
+    # Send "?" on a fixed schedule. Waiting on the stop event rather than sleeping
+    # means stop() doesn't have to wait out the interval.
+    def _poll(self):
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                self.ser.write(b"?")
+            except Exception as e:
+                print("Status poll failed:", e)
+            next_time += self.interval
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                # We've fallen behind, don't try to catch up with a burst of polls
+                next_time = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+
+    # Read the port ourselves. A line cut short by the read timeout is kept
+    # until the rest of it arrives.
+    def _read(self):
+        if self.ser.timeout is None:
+            self.ser.timeout = 0.1
+        partial = b""
+        while not self.stop_event.is_set():
+            raw = self.ser.readline()
+            if not raw.endswith(b"\n"):
+                partial += raw
+                continue
+            self.handle_line((partial + raw).decode('ascii', errors='ignore'))
+            partial = b""
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# dcstream.py - Streams a GCODE job file to GRBL
+# Released under GPL3 or later
+#
+# Sends the output of dipify_gcode.py, png_to_gcode.py and friends to the machine
+# using the character counting streamer in dcserial, so the planner never runs dry.
+# The file is read a line at a time, so memory use doesn't depend on its size.
+#
+# While streaming it shows progress, the live command rate and an estimate of the
+# time remaining. Keys:
+#   space or p   Feed hold / resume
+#   q            Abort: feed hold, then reset GRBL
+# At the end it waits for GRBL to finish and summarises any errors.
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+import dcserial
+
+# Seconds between progress display updates
+DISPLAY_INTERVAL = 0.25
+# How quickly the displayed command rate follows changes, 0-1
+RATE_SMOOTHING = 0.2
+
+FEED_HOLD = b"!"
+CYCLE_START = b"~"
+SOFT_RESET = b"\x18"
+
+
+# Count the lines GRBL will actually be sent, without holding the file in memory.
+# Raises ValueError, giving the line number, for a line that can't be sent.
+def count_gcode_lines(file_path):
+    count = 0
+    with open(file_path, 'r') as file:
+        for number, line in enumerate(file, 1):
+            try:
+                if dcserial.clean_gcode_line(line):
+                    count += 1
+            except ValueError as e:
+                raise ValueError(f"Line {number}: {e}") from None
+    return count
+
+
+# Turn a number of seconds into h:mm:ss
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+# Reads single keypresses from the terminal without waiting for Enter.
+# Does nothing if stdin isn't a terminal, or we're not on a POSIX system.
+class KeyReader:
+    def __init__(self):
+        self.saved = None
+        try:
+            import termios
+            import tty
+            if sys.stdin.isatty():
+                self.saved = termios.tcgetattr(sys.stdin)
+                tty.setcbreak(sys.stdin.fileno())
+        except (ImportError, OSError):
+            self.saved = None
+
+    def get_key(self):
+        if self.saved is None:
+            return None
+        import select
+        ready, _, _ = select.select([sys.stdin], [], [], 0)
+        return sys.stdin.read(1) if ready else None
+
+    def close(self):
+        if self.saved is not None:
+            import termios
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+
+# Keeps track of how the job is going and draws the progress line
+class JobProgress:
+    def __init__(self, streamer, total):
+        self.streamer = streamer
+        self.total = total
+        self.start_time = time.monotonic()
+        self.last_display = 0
+        self.last_acknowledged = 0
+        self.rate = 0.0
+        self.paused = False
+        self.paused_time = 0.0
+        self.pause_start = None
+
+    def pause(self):
+        self.paused = True
+        self.pause_start = time.monotonic()
+
+    def resume(self):
+        self.paused = False
+        self.paused_time += time.monotonic() - self.pause_start
+
+    def elapsed(self):
+        now = time.monotonic()
+        paused = self.paused_time + (now - self.pause_start if self.paused else 0)
+        return now - self.start_time - paused
+
+    def update(self, force=False):
+        now = time.monotonic()
+        interval = now - self.last_display
+        if interval < DISPLAY_INTERVAL and not force:
+            return
+        done = self.streamer.acknowledged
+        if not self.paused and interval > 0 and self.last_display:
+            instant = (done - self.last_acknowledged) / interval
+            self.rate += RATE_SMOOTHING * (instant - self.rate)
+        self.last_display = now
+        self.last_acknowledged = done
+
+        status = f"\r{done}"
+        if self.total:
+            status += f"/{self.total} lines {100.0 * done / self.total:5.1f}%"
+        else:
+            status += " lines"
+        status += f"  {self.rate:6.1f} cmd/s  elapsed {format_duration(self.elapsed())}"
+        if self.total and self.rate > 0:
+            status += f"  ETA {format_duration((self.total - done) / self.rate)}"
+        if self.streamer.errors:
+            status += f"  errors {len(self.streamer.errors)}"
+        if self.paused:
+            status += "  [HOLD - space to resume]"
+        sys.stderr.write(status + "\033[K")
+        sys.stderr.flush()
+
+
+# Deal with any keypress. Returns False if the job should be aborted.
+def handle_keys(keys, ser, progress):
+    key = keys.get_key()
+    if key in (" ", "p", "P"):
+        if progress.paused:
+            ser.write(CYCLE_START)
+            progress.resume()
+        else:
+            ser.write(FEED_HOLD)
+            progress.pause()
+        progress.update(force=True)
+    elif key in ("q", "Q"):
+        return False
+    return True
+
+
+# Stop the machine. A feed hold first lets it decelerate so GRBL keeps its position.
+def abort_job(ser):
+    ser.write(FEED_HOLD)
+    time.sleep(0.5)
+    ser.write(SOFT_RESET)
+    sys.stderr.write("\nJob aborted, GRBL reset.\n")
+
+
+# Report a line that can't be sent, which stops the job
+def bad_line(number, error):
+    sys.stderr.write(f"\nLine {number}: {error}\n")
+    return False
+
+
+# Stream the lines of a file to GRBL, servicing the display and keyboard while we
+# wait for room in the receive buffer. Returns False if the job was aborted,
+# including for a line that can't be sent.
+def stream_file(ser, input_stream, streamer, progress, keys):
+    for number, line in enumerate(input_stream, 1):
+        try:
+            line = dcserial.clean_gcode_line(line)
+        except ValueError as e:
+            return bad_line(number, e)
+        if not line:
+            continue
+        while not streamer.has_room(line):
+            streamer.read_response()
+            if not handle_keys(keys, ser, progress):
+                return False
+            progress.update()
+        try:
+            streamer.send(line, number=number)
+        except ValueError as e:
+            return bad_line(number, e)
+        progress.update()
+
+    # Everything is sent, wait for the rest of the answers
+    while streamer.pending:
+        streamer.read_response()
+        if not handle_keys(keys, ser, progress):
+            return False
+        progress.update()
+    return True
+
+
+# Print what happened, grouping any errors by their code
+def summarise(streamer, progress, completed):
+    progress.update(force=True)
+    elapsed = progress.elapsed()
+    print(file=sys.stderr)
+    print(f"\n{'Completed' if completed else 'Stopped'}: {streamer.acknowledged} of {streamer.sent} lines "
+          f"acknowledged in {format_duration(elapsed)}", file=sys.stderr)
+    if elapsed > 0:
+        print(f"Average {streamer.acknowledged / elapsed:.1f} commands/s", file=sys.stderr)
+    if streamer.alarms:
+        print(f"Alarms: {', '.join(streamer.alarms)}", file=sys.stderr)
+    if not streamer.errors:
+        print("No errors", file=sys.stderr)
+        return
+    print(f"{len(streamer.errors)} errors:", file=sys.stderr)
+    for code, count in Counter(response for _, _, response in streamer.errors).most_common():
+        examples = [number for number, _, response in streamer.errors if response == code][:5]
+        print(f"  {code}: {count} (lines {', '.join(str(n) for n in examples)}"
+              f"{', ...' if count > len(examples) else ''})", file=sys.stderr)
+    number, line, response = streamer.errors[0]
+    print(f"First error at line {number}: {line}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stream a GCODE file to GRBL with progress, pause and resume"
+    )
+    parser.add_argument("input", help="GCODE file to stream (use '-' for stdin)")
+    parser.add_argument("--port", default="/dev/ttyACM0", help="Serial port for GRBL")
+    parser.add_argument("--baud", type=int, default=115200, help="Serial baud rate")
+    parser.add_argument("--scan-all", action="store_true",
+                        help="If GRBL isn't on --port, look on every serial port, not just ones on Arduino-like USB chips")
+    parser.add_argument("--unlock", action="store_true", help="Send $X before starting")
+    parser.add_argument("--stats", help="Write command latency statistics to this .json or .csv file")
+    args = parser.parse_args()
+
+    total = None
+    if args.input != "-":
+        if not os.path.exists(args.input):
+            sys.exit(f"File not found: {args.input}")
+        try:
+            total = count_gcode_lines(args.input)
+        except ValueError as e:
+            sys.exit(f"{args.input}: {e}")
+
+    ser = dcserial.initialize_with_retry(args.baud, args.port, args.scan_all)
+    dcserial.wait_for_data_pause(ser)
+    if args.unlock:
+        dcserial.send_GRBL_command_ok(ser, "$X\n")
+    # Short timeout so the display and keyboard keep going while GRBL is
+    # busy. Set last, as the handshake above leaves a 10s one behind.
+    ser.timeout = 0.1
+
+    streamer = dcserial.GRBLStreamer(ser, echo_errors=False)
+    streamer.stats.reset()
+    progress = JobProgress(streamer, total)
+    keys = KeyReader()
+    input_stream = sys.stdin if args.input == "-" else open(args.input, 'r')
+    completed = False
+    try:
+        completed = stream_file(ser, input_stream, streamer, progress, keys)
+        if not completed:
+            abort_job(ser)
+    except KeyboardInterrupt:
+        abort_job(ser)
+    finally:
+        keys.close()
+        if input_stream is not sys.stdin:
+            input_stream.close()
+    summarise(streamer, progress, completed)
+    print(streamer.stats.report(), file=sys.stderr)
+    if args.stats:
+        if args.stats.endswith(".csv"):
+            streamer.stats.dump_csv(args.stats)
+        else:
+            streamer.stats.dump_json(args.stats)
+    ser.close()
+    sys.exit(0 if completed and not streamer.errors else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,453 @@
 # deltacontrol.py - Prototyping control panel for driving a micro delta stage that uses GRBL
 # Released under GPL3 or later by vik@diamondage.co.nz 2024
 # Uses the free Zelle portable graphics library, which requires TkInter
-import time
-import math
+#
+# This is just the window. Driving the stage itself is done by the
+# DeltaController in dccore.py, which can also be run without a display.
 import numpy as np
 import os
+import queue
+import threading
+import tkinter
 import dcserial
+import dccore
 from graphics import *
-# This bit contains the stage configuration if you need to fiddle with that
-import dcstage
 
 # Nasty Global variables
 # ======================
 # Units by which manual controls on the panel move.
 step_size = 0.1
-# Actual start positions of the delta towers. Set im main loop.
-# In theory zero, but in practice may be small roundings or plain wrong
-tower_zero_offset=(0,0,0)
-# Initial axis positions
-# These are the numbers the user sees:
-x_position, y_position, z_position = 0, 0, 0
-# These are the "machine offsets" which hold position when the user redefines an axis to zero.
-x_mc_offset, y_mc_offset, z_mc_offset = 0, 0, 0
+# Tower feed rate for jogs, or None to use the slowest of GRBL's max rates ($110-$112)
+jog_feed = None
+# The stage: where the user thinks the TCP is, the machine offsets, and the serial port
+controller = dccore.DeltaController(jog_feed=jog_feed)
+
+# Jogging. The arrow and page keys jog using GRBL $J= commands, which can be
+# cancelled when the key is released rather than leaving a backlog of moves.
+# Keys that jog, and the axis and direction they move the TCP
+JOG_KEYS = {'Up': (1, 1), 'Down': (1, -1), 'Left': (0, -1), 'Right': (0, 1), 'Prior': (2, 1), 'Next': (2, -1)}
+# Key presses not yet sent to GRBL, as steps on each axis. Presses that arrive
+# while we're busy are added together into one jog.
+pending_jog = [0, 0, 0]
+# Keys currently held down
+held_keys = set()
+# Presses of each jog key since it was last really released. More than one
+# means it was held long enough to auto-repeat.
+key_presses = {}
+# Most steps on any axis in the last jog sent
+last_jog_steps = 0
+# X11 auto-repeat sends a release and press for every repeat, so we wait this
+# many ms before believing a key has really been released
+JOG_RELEASE_DELAY = 40
+# True while a jog is waiting for GRBL to accept it. Presses meanwhile pile up in pending_jog.
+jog_in_flight = False
+# The "please wait" window while homing, or None. Motion controls are ignored while it's up.
+busy_window = None
+
+# Where Tk can't watch a pipe for us, check for finished serial jobs this often (ms)
+WORKER_POLL_INTERVAL = 20
+# When it has nothing else to do, the worker asks GRBL where it is this often (s).
+# It slows down to STATUS_MAX_INTERVAL while nothing is moving.
+STATUS_INTERVAL = 0.1
+STATUS_MAX_INTERVAL = 1.0
+
+# The trace panel below the controls. The XY trail is drawn in one box and the
+# Z history in the other, as (left, top, right, bottom).
+TRACE_XY_BOX = (10, 300, 210, 500)
+TRACE_Z_BOX = (230, 300, 590, 500)
+# Most points kept in the trace. When it fills up, the older half is thinned out.
+TRACE_POINTS = 400
+# Reported moves smaller than this aren't added to the trace
+TRACE_MIN_MOVE = 0.0005
+# Smallest span shown in the trace boxes, so a still probe isn't zoomed in on noise
+TRACE_MIN_SPAN = 0.01
 
 # Open the default port. Put there so it's all in one place.
 def open_port():
-    return dcserial.initialize_with_retry(115200,'/dev/ttyACM1')
-
-# Move the TCP to these coordinates using GRBL to move the stage towers
-def grbl_move_to(location):
-  x, y, z = location
-  # Format GRBL G0 command
-  GRBL_command = f"G0 X{x:.5f} Y{y:.5f} Z{z:.5f}\n"
-  dcserial.send_GRBL_command_ok(ser,GRBL_command)
-  
-# Move the TCP to (x,y,z) by calculating the new tower positions, and then calling the
-# grbl_move_to function to set them.
-# Note: [xyz]_mc_offset contains the offsets applied from initial zero when user
-# sets an axis position as zero such as when levelling.
-def tcp_move_to(pos):
-  # Combine the user coordinates with machine coordinates
-  # Note: Y is inverted in this hardware, so we flip it.
-  offset_xyz=(x_mc_offset+pos[0],y_mc_offset-pos[1],z_mc_offset+pos[2])
-  tower_new_position=dcstage.calculate_joint_positions(offset_xyz)
-  # Subtract the zero offset from each axis. This should not do anything.
-  # However, I have misconfigured things before and it has saved my bacon.
-  shifted_tower_position=(tower_new_position[0]-tower_zero_offset[0], tower_new_position[1]-tower_zero_offset[1], tower_new_position[2]-tower_zero_offset[2])
-  # Now we move the GRBL axes to put the TCP in the right place
-  grbl_move_to(shifted_tower_position)
+    return dcserial.initialize_with_retry(dccore.DEFAULT_BAUD, dccore.DEFAULT_PORT)
+
+# As open_port, when GRBL has already been looked for: just the default port or the port picker
+def pick_port():
+    return dcserial.initialize_with_retry(dccore.DEFAULT_BAUD, dccore.DEFAULT_PORT, search=False)
+
+# Show where the controller thinks the TCP is
+def show_position():
+  draw_axis_location(win, *controller.position)
+
+# Runs serial port jobs one at a time in a background thread, so the window never
+# waits for GRBL. A job is a function to call in the worker thread, plus an optional
+# on_done(result) to call back in the Tk thread when it has finished. The worker
+# wakes Tk up by writing to a pipe Tk is watching, so nothing polls while idle.
+# Tk can't watch pipes on Windows, so there we check every WORKER_POLL_INTERVAL ms.
+#
+# idle_job, if given, is called in the worker whenever there have been no jobs
+# for a while, and on_idle(result) in the Tk thread with what it returns. If it
+# returns None nothing is passed on, and the worker waits longer next time.
+class SerialWorker:
+  def __init__(self, win, idle_job=None, on_idle=None):
+    self.win = win
+    self.idle_job = idle_job
+    self.on_idle = on_idle
+    self.idle_interval = STATUS_INTERVAL
+    self.jobs = queue.Queue()
+    self.finished = queue.Queue()
+    # Jobs submitted whose on_done hasn't been called yet. Only touched by Tk.
+    self.outstanding = 0
+    self.wake_read, self.wake_write = os.pipe()
+    try:
+      win.tk.createfilehandler(self.wake_read, tkinter.READABLE, self._on_wake)
+      self.polling = False
+    except (AttributeError, tkinter.TclError):
+      self.polling = True
+      win.after(WORKER_POLL_INTERVAL, self._poll)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def submit(self, job, on_done=None):
+    self.outstanding += 1
+    self.jobs.put((job, on_done))
+
+  def idle(self):
+    return self.outstanding == 0
+
+  # Throw away jobs that haven't started. Their on_done is called with None.
+  def cancel_pending(self):
+    while True:
+      try:
+        job, on_done = self.jobs.get_nowait()
+      except queue.Empty:
+        break
+      self.outstanding -= 1
+      if on_done:
+        on_done(None)
+
+  # Finish the job in hand and stop. A job stuck waiting on GRBL is abandoned
+  # after timeout seconds; the thread is a daemon so it won't hold up exit.
+  def stop(self, timeout=2):
+    self.cancel_pending()
+    self.jobs.put((None, None))
+    self.thread.join(timeout)
+    if not self.polling:
+      self.win.tk.deletefilehandler(self.wake_read)
+    os.close(self.wake_read)
+    os.close(self.wake_write)
+
+  def _run(self):
+    while True:
+      try:
+        job, on_done = self.jobs.get(timeout=self.idle_interval if self.idle_job else None)
+      except queue.Empty:
+        self._run_idle_job()
+        continue
+      if job is None:
+        break
+      self.idle_interval = STATUS_INTERVAL
+      try:
+        result = job()
+      except Exception as e:
+        print("Serial job failed:", e)
+        result = None
+      self.finished.put((on_done, result, True))
+      os.write(self.wake_write, b"!")
+
+  def _run_idle_job(self):
+    try:
+      result = self.idle_job()
+    except Exception:
+      # Most likely the port is being reopened. Try again later.
+      result = None
+    if result is None:
+      self.idle_interval = min(self.idle_interval * 2, STATUS_MAX_INTERVAL)
+      return
+    self.idle_interval = STATUS_INTERVAL
+    self.finished.put((self.on_idle, result, False))
+    os.write(self.wake_write, b"!")
+
+  # Call on_done for every finished job, in the Tk thread
+  def _deliver(self):
+    while True:
+      try:
+        on_done, result, submitted = self.finished.get_nowait()
+      except queue.Empty:
+        break
+      if submitted:
+        self.outstanding -= 1
+      if on_done:
+        on_done(result)
+
+  def _on_wake(self, fd, mask):
+    os.read(fd, 512)
+    self._deliver()
+
+  def _poll(self):
+    self._deliver()
+    if not self.win.isClosed():
+      self.win.after(WORKER_POLL_INTERVAL, self._poll)
+
+# Send all the jog presses since the last jog as one jog to where they add up to.
+# Only one jog is handed to the worker at a time, so presses while GRBL is busy
+# are merged rather than queued up behind each other.
+def send_pending_jog():
+  global jog_in_flight, last_jog_steps
+  if jog_in_flight or not any(pending_jog):
+    return
+  last_jog_steps = max(abs(j) for j in pending_jog)
+  target = [p + j * step_size for p, j in zip(controller.position, pending_jog)]
+  pending_jog[:] = [0, 0, 0]
+  jog_in_flight = True
+  worker.submit(lambda: controller.jog_to(target), jog_sent)
+  draw_axis_location(win, *target)
+
+def jog_sent(response):
+  global jog_in_flight
+  jog_in_flight = False
+  send_pending_jog()
+
+# Add a press of a jog key or button to the pending jog
+def add_jog(key):
+  if busy_window is not None:
+    return
+  axis, direction = JOG_KEYS[key]
+  pending_jog[axis] += direction
+  send_pending_jog()
+
+# Called by Tk for every key press. Jog keys are counted up to be sent as one jog.
+def on_key_press(event):
+  if event.keysym in JOG_KEYS:
+    held_keys.add(event.keysym)
+    key_presses[event.keysym] = key_presses.get(event.keysym, 0) + 1
+    add_jog(event.keysym)
+  elif event.keysym == 'Home':
+    go_home()
+  elif event.keysym == 'q':
+    quit_panel()
+
+# Called by Tk for every key release. If it's still released after auto-repeat
+# has had a chance to press it again, and it was held down or the jog has
+# several steps to go, stop the jog where it is. A single tap is left to
+# finish its step.
+def on_jog_key_release(event):
+  if event.keysym in JOG_KEYS:
+    held_keys.discard(event.keysym)
+    win.after(JOG_RELEASE_DELAY, lambda: check_jog_released(event.keysym))
+
+def check_jog_released(keysym):
+  if keysym in held_keys or win.isClosed():
+    return
+  if key_presses.pop(keysym, 0) <= 1 and last_jog_steps <= 1:
+    return
+  # Anything still waiting to be sent is for a key that is no longer held.
+  # The cancel is a realtime byte, so it goes straight out rather than waiting its turn.
+  pending_jog[:] = [0, 0, 0]
+  controller.cancel_jog()
+  worker.submit(controller.update_position, jog_cancelled)
+
+# Called in the Tk thread with each new position the worker has found
+def on_status(status):
+  state, towers = status
+  if trace.append(controller.tcp_from_towers(towers)):
+    draw_trace(win, state)
+
+# The history of where the TCP has been. Once full, every other point of the
+# older half is dropped, so recent moves are kept in detail, older ones more
+# coarsely, and there are never more than size points to draw.
+class TraceBuffer:
+  def __init__(self, size=TRACE_POINTS):
+    self.size = size
+    self.points = np.empty((size, 3))
+    self.count = 0
+
+  # Add a point unless it's too close to the last one, or the kinematics couldn't
+  # reach it. Returns True if it was added.
+  def append(self, point):
+    point = np.asarray(point, dtype=float)
+    if not np.all(np.isfinite(point)):
+      return False
+    if self.count and np.max(np.abs(self.points[self.count - 1] - point)) < TRACE_MIN_MOVE:
+      return False
+    if self.count == self.size:
+      half = self.size // 2
+      kept = self.points[0:half:2].copy()
+      recent = self.points[half:].copy()
+      self.points[:len(kept)] = kept
+      self.points[len(kept):len(kept) + len(recent)] = recent
+      self.count = len(kept) + len(recent)
+    self.points[self.count] = point
+    self.count += 1
+    return True
+
+  def history(self):
+    return self.points[:self.count]
+
+trace = TraceBuffer()
+
+# Map values onto screen coordinates from low to high, centred on the values and
+# using the given scale. Returns a numpy array.
+def to_panel(values, centre, scale, middle, flip=False):
+  offset = (values - centre) * scale
+  return middle - offset if flip else middle + offset
+
+# Tk lines need at least two points
+def line_coords(xs, ys):
+  if len(xs) == 1:
+    xs, ys = np.repeat(xs, 2), np.repeat(ys, 2)
+  return np.column_stack((xs, ys)).ravel().tolist()
+
+# Draw the outlines and create the canvas items the trace is drawn with. They are
+# moved about by draw_trace rather than being recreated.
+def create_trace_panel(win):
+  global trace_items
+  for left, top, right, bottom in (TRACE_XY_BOX, TRACE_Z_BOX):
+    Rectangle(Point(left, top), Point(right, bottom)).draw(win)
+  xy_label = Text(Point(TRACE_XY_BOX[0] + 50, TRACE_XY_BOX[3] - 10), "XY trail")
+  z_label = Text(Point(TRACE_Z_BOX[0] + 50, TRACE_Z_BOX[3] - 10), "Z history")
+  for label in (xy_label, z_label):
+    label.setSize(8)
+    label.draw(win)
+  trace_items = {
+    'trail': win.create_line(0, 0, 0, 0, fill="blue"),
+    'marker': win.create_oval(0, 0, 0, 0, outline="red", width=2),
+    'z': win.create_line(0, 0, 0, 0, fill="darkgreen"),
+    'xy_label': xy_label,
+    'z_label': z_label,
+  }
+
+# Move the trace items to show the history. The cost depends on TRACE_POINTS, not
+# how long we've been running.
+def draw_trace(win, state):
+  points = trace.history()
+  if len(points) == 0:
+    return
+  with win.batch():
+    # XY trail, the same scale on both axes with Y up
+    left, top, right, bottom = TRACE_XY_BOX
+    low, high = points[:, :2].min(axis=0), points[:, :2].max(axis=0)
+    span = max(np.max(high - low), TRACE_MIN_SPAN) * 1.1
+    scale = (min(right - left, bottom - top) - 20) / span
+    centre = (low + high) / 2
+    xs = to_panel(points[:, 0], centre[0], scale, (left + right) / 2)
+    ys = to_panel(points[:, 1], centre[1], scale, (top + bottom) / 2, flip=True)
+    win.coords(trace_items['trail'], *line_coords(xs, ys))
+    win.coords(trace_items['marker'], xs[-1] - 4, ys[-1] - 4, xs[-1] + 4, ys[-1] + 4)
+    trace_items['xy_label'].setText(f"XY {span:.3f} across")
+
+    # Z against sample number, oldest on the left
+    left, top, right, bottom = TRACE_Z_BOX
+    z = points[:, 2]
+    z_span = max(z.max() - z.min(), TRACE_MIN_SPAN) * 1.1
+    zs = to_panel(z, (z.max() + z.min()) / 2, (bottom - top - 20) / z_span, (top + bottom) / 2, flip=True)
+    xs = left + 5 + np.arange(len(z)) * (right - left - 10) / max(trace.size - 1, 1)
+    win.coords(trace_items['z'], *line_coords(xs, zs))
+    trace_items['z_label'].setText(f"Z {z[-1]:+.4f}  {state}")
+
+def jog_cancelled(position):
+  if position is not None:
+    show_position()
+
+# Move the XY axes to zero first, then the Z
+def go_home():
+  if busy_window is not None:
+    return
+  pending_jog[:] = [0, 0, 0]
+  print("Move to zero")
+  worker.submit(controller.go_home)
+  draw_axis_location(win, 0, 0, 0)
+
+def start_rehome():
+  global busy_window
+  if busy_window is not None:
+    return
+  pending_jog[:] = [0, 0, 0]
+  busy_window = GraphWin("Message", 300, 100)
+  message_text = Text(Point(150, 50), "Homing in progress. Please wait.")
+  message_text.draw(busy_window)
+  worker.submit(controller.rehome, rehome_done)
+
+def rehome_done(result):
+  global busy_window
+  if busy_window is not None:
+    busy_window.close()
+    busy_window = None
+
+# Stop whatever is going on. A soft reset stops GRBL at once, even part way
+# through homing, then closing and opening the port resets the Arduino as well.
+def stop_machine():
+  pending_jog[:] = [0, 0, 0]
+  worker.cancel_pending()
+  controller.soft_reset()
+  print("Stopping serial port");
+  worker.submit(find_port_again, reopen_port)
+
+# Close the port and look for GRBL again, which can take seconds, so it's done
+# by the worker. The Arduino may come back on a different port.
+def find_port_again():
+  controller.close()
+  return dcserial.find_grbl(dccore.DEFAULT_BAUD, dccore.DEFAULT_PORT)
+
+# Called in the Tk thread with the port the worker found. If it didn't find
+# GRBL, the user may have to pick the port, and that has to be done here.
+def reopen_port(ser):
+  if ser is not None:
+    controller.connect(open_port=lambda: ser)
+  else:
+    controller.connect(open_port=pick_port)
+
+def quit_panel():
+  win.quit()
+
+# Called by the window for every mouse click.
+# Some buttons emulate a keypress so we can keep code all in one place
+def on_click(click_point):
+  global step_size
+  for key, button in (('Up', up_button), ('Down', down_button), ('Left', left_button),
+                      ('Right', right_button), ('Prior', pageup_button), ('Next', pagedown_button)):
+    if is_clicked(click_point, button):
+      # A click on a jog button counts as a single key press
+      add_jog(key)
+      return
+  # These bits set the size of the steps we move the XY or Z axes in
+  if is_clicked(click_point, button_05):
+    step_size=0.5
+  elif is_clicked(click_point, button_01):
+    step_size=0.1
+  elif is_clicked(click_point, button_001):
+    step_size=0.01
+  elif is_clicked(click_point, button_0001):
+    step_size=0.001
+  elif is_clicked(click_point,home_button):
+    go_home()
+    return
+  elif is_clicked(click_point, xy0_button):
+    # Set the current point to X=0 Y=0 by adjusting the machine offset, ignore Z
+    controller.zero_axes("xy")
+  elif is_clicked(click_point, z0_button):
+    # Set the current point to Z=0 by adjusting the machine offset, ignore XY
+    controller.zero_axes("z")
+  elif is_clicked(click_point, unlock_button):
+    if busy_window is None:
+      worker.submit(controller.unlock)
+    return
+  elif is_clicked(click_point, rehome_button):
+    start_rehome()
+    return
+  elif is_clicked(click_point, stop_button):
+    stop_machine()
+    return
+  elif is_clicked(click_point, quit_button):
+    quit_panel()
+    return
+  else:
+    return
+  show_position()
 
 
 def draw_axis_location(win, x, y, z):
-    # Clear previous axis location text
+    axis_location_text = f"Step: {step_size:.4f}    X: {x:.4f}, Y: {y:.4f}, Z: {z:.4f}"
+    # Change the existing text rather than drawing it again
     if hasattr(win, 'axis_text'):
-        win.axis_text.undraw()
+        win.axis_text.setText(axis_location_text)
+        return
     # Draw current axis location text
-    axis_location_text = f"Step: {step_size:.4f}    X: {x:.4f}, Y: {y:.4f}, Z: {z:.4f}"
     win.axis_text = Text(Point(win.getWidth() - 180, 20),axis_location_text)
     win.axis_text.draw(win)
 
@@ -151,27 +543,19 @@ def print_gcode_lines(file_path):
 
 # Expects to use global variables
 # step_size - size of a movement control step
-# tower_zero_offset - Position of tower bases at actual (0,0,0)
+# controller - the stage, see dccore.py
 if __name__ == "__main__":
 
     # Initialize serial port
-    ser = open_port();
+    controller.connect(open_port=open_port)
     # Display incoming characters
     print("Starting...")
-    dcserial.wait_for_data_pause(ser)
-
-    # Issue GRBL G92 command to set the current work axes to (0,0,0)
-    # This assumes the machine *was* zeroed, which is an iffy thing to do.
-    dcserial.send_GRBL_command(ser,"G92 X0 Y0 Z0\n")
-
-    # Find out where the virtual towers are when the TCP is at (0,0,0)
-    # This is subtraced from any positioning so movement is relative to (0,0,0)
-    tower_zero_offset=dcstage.calculate_joint_positions((0,0,0))
-    print("Tower zero offset: ",tower_zero_offset)
+    # Set the current work axes to (0,0,0) and find the tower zero offset
+    controller.start()
 
 
     # Initialize window
-    win = GraphWin("Probe Control V0.01", 600, 300)
+    win = GraphWin("Probe Control V0.01", 600, 510)
     
    
     # Draw control buttons
@@ -283,134 +667,23 @@ if __name__ == "__main__":
  
 
     # Draw initial axis location
-    draw_axis_location(win, x_position, y_position, z_position)
-    # Main loop for handling user input
-    # Some buttons emulate a keypress so we can keep code all in one place
-    while True:
-        key = ""
-        x_last=x_position
-        y_last=y_position
-        z_last=z_position
-        # Status update can be forced
-        update_status=False
-        click_point = win.checkMouse()
-        if click_point:
-            if is_clicked(click_point, up_button):
-                key = 'Up'
-            elif is_clicked(click_point, down_button):
-                key = 'Down'
-            elif is_clicked(click_point, left_button):
-                key = 'Left'
-            elif is_clicked(click_point, right_button):
-                key = 'Right'
-            elif is_clicked(click_point, pageup_button):
-                key = 'Prior'
-            elif is_clicked(click_point, pagedown_button):
-                key = 'Next'
-            # These bits set the size of the steps we move the XY or Z axes in
-            if is_clicked(click_point, button_05):
-                step_size=0.5
-                update_status=True
-            if is_clicked(click_point, button_01):
-                step_size=0.1
-                update_status=True
-            elif is_clicked(click_point, button_001):
-                step_size=0.01
-                update_status=True
-            elif is_clicked(click_point, button_0001):
-                step_size=0.001
-                update_status=True
-            elif is_clicked(click_point,home_button):
-                key = 'Home'
-            elif is_clicked(click_point, xy0_button):
-                # Set the current point to X=0 Y=0 by adjusting the machine offset, ignore Z
-                x_mc_offset+=x_position
-                y_mc_offset+=y_position
-                update_status=True
-                last_x=last_y=x_position=y_position=0
-            elif is_clicked(click_point, z0_button):
-                # Set the current point to Z=0 by adjusting the machine offset, ignore XY
-                z_mc_offset+=z_position
-                update_status=True
-                last_z=z_position=0
-            elif is_clicked(click_point, unlock_button):
-                # Unlock the CNC driver from fault state. DANGER DANGER!
-                # Because we don't know what will happen, we just wait for data to
-                # cease being sent to us by GRBL rather than look for "ok"
-                dcserial.send_GRBL_command(ser,"$X\n")
-                # Set current position as workplace zero coordinates.
-                dcserial.send_GRBL_command_ok(ser,"G92 X0 Y0 Z0\n")
-                # Display the machine position and error state on text window
-                # Because we don't know what will happen, we just wait for data to
-                # cease being sent to us by GRBL rather than look for "ok"
-                dcserial.send_GRBL_command(ser,"?\n")
-            elif is_clicked(click_point, rehome_button):
-                # Seek and rehome the CNC driver, move up a bit, and set zero
-                message_win = GraphWin("Message", 300, 100)
-                message_text = Text(Point(150, 50), "Homing in progress. Please wait.")
-                message_text.draw(message_win)
-                # Update the window to finish drawing because we'll be busy...
-                message_win.update()
-                # Issue GRBL home axes command and wait for the OK
-                dcserial.send_GRBL_command_ok(ser,"$H\n")
-                # Set current position as workplace zero coordinates
-                # before we move up for elbow room.
-                dcserial.send_GRBL_command_ok(ser,"G92 X0 Y0 Z0\n")
-                # Move up a bit on the Z axis to give arms room to manoeuvre
-                dcserial.send_GRBL_command_ok(ser,"G0 X2 Y2 Z2\n")
-                # Set current position as workplace zero coordinates.
-                dcserial.send_GRBL_command_ok(ser,"G92 X0 Y0 Z0\n")
-                message_win.close()
-                ## Display on the console what the CNC thinks it is doing
-                dcserial.send_GRBL_command(ser,"?\n")
-            elif is_clicked(click_point, stop_button):
-                # Close the serial port and open it. This resets the Arduino
-                ser.close()
-                print("Stopping serial port");
-                ser=open_port()
-            elif is_clicked(click_point, quit_button):
-               break
-
-        # Handling keyboard events
-        if key == "":
-          key = win.checkKey()
-        if key:
-            if key == 'Up':
-                y_position += step_size
-            elif key == 'Down':
-                y_position -= step_size
-            elif key == 'Left':
-                x_position -= step_size
-            elif key == 'Right':
-                x_position += step_size
-            elif key == 'Prior':
-                z_position += step_size
-            elif key == 'Next':
-                z_position -= step_size
-            elif key == 'Home':
-                # Home the XY axes first, then the Z
-                # Set xyz so no further movement is made.
-                x_position=y_position=0
-                print("Move XY to zero")
-                tcp_move_to((x_position, y_position, z_position))
-                z_position=0
-                print("Move Z  to zero")
-                tcp_move_to((x_position, y_position, z_position))
-                last_x=last_y=Last_z=0
-                update_status=True
-            # Finally, check for "Q" to quit
-            elif key == "q":
-                break
-
-        # If an axis moved, reposition the TCP
-        if x_last != x_position or y_last != y_position or z_last != z_position:
-            # Figure out the new XYZ for the tower positions
-            tcp_move_to((x_position, y_position, z_position))
-            update_status=True
-
-        if update_status:
-            draw_axis_location(win, x_position, y_position, z_position)
-
+    draw_axis_location(win, *controller.position)
+    create_trace_panel(win)
+
+    # Closing the window quits the same way as the Quit button
+    win.master.protocol("WM_DELETE_WINDOW", quit_panel)
+    # Jog keys are tracked as they are pressed and released
+    win.bind_all("<KeyPress>", on_key_press, add="+")
+    win.bind_all("<KeyRelease>", on_jog_key_release, add="+")
+    win.setMouseHandler(on_click)
+    # All serial traffic from here on goes through the worker thread, which
+    # keeps an eye on where the machine is when it isn't busy
+    worker = SerialWorker(win, controller.status_changed, on_status)
+
+    # Everything happens in the Tk event handlers above. Tk sleeps until there is
+    # a click, a key, or a serial job finishing.
+    win.mainloop()
 
     # Close window
+    worker.stop()
     win.close()
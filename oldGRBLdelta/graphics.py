@@ -62,6 +62,15 @@ http://mcsp.wartburg.edu/zelle/python for a quick reference"""
 
 __version__ = "5.0"
 
+# Local changes for deltacontrol
+#     * Added GraphWin.batch() for drawing lots of things without a Tk
+#       update after each one. plot and plotPixel calls inside a batch
+#       are queued and sent to Tk as one script, before any other item
+#       is created so the stacking order is kept.
+#     * Added Image.fromArray, Image.setArray and Image.toArray to move
+#       whole NumPy images in and out of Tk at once. Needs NumPy, but
+#       only if they are used.
+
 # Version 5 8/26/2016
 #     * update at bottom to fix MacOS issue causing askopenfile() to hang
 #     * update takes an optional parameter specifying update rate
@@ -179,6 +188,9 @@ OBJ_ALREADY_DRAWN = "Object currently drawn"
 UNSUPPORTED_METHOD = "Object doesn't support operation"
 BAD_OPTION = "Illegal option value"
 
+# Most plot commands queued in a batch before they are sent to Tk
+BATCH_QUEUE_LIMIT = 10000
+
 ##########################################################################
 # global variables and funtions
 
@@ -231,6 +243,11 @@ class GraphWin(tk.Canvas):
         self.closed = False
         master.lift()
         self.lastKey = ""
+        self._batchDepth = 0
+        self._batchAutoflush = autoflush
+        self._batchQueue = []
+        self._frameInterval = None
+        self._lastFrame = 0
         if autoflush: _root.update()
 
     def __repr__(self):
@@ -269,6 +286,7 @@ class GraphWin(tk.Canvas):
 
         if self.closed: return
         self.closed = True
+        self._batchQueue = []
         self.master.destroy()
         self.__autoflush()
 
@@ -290,6 +308,9 @@ class GraphWin(tk.Canvas):
         """Set pixel (x,y) to the given color"""
         self.__checkOpen()
         xs,ys = self.toScreen(x,y)
+        if self._batchDepth:
+            self._queuePixel(xs, ys, color)
+            return
         self.create_line(xs,ys,xs+1,ys, fill=color)
         self.__autoflush()
         
@@ -297,14 +318,71 @@ class GraphWin(tk.Canvas):
         """Set pixel raw (independent of window coordinates) pixel
         (x,y) to color"""
         self.__checkOpen()
+        if self._batchDepth:
+            self._queuePixel(x, y, color)
+            return
         self.create_line(x,y,x+1,y, fill=color)
         self.__autoflush()
       
     def flush(self):
         """Update drawing to the window"""
         self.__checkOpen()
+        self._sendBatch()
         self.update_idletasks()
-        
+
+    def batch(self, rate=None):
+        """Return a context manager for drawing lots of things at once.
+        Inside a "with win.batch():" block the window isn't updated
+        after every change, and plot and plotPixel calls are queued
+        and sent to Tk together, before anything else is drawn, so
+        items still stack in the order they were drawn. Everything
+        appears when the block ends, or at most rate times a second
+        if rate is given. Batches may be nested; only the outermost
+        one updates the window."""
+        return _Batch(self, rate)
+
+    def _beginBatch(self, rate):
+        if self._batchDepth == 0:
+            self._batchAutoflush = self.autoflush
+            self.autoflush = False
+            self._frameInterval = 1.0/rate if rate else None
+            self._lastFrame = time.time()
+        self._batchDepth += 1
+
+    def _endBatch(self):
+        self._batchDepth -= 1
+        if self._batchDepth: return
+        self.autoflush = self._batchAutoflush
+        self._frameInterval = None
+        if self.closed: return
+        self._sendBatch()
+        if self.autoflush:
+            _root.update()
+
+    def _queuePixel(self, x, y, color):
+        # Same as create_line(x,y,x+1,y, fill=color), as Tcl
+        self._batchQueue.append("{} create line {} {} {} {} -fill {{{}}}".format(
+            self._w, x, y, x+1, y, color))
+        if len(self._batchQueue) >= BATCH_QUEUE_LIMIT:
+            self._sendBatch()
+        if self._frameInterval:
+            now = time.time()
+            if now - self._lastFrame >= self._frameInterval:
+                self._sendBatch()
+                _root.update()
+                self._lastFrame = now
+
+    def _sendBatch(self):
+        if self._batchQueue:
+            self.tk.eval("\n".join(self._batchQueue))
+            self._batchQueue = []
+
+    def _create(self, itemType, args, kw):
+        # Every create_* call comes through here. Queued plots are sent
+        # first so they stay below anything drawn after them.
+        self._sendBatch()
+        return tk.Canvas._create(self, itemType, args, kw)
+
     def getMouse(self):
         """Wait for mouse click and return Point object representing
         the click"""
@@ -399,6 +477,23 @@ class GraphWin(tk.Canvas):
         self.update()
         
                       
+class _Batch:
+
+    """Internal context manager returned by GraphWin.batch"""
+
+    def __init__(self, win, rate):
+        self.win = win
+        self.rate = rate
+
+    def __enter__(self):
+        self.win._beginBatch(self.rate)
+        return self.win
+
+    def __exit__(self, *exc):
+        self.win._endBatch()
+        return False
+
+                      
 class Transform:
 
     """Internal class for 2-D coordinate transformations"""
@@ -943,6 +1038,42 @@ class Image(GraphicsObject):
         
         """
         self.img.put("{" + color +"}", (x, y))
+
+    @classmethod
+    def fromArray(cls, p, array):
+        """Returns a new Image anchored at p holding a NumPy array,
+        either height x width greyscale or height x width x 3 RGB.
+        Values are clipped to range(256)."""
+        image = cls(p, 0, 0)
+        image.setArray(array)
+        return image
+
+    def setArray(self, array):
+        """Replaces the whole image with a NumPy array, as for fromArray.
+        The image takes on the size of the array. Much faster than
+        calling setPixel for every pixel."""
+        self.img.configure(width=0, height=0)
+        self.img.configure(data=_toPNM(array), format="PPM")
+
+    def toArray(self):
+        """Returns the whole image as a height x width x 3 NumPy array of
+        uint8 RGB values. Much faster than calling getPixel for every
+        pixel."""
+        import numpy as np
+        width, height = self.getWidth(), self.getHeight()
+        try:
+            data = self.img.tk.call(self.img.name, "data", "-format", "ppm")
+            if isinstance(data, str):
+                data = data.encode("latin-1")
+            return _fromPNM(data)
+        except (tk.TclError, ValueError):
+            # Older Tk can't write PPM to a string, so read the list of
+            # "#rrggbb" rows instead
+            rows = self.img.tk.splitlist(self.img.tk.call(self.img.name, "data"))
+            text = " ".join(row if isinstance(row, str) else " ".join(map(str, row))
+                            for row in rows)
+            pixels = bytes.fromhex(text.replace("#", "").replace(" ", ""))
+            return np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 3).copy()
         
 
     def save(self, filename):
@@ -956,6 +1087,50 @@ class Image(GraphicsObject):
         self.img.write( filename, format=ext)
 
         
+def _toPNM(array):
+    # Internal: a NumPy image as binary PGM (greyscale) or PPM (RGB) data
+    import numpy as np
+    array = np.asarray(array)
+    if array.dtype != np.uint8:
+        array = np.clip(array, 0, 255).astype(np.uint8)
+    if array.ndim == 2:
+        magic = b"P5"
+    elif array.ndim == 3 and array.shape[2] == 3:
+        magic = b"P6"
+    else:
+        raise GraphicsError("Image arrays must be height x width or height x width x 3")
+    height, width = array.shape[:2]
+    header = magic + " {} {} 255\n".format(width, height).encode("ascii")
+    return header + np.ascontiguousarray(array).tobytes()
+
+def _fromPNM(data):
+    # Internal: binary PGM or PPM data as a height x width x 3 NumPy array
+    import numpy as np
+    fields = []
+    position = 0
+    # Magic, width, height and maximum value, separated by whitespace
+    while len(fields) < 4:
+        while data[position:position+1].isspace():
+            position += 1
+        if data[position:position+1] == b"#":
+            position = data.index(b"\n", position)
+            continue
+        end = position
+        while not data[end:end+1].isspace():
+            end += 1
+        fields.append(data[position:end])
+        position = end
+    position += 1   # A single whitespace character ends the header
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic not in (b"P5", b"P6") or maxval != 255:
+        raise ValueError("Not 8 bit binary PGM or PPM data")
+    channels = 3 if magic == b"P6" else 1
+    pixels = np.frombuffer(data, dtype=np.uint8, count=width*height*channels, offset=position)
+    pixels = pixels.reshape(height, width, channels)
+    if channels == 1:
+        pixels = np.repeat(pixels, 3, axis=2)
+    return pixels.copy()
+
 def color_rgb(r,g,b):
     """r,g,b are intensities of red, green, and blue in range(256)
     Returns color specifier string for the resulting color"""
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# graphics_benchmark.py - Times drawing lots of pixels with graphics.py
+# Released under GPL3 or later
+#
+# Plots the same random points with GraphWin.plot twice: once the normal way,
+# where every point is followed by a full Tk update, and once inside
+# win.batch(), where the points are queued and the window is updated once at
+# the end. Needs a display.
+#
+# Plotting one at a time gets slower as the canvas fills up, so that run stops
+# after --max-seconds and the rate it managed is reported instead.
+#
+# Then fills and reads back an Image a pixel at a time with setPixel/getPixel,
+# and all at once with setArray/toArray.
+
+import argparse
+import random
+import time
+import numpy as np
+from graphics import GraphWin, Image, Point, color_rgb, update
+
+
+# Some random points and colours, the same for both runs
+def make_points(count, size, seed=1):
+    rng = random.Random(seed)
+    return [(rng.randrange(size), rng.randrange(size),
+             color_rgb(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+            for _ in range(count)]
+
+
+# Plot points one at a time with autoflush on. Returns (points plotted, seconds).
+def plot_unbatched(points, size, max_seconds):
+    win = GraphWin("Unbatched", size, size)
+    start = time.perf_counter()
+    plotted = 0
+    for x, y, color in points:
+        win.plot(x, y, color)
+        plotted += 1
+        if plotted % 1000 == 0 and time.perf_counter() - start > max_seconds:
+            break
+    update()
+    elapsed = time.perf_counter() - start
+    win.close()
+    return plotted, elapsed
+
+
+# Plot all the points inside a batch. Returns (points plotted, seconds).
+def plot_batched(points, size, rate):
+    win = GraphWin("Batched", size, size)
+    start = time.perf_counter()
+    with win.batch(rate):
+        for x, y, color in points:
+            win.plot(x, y, color)
+    update()
+    elapsed = time.perf_counter() - start
+    win.close()
+    return len(points), elapsed
+
+
+# Fill an image with setPixel then read it back with getPixel.
+# Returns (seconds to write, seconds to read, whether it read back correctly).
+def image_per_pixel(pixels):
+    height, width = pixels.shape[:2]
+    image = Image(Point(0, 0), width, height)
+    start = time.perf_counter()
+    for y in range(height):
+        for x in range(width):
+            image.setPixel(x, y, color_rgb(*(int(v) for v in pixels[y, x])))
+    written = time.perf_counter()
+    back = [[image.getPixel(x, y) for x in range(width)] for y in range(height)]
+    read = time.perf_counter()
+    return written - start, read - written, np.array_equal(np.array(back), pixels)
+
+
+# The same with setArray and toArray
+def image_bulk(pixels):
+    height, width = pixels.shape[:2]
+    image = Image(Point(0, 0), width, height)
+    start = time.perf_counter()
+    image.setArray(pixels)
+    written = time.perf_counter()
+    back = image.toArray()
+    read = time.perf_counter()
+    return written - start, read - written, np.array_equal(back, pixels)
+
+
+def report(name, plotted, elapsed, unit="points"):
+    print(f"{name:>13}: {plotted:7d} {unit} in {elapsed:8.3f}s  {plotted / elapsed:10.0f} {unit}/s")
+
+
+def benchmark_images(size):
+    pixels = np.random.default_rng(1).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    count = size * size
+    slow = image_per_pixel(pixels)
+    fast = image_bulk(pixels)
+    for name, (write, read, ok) in (("per pixel", slow), ("bulk", fast)):
+        report(name + " set", count, write, "pixels")
+        report(name + " get", count, read, "pixels")
+        if not ok:
+            print(f"{name}: image read back differently!")
+    print(f"setArray is {slow[0] / fast[0]:.0f} times faster, toArray {slow[1] / fast[1]:.0f} times faster")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time plotting points with and without GraphWin.batch(), and bulk Image pixel access")
+    parser.add_argument("--points", type=int, default=100000, help="Number of points to plot")
+    parser.add_argument("--size", type=int, default=600, help="Window width and height in pixels")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Frame rate to redraw at while batching (default: only at the end)")
+    parser.add_argument("--max-seconds", type=float, default=60,
+                        help="Give up on the unbatched run after this long")
+    parser.add_argument("--batched-only", action="store_true", help="Skip the unbatched run")
+    parser.add_argument("--image-size", type=int, default=256,
+                        help="Width and height of the image for the pixel access test, 0 to skip it")
+    parser.add_argument("--images-only", action="store_true", help="Only run the pixel access test")
+    args = parser.parse_args()
+
+    if args.image_size:
+        benchmark_images(args.image_size)
+    if args.images_only:
+        return
+    points = make_points(args.points, args.size)
+    batched = plot_batched(points, args.size, args.rate)
+    report("batched", *batched)
+    if args.batched_only:
+        return
+    unbatched = plot_unbatched(points, args.size, args.max_seconds)
+    report("unbatched", *unbatched)
+    if unbatched[0] < args.points:
+        print(f"Unbatched run stopped after {args.max_seconds:g}s, "
+              f"{unbatched[0]} of {args.points} points")
+    speedup = (batched[0] / batched[1]) / (unbatched[0] / unbatched[1])
+    print(f"Batching is {speedup:.0f} times faster")
+
+
+if __name__ == "__main__":
+    main()
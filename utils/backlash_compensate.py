@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# backlash_compensate.py - Revision 0.01
+#
+# Takes up backlash in a GCODE job, such as dipify_gcode.py, png_to_gcode.py or
+# grid_gcode.py output, using the backlash measured with backlash_vernier.py:
+# - The direction each axis last moved in is followed through the file.
+# - When an axis reverses, the slack is taken up: either by a short G0 move
+#   of just that axis inserted before the move (--mode insert, the default),
+#   so the move itself goes where it should from the start, or by adding it
+#   to the move (--mode fold), which adds no lines but means the start of the
+#   move is spent taking up the slack.
+# - Either way, every position after that on the axis is written out shifted
+#   by the slack taken up, until it reverses back.
+#
+# The backlash for each axis is given in microns (--x, --y, --z), or as the
+# line number that aligned on the vernier pattern (--vernier x=3).
+#
+# Lines are read and written in batches, and each different line is only
+# taken apart once, so lines that don't need changing cost little more than
+# copying them.
+#
+# G0/G1 moves are compensated, in G90 or G91, and G92 is shifted to match.
+# Arcs have their end points shifted but reversals within them aren't taken
+# up. G10/G28/G30/G53/G38.x leave the position and direction of the axes they
+# name unknown, or of every axis if they name none (G28 on its own goes home),
+# so the next move on them takes nothing up.
+#
+# Units: 1 mm in GCODE = 1 micron in machine space.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import itertools
+import sys
+import time
+
+from backlash_vernier import backlash_from_line
+from heightmap_compensate import MOTION_WORDS, OTHER_AXIS_WORDS, split_comment
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+BATCH_LINES = 200000     # Lines read and written at a time
+CACHE_LINES = 100000     # Most different lines remembered between batches
+
+AXES = "XYZ"
+
+# ---------------------------------------------------------------------
+# Compensation
+# ---------------------------------------------------------------------
+
+
+class BacklashCompensator:
+    """
+    Follows the modal state and the direction of each axis through the file.
+
+    position is where each axis has been told to go, as written in the file
+    (None until known), direction the way it last moved (+1, -1, or 0 if not
+    known) and shift how much it has been moved by to take up slack, which is
+    added to every position written out for it.
+    """
+
+    def __init__(self, backlash, mode="insert"):
+        self.backlash = list(backlash)
+        self.insert = mode == "insert"
+        # Axis letters to follow, and their index
+        self.compensated = {a: i for i, a in enumerate(AXES) if self.backlash[i]}
+        self.position = [None, None, None]
+        self.direction = [0, 0, 0]
+        self.shift = [0.0, 0.0, 0.0]
+        self.absolute = True
+        self.motion = "G0"
+        self.stats = {"lines": 0, "moves": 0, "rewritten": 0, "inserted": 0,
+                      "reversals": [0, 0, 0], "arcs": 0}
+        # What parse made of each line. Jobs repeat the same moves over
+        # and over, so most lines are only taken apart once.
+        self.cache = {}
+
+    def process(self, lines):
+        """Returns the compensated lines of a batch."""
+        cache = self.cache
+        if len(cache) > CACHE_LINES:
+            cache.clear()
+        out = []
+        append = out.append
+        for line in lines:
+            parsed = cache.get(line)
+            if parsed is None:
+                parsed = cache[line] = self.parse(line)
+            if parsed and (parsed[2] or parsed[3]):
+                append(self.compensate(line, parsed))
+                continue
+            if parsed:
+                # Nothing to take up, but the modal state still has to be followed
+                motion, mode = parsed[:2]
+                if mode:
+                    self.absolute = mode == "G90"
+                if motion:
+                    self.motion = motion
+            append(line)
+        self.stats["lines"] += len(lines)
+        return out
+
+    def parse(self, line):
+        """
+        Take a line apart. Returns an empty tuple for lines that can be passed
+        straight through, or (motion word, G90/G91, other G word that takes
+        axis words, axes, words, comment with the line ending, whether it has
+        any axis words), where axes are (axis, value, word index) for the axes
+        with backlash to take up.
+        """
+        code, comment = split_comment(line)
+        words = code.upper().split()
+        motion = mode = special = None
+        axes = []
+        named = False
+        compensated = self.compensated
+        for k, word in enumerate(words):
+            letter = word[0]
+            if letter == "G":
+                if word in MOTION_WORDS:
+                    motion = MOTION_WORDS[word]
+                elif word in ("G90", "G91"):
+                    mode = word
+                elif word == "G92" or word in OTHER_AXIS_WORDS:
+                    special = word
+            elif letter in AXES:
+                named = True
+                if letter in compensated:
+                    try:
+                        axes.append((compensated[letter], float(word[1:]), k))
+                    except ValueError:
+                        return ()
+        if not (motion or mode or axes or special):
+            return ()
+        comment = comment.rstrip("\r\n")
+        comment = (" " + comment if comment else "") + "\n"
+        return (motion, mode, special, tuple(axes), words, comment, named)
+
+    def compensate(self, line, parsed):
+        """The line, or what replaces it, for a line with axes to follow."""
+        motion, mode, special, axes, words, comment, named = parsed
+        if mode:
+            self.absolute = mode == "G90"
+        if motion:
+            self.motion = motion
+        position, direction, shift = self.position, self.direction, self.shift
+
+        if special == "G92":
+            # G92 makes the current position read as the given values. The
+            # machine is shift away from where the file thinks it is, so
+            # keep it that way.
+            for i, v, slot in axes:
+                position[i] = v
+            return self.rewrite(line, axes, words, comment, shift)
+        if special:
+            # Moves we can't follow: forget where the axes are and which way
+            # they went. G28 or G30 with no axis words sends them all home.
+            # These lines aren't shifted, so afterwards GRBL and the file
+            # agree on where the axes are, as at the start of the file.
+            for i in [i for i, v, slot in axes] if named else range(3):
+                position[i] = None
+                direction[i] = 0
+                shift[i] = 0.0
+            return line
+
+        self.stats["moves"] += 1
+        absolute = self.absolute
+        arc = self.motion in ("G2", "G3")
+        start = list(position)
+        takeup = None
+        for i, v, slot in axes:
+            if absolute:
+                delta = None if start[i] is None else v - start[i]
+                position[i] = v
+            else:
+                delta = v
+                position[i] = None if start[i] is None else start[i] + v
+            if not delta or arc:
+                continue
+            way = 1 if delta > 0 else -1
+            if direction[i] == -way:
+                if takeup is None:
+                    takeup = [0.0, 0.0, 0.0]
+                takeup[i] = way * self.backlash[i]
+                shift[i] += takeup[i]
+                self.stats["reversals"][i] += 1
+            direction[i] = way
+        if arc:
+            self.stats["arcs"] += 1
+
+        if takeup is None:
+            return self.rewrite(line, axes, words, comment, shift) if absolute else line
+        if not self.insert:
+            return self.rewrite(line, axes, words, comment, shift if absolute else takeup)
+
+        # Take up the slack on the spot, then make the move as it was. Its
+        # motion word goes in again if it relied on the modal one, as the
+        # G0 has replaced that.
+        self.stats["inserted"] += 1
+        if absolute:
+            steps = (f"{AXES[i]}{start[i] + shift[i]:.3f}" for i in range(3) if takeup[i])
+        else:
+            steps = (f"{AXES[i]}{takeup[i]:.3f}" for i in range(3) if takeup[i])
+        main = self.rewrite(line, axes, words, comment, shift if absolute else None,
+                            None if motion else self.motion)
+        return f"G0 {' '.join(steps)} ; Backlash take-up\n{main}"
+
+    def rewrite(self, line, axes, words, comment, add, motion=None):
+        """
+        The line with add[i] added to each axis word, and the motion word put
+        in front if given. The line itself if that changes nothing.
+        """
+        changed = [(i, v, slot) for i, v, slot in axes if add[i]] if add else ()
+        if not changed and motion is None:
+            return line
+        self.stats["rewritten"] += 1
+        words = list(words)
+        for i, v, slot in changed:
+            words[slot] = f"{AXES[i]}{v + add[i]:.3f}"
+        if motion:
+            words.insert(1 if words[0].startswith("N") else 0, motion)
+        return " ".join(words) + comment
+
+
+def compensate(input_stream, output_stream, compensator, batch_lines=BATCH_LINES):
+    while True:
+        lines = list(itertools.islice(input_stream, batch_lines))
+        if not lines:
+            break
+        output_stream.writelines(compensator.process(lines))
+
+
+def parse_vernier(text, parser):
+    """Read axis=line from --vernier."""
+    axis, _, index = text.partition("=")
+    if axis.upper() not in AXES or not index:
+        parser.error(f"--vernier wants axis=line, such as x=3, not {text}")
+    try:
+        return AXES.index(axis.upper()), backlash_from_line(float(index))
+    except ValueError:
+        parser.error(f"--vernier wants axis=line, such as x=3, not {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Take up backlash when an axis reverses in a GCODE file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", nargs="?", default="-", help="Input GCODE file (use '-' for stdin)")
+    parser.add_argument("-o", "--output", default="-", help="Output GCODE file (use '-' for stdout)")
+    parser.add_argument("--x", type=float, default=0.0, help="X backlash (microns)")
+    parser.add_argument("--y", type=float, default=0.0, help="Y backlash (microns)")
+    parser.add_argument("--z", type=float, default=0.0, help="Z backlash (microns)")
+    parser.add_argument("--vernier", action="append", default=[], metavar="AXIS=LINE",
+                        help="Backlash from the pair of lines that aligned on the backlash_vernier.py "
+                             "pattern, counting the pair at the origin as 0. May be repeated")
+    parser.add_argument("--mode", choices=("insert", "fold"), default="insert",
+                        help="Take up slack with a move of its own, or as part of the next move")
+    parser.add_argument("--batch", type=int, default=BATCH_LINES, help="Lines processed at a time")
+    args = parser.parse_args()
+
+    backlash = [args.x, args.y, args.z]
+    for text in args.vernier:
+        i, amount = parse_vernier(text, parser)
+        backlash[i] = amount
+    if not any(backlash):
+        parser.error("no backlash given: use --x/--y/--z or --vernier")
+    compensator = BacklashCompensator(backlash, args.mode)
+
+    start = time.perf_counter()
+    input_stream = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        output_stream.write("; Backlash compensated by backlash_compensate.py: "
+                            + " ".join(f"{a}{b:g}" for a, b in zip(AXES, backlash) if b)
+                            + f" ({args.mode})\n")
+        compensate(input_stream, output_stream, compensator, max(1, args.batch))
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    elapsed = time.perf_counter() - start
+
+    stats = compensator.stats
+    reversals = ", ".join(f"{a} {n}" for a, n, b in zip(AXES, stats["reversals"], backlash) if b)
+    print(f"{stats['lines']} lines in, {stats['lines'] + stats['inserted']} out: {stats['moves']} moves, "
+          f"{stats['rewritten']} rewritten, {stats['inserted']} take-up moves added", file=sys.stderr)
+    print(f"Reversals taken up: {reversals}", file=sys.stderr)
+    if stats["arcs"]:
+        print(f"{stats['arcs']} arc moves shifted, but reversals within them not taken up", file=sys.stderr)
+    if elapsed > 0:
+        print(f"{elapsed:.2f}s, {stats['lines'] / elapsed:.0f} lines/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
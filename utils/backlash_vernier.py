@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# backlash_vernier.py - Revision 0.01
+# backlash_vernier.py - Revision 0.02
 #
 # Generates GCODE for visual backlash estimation using a vernier-style pattern.
 #
@@ -9,6 +9,9 @@
 #
 # The pair of lines that visually align indicates backlash magnitude.
 #
+# The pattern is built and written by pattern_engine.py, so it moves the
+# probe the same way as the other calibration patterns.
+#
 # Units: 1 mm in GCODE = 1 micron in machine space.
 #
 # Copyright (C) 2026 Vik Olliver
@@ -19,6 +22,8 @@
 import sys
 import argparse
 
+from pattern_engine import PatternWriter, vernier
+
 # ---------------------------------------------------------------------
 # Configuration
 # ---------------------------------------------------------------------
@@ -43,75 +48,25 @@ Y_BOTTOM = -210  # separation between patterns
 
 # ---------------------------------------------------------------------
 
-def move_safe(output):
-    output.write(f"G1 Z{SAFE_Z:.3f} F{FAST_Z:.3f}\n")
-
-
-def move_to(x, y, output):
-    output.write(f"G0 X{x:.3f} Y{y:.3f} F{FAST_XY:.3f}\n")
-
-
-def lower_probe(output):
-    output.write(
-        f"G1 Z{(DRAW_Z+2):.3f} F{FAST_Z:.3f}\n"
-        f"G1 Z{DRAW_Z:.3f} F{SLOW_Z:.3f}\n"
-    )
-
-
-def raise_probe(output):
-    output.write(
-        f"G1 Z{(DRAW_Z+2):.3f} F{SLOW_Z:.3f}\n"
-        f"G1 Z{SAFE_Z:.3f} F{FAST_Z:.3f}\n"
-    )
-
-
-def draw_vertical_line(x, y_start, y_end, direction, output):
+def backlash_from_line(index):
     """
-    direction: "up" or "down"
+    Backlash given by the pair of lines that align, counting the pair at the
+    origin as 0. Both sets start together, the top set is approached from
+    the far side and the bottom set from the near side, and the gap between
+    pair i grows by OFFSET - DELTA each line. A fraction can be given for
+    alignment between two pairs.
     """
+    OFFSET = (NUM_LINES - 1) * DELTA / 2
+    return index * (OFFSET - DELTA)
 
-    move_to(x, y_start, output)
-    lower_probe(output)
-
-    if direction == "up":
-        output.write(f"G1 Y{y_end:.3f} F{SLOW_XY:.3f}\n")
-    else:
-        output.write(f"G1 Y{y_start:.3f} F{SLOW_XY:.3f}\n")
-
-    raise_probe(output)
-
-
-# ---------------------------------------------------------------------
 
 def generate_pattern(output, axis="x"):
-    move_safe(output)
-    move_to(0, 0, output)
-
-    OFFSET = (NUM_LINES - 1) * DELTA / 2
-
-    def draw_line(pos, start, end):
-        if axis == "x":
-            draw_vertical_line(pos, start, end, "up", output)
-        else:
-            # rotate 90°: swap X/Y roles
-            move_to(start, pos, output)
-            lower_probe(output)
-            output.write(f"G1 X{end:.3f} F{SLOW_XY:.3f}\n")
-            raise_probe(output)
-
-    # -----------------------------
-    # Top pattern (reverse direction)
-    # -----------------------------
-    for i in reversed(range(NUM_LINES)):
-        pos = i * BASE_SPACING + i * DELTA
-        draw_line(pos, Y_TOP, Y_TOP + LINE_LENGTH)
-
-    # -----------------------------
-    # Bottom pattern (forward direction)
-    # -----------------------------
-    for i in range(NUM_LINES):
-        pos = i * (BASE_SPACING + OFFSET)
-        draw_line(pos, Y_BOTTOM, Y_BOTTOM + LINE_LENGTH)
+    # Top pattern (reverse direction), then bottom pattern (forward
+    # direction), drawn in that order as given
+    pattern = vernier(NUM_LINES, BASE_SPACING, DELTA, LINE_LENGTH, Y_TOP, Y_BOTTOM, axis)
+    writer = PatternWriter(output, safe_z=SAFE_Z, draw_z=DRAW_Z, fast_xy=FAST_XY,
+                           slow_xy=SLOW_XY, fast_z=FAST_Z, slow_z=SLOW_Z)
+    writer.write(pattern)
 
 
 # ---------------------------------------------------------------------
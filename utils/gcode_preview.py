@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+# gcode_preview.py - Revision 0.01
+#
+# Previews a GCODE job - dots, drawn lines and travel moves - before it is
+# streamed to the machine. Built for dipify_gcode.py output with millions of
+# dots, where drawing one canvas item per dot is hopeless.
+#
+# The job is parsed into NumPy arrays once. The view is rasterised into a single
+# RGB image, handed to one Tk PhotoImage as PPM data, and is only redrawn when
+# the view is panned, zoomed or resized:
+# - Zoomed out, the image is sampled from a pyramid of dot counts and line
+#   coverage built at load time, halving the resolution at each level. The
+#   cost depends on the window size, not the size of the job.
+# - Zoomed in past the finest pyramid level, only the dots and lines in view
+#   are rasterised from the job itself.
+#
+# A dot is where the probe goes down and comes back up without moving in XY.
+# XY moves made while the probe is down are drawn lines, anything else is travel.
+#
+# Mouse: drag to pan, wheel to zoom. Keys: f fits the job to the window,
+# t shows or hides travel moves, q quits.
+# --save writes the fitted view to a PPM file instead of opening a window.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import math
+import sys
+import time
+import numpy as np
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+PYRAMID_SIZE = 2048      # Cells along the longer side of the finest pyramid level
+PYRAMID_MIN = 32         # Stop halving once a level is this small
+SAMPLE_BATCH = 4000000   # Most line samples rasterised at once, to bound memory
+ZOOM_STEP = 1.25         # Zoom factor per mouse wheel click
+
+BACKGROUND = (255, 255, 255)
+TRAVEL_COLOUR = (190, 215, 240)
+DRAW_COLOUR = (30, 60, 160)
+DOT_LIGHT = np.array((235, 80, 80))     # A single dot
+DOT_DARK = np.array((140, 0, 0))        # The most dots in one pixel
+
+
+# ---------------------------------------------------------------------
+# Parsing
+# ---------------------------------------------------------------------
+
+class Toolpath:
+    """
+    The dots and XY segments of a job as NumPy arrays. dots is (N,2) and
+    draw and travel are (M,4) arrays of x0,y0,x1,y1.
+    """
+
+    def __init__(self, dots, draw, travel):
+        self.dots = np.asarray(dots, dtype=float).reshape(-1, 2)
+        self.draw = np.asarray(draw, dtype=float).reshape(-1, 4)
+        self.travel = np.asarray(travel, dtype=float).reshape(-1, 4)
+
+    def bounds(self):
+        """(xmin, ymin, xmax, ymax) of everything in the job."""
+        xs = [self.dots[:, 0], self.draw[:, 0], self.draw[:, 2], self.travel[:, 0], self.travel[:, 2]]
+        ys = [self.dots[:, 1], self.draw[:, 1], self.draw[:, 3], self.travel[:, 1], self.travel[:, 3]]
+        xs = np.concatenate(xs)
+        ys = np.concatenate(ys)
+        if len(xs) == 0:
+            return (-1.0, -1.0, 1.0, 1.0)
+        return (xs.min(), ys.min(), xs.max(), ys.max())
+
+
+def parse_toolpath(stream):
+    """
+    Follow the G0/G1 moves in a GCODE stream (with G90/G91 and G92) and sort
+    them into dots, drawn lines and travel moves.
+    """
+    x = y = z = 0.0
+    offset = [0.0, 0.0, 0.0]
+    absolute = True
+    down = False     # Last Z move was downwards
+    drew = False     # Moved in XY since the probe went down
+    dots, draw, travel = [], [], []
+
+    for line in stream:
+        line = line.split(";", 1)[0]
+        if "(" in line:
+            line = line.split("(", 1)[0]
+        words = line.upper().split()
+        if not words:
+            continue
+        motion = False
+        set_offset = False
+        target = {}
+        for word in words:
+            letter = word[0]
+            if letter == "G":
+                code = word[1:]
+                if code in ("0", "00", "1", "01"):
+                    motion = True
+                elif code == "90":
+                    absolute = True
+                elif code == "91":
+                    absolute = False
+                elif code == "92":
+                    set_offset = True
+            elif letter in "XYZ":
+                try:
+                    target[letter] = float(word[1:])
+                except ValueError:
+                    pass
+        if set_offset:
+            # G92 makes the current position read as the given values
+            for axis, current in zip("XYZ", (x, y, z)):
+                if axis in target:
+                    offset["XYZ".index(axis)] = current - target[axis]
+            continue
+        if not (motion or target):
+            continue
+
+        if absolute:
+            nx = target["X"] + offset[0] if "X" in target else x
+            ny = target["Y"] + offset[1] if "Y" in target else y
+            nz = target["Z"] + offset[2] if "Z" in target else z
+        else:
+            nx = x + target.get("X", 0.0)
+            ny = y + target.get("Y", 0.0)
+            nz = z + target.get("Z", 0.0)
+
+        if nx != x or ny != y:
+            if down and nz == z:
+                draw.append((x, y, nx, ny))
+                drew = True
+            else:
+                travel.append((x, y, nx, ny))
+        if nz < z:
+            down = True
+            drew = nx != x or ny != y
+        elif nz > z:
+            if down and not drew:
+                dots.append((x, y))
+            down = False
+        x, y, z = nx, ny, nz
+
+    if down and not drew:
+        dots.append((x, y))
+    return Toolpath(dots, draw, travel)
+
+
+# ---------------------------------------------------------------------
+# Rasterising
+# ---------------------------------------------------------------------
+
+def clip_segments(segments, xmin, ymin, xmax, ymax):
+    """
+    Liang-Barsky clip of an (M,4) array of segments to a rectangle, all at
+    once. Returns the parts of the segments that are inside.
+    """
+    x0, y0, x1, y1 = segments.T
+    dx = x1 - x0
+    dy = y1 - y0
+    t0 = np.zeros(len(segments))
+    t1 = np.ones(len(segments))
+    keep = np.ones(len(segments), dtype=bool)
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        parallel = p == 0
+        keep &= ~(parallel & (q < 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = np.where(parallel, 0.0, q / np.where(parallel, 1.0, p))
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    keep &= t0 <= t1
+    t0, t1 = t0[keep], t1[keep]
+    x0, y0, dx, dy = x0[keep], y0[keep], dx[keep], dy[keep]
+    return np.column_stack((x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy))
+
+
+def rasterise_points(px, py, width, height):
+    """Count the points falling in each cell of a width x height grid."""
+    ix = np.floor(px).astype(np.int64)
+    iy = np.floor(py).astype(np.int64)
+    inside = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+    counts = np.bincount(iy[inside] * width + ix[inside], minlength=width * height)
+    return counts.reshape(height, width)
+
+
+def rasterise_segments(segments, width, height):
+    """
+    Mark the cells of a width x height grid that segments (already in cell
+    units) pass through, by sampling each segment at least twice per cell.
+    Done in batches so long moves can't use up all the memory.
+    """
+    covered = np.zeros((height, width), dtype=bool)
+    if len(segments) == 0:
+        return covered
+    segments = clip_segments(segments, 0, 0, width - 1e-9, height - 1e-9)
+    lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    samples = np.ceil(lengths * 2).astype(np.int64) + 1
+    totals = np.cumsum(samples)
+    start = 0
+    while start < len(segments):
+        limit = (totals[start - 1] if start else 0) + SAMPLE_BATCH
+        end = max(start + 1, int(np.searchsorted(totals, limit, side="right")))
+        batch = segments[start:end]
+        n = samples[start:end]
+        # t runs from 0 to 1 along each segment in n steps
+        owner = np.repeat(np.arange(len(batch)), n)
+        first = np.repeat(np.cumsum(n) - n, n)
+        t = (np.arange(len(owner)) - first) / np.maximum(n[owner] - 1, 1)
+        px = batch[owner, 0] + t * (batch[owner, 2] - batch[owner, 0])
+        py = batch[owner, 1] + t * (batch[owner, 3] - batch[owner, 1])
+        covered |= rasterise_points(px, py, width, height) > 0
+        start = end
+    return covered
+
+
+def halve(grid, combine):
+    """Halve the resolution of a grid, combining each 2x2 block with np.add or np.logical_or."""
+    height, width = grid.shape
+    if height % 2 or width % 2:
+        padded = np.zeros((height + height % 2, width + width % 2), dtype=grid.dtype)
+        padded[:height, :width] = grid
+        grid = padded
+    return combine.reduce(combine.reduce(
+        grid.reshape(grid.shape[0] // 2, 2, grid.shape[1] // 2, 2), axis=3), axis=1)
+
+
+class Pyramid:
+    """
+    Dot counts and line coverage of the whole job at PYRAMID_SIZE cells along
+    its longer side, and at half that resolution, and half again...
+    levels[n] is a (dots, draw, travel) tuple of grids with cells 2**n times
+    the size of cell_size.
+    """
+
+    def __init__(self, toolpath, size=PYRAMID_SIZE):
+        xmin, ymin, xmax, ymax = toolpath.bounds()
+        span = max(xmax - xmin, ymax - ymin, 1e-9)
+        self.cell_size = span / size
+        self.x0, self.y0 = xmin, ymin
+        width = max(1, int(math.ceil((xmax - xmin) / self.cell_size)) + 1)
+        height = max(1, int(math.ceil((ymax - ymin) / self.cell_size)) + 1)
+
+        def cells(a):
+            # Columns alternate x and y
+            origin = np.tile((self.x0, self.y0), a.shape[1] // 2)
+            return (a - origin) / self.cell_size
+
+        dots = rasterise_points(*cells(toolpath.dots).T, width, height)
+        draw = rasterise_segments(cells(toolpath.draw), width, height)
+        travel = rasterise_segments(cells(toolpath.travel), width, height)
+        self.levels = [(dots, draw, travel)]
+        while max(dots.shape) > PYRAMID_MIN:
+            dots = halve(dots, np.add)
+            draw = halve(draw, np.logical_or)
+            travel = halve(travel, np.logical_or)
+            self.levels.append((dots, draw, travel))
+
+    def sample(self, level, xs, ys):
+        """
+        The (dots, draw, travel) grids of a level sampled at world coordinates
+        xs (columns) and ys (rows). Outside the job is empty.
+        """
+        size = self.cell_size * 2 ** level
+        grids = self.levels[level]
+        height, width = grids[0].shape
+        cols = np.floor((xs - self.x0) / size).astype(np.int64)
+        rows = np.floor((ys - self.y0) / size).astype(np.int64)
+        col_ok = (cols >= 0) & (cols < width)
+        row_ok = (rows >= 0) & (rows < height)
+        index = np.ix_(np.clip(rows, 0, height - 1), np.clip(cols, 0, width - 1))
+        inside = np.outer(row_ok, col_ok)
+        return tuple(np.where(inside, grid[index], 0) for grid in grids)
+
+
+class View:
+    """What part of the job is on screen: centre in job units and pixels per unit."""
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.cx = self.cy = 0.0
+        self.scale = 1.0
+
+    def fit(self, bounds, margin=0.05):
+        xmin, ymin, xmax, ymax = bounds
+        self.cx, self.cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+        span_x = max(xmax - xmin, 1e-9) * (1 + 2 * margin)
+        span_y = max(ymax - ymin, 1e-9) * (1 + 2 * margin)
+        self.scale = min(self.width / span_x, self.height / span_y)
+
+    def to_world(self, px, py):
+        return (self.cx + (px - self.width / 2) / self.scale,
+                self.cy - (py - self.height / 2) / self.scale)
+
+    def zoom(self, factor, px, py):
+        """Zoom by factor keeping the job under pixel (px, py) where it is."""
+        wx, wy = self.to_world(px, py)
+        self.scale *= factor
+        self.cx = wx - (px - self.width / 2) / self.scale
+        self.cy = wy + (py - self.height / 2) / self.scale
+
+
+def in_view(segments, left, bottom, right, top):
+    """The segments whose bounding boxes overlap the view, so only they get clipped."""
+    x0, y0, x1, y1 = segments.T
+    keep = ((np.maximum(x0, x1) >= left) & (np.minimum(x0, x1) <= right) &
+            (np.maximum(y0, y1) >= bottom) & (np.minimum(y0, y1) <= top))
+    return segments[keep]
+
+
+# Colours by index: background, travel, draw, then DOT_SHADES shades of dot
+DOT_SHADES = 64
+PALETTE = np.vstack((BACKGROUND, TRAVEL_COLOUR, DRAW_COLOUR,
+                     DOT_LIGHT + np.linspace(0, 1, DOT_SHADES)[:, np.newaxis] * (DOT_DARK - DOT_LIGHT)
+                     )).astype(np.uint8)
+
+
+def render(toolpath, pyramid, view, show_travel=True):
+    """
+    Rasterise the view into an (height, width, 3) uint8 RGB image.
+    Returns (image, level) where level is the pyramid level used, or None if
+    the job itself was rasterised.
+    """
+    width, height = view.width, view.height
+    pixel = 1.0 / view.scale
+    level = math.ceil(math.log2(pixel / pyramid.cell_size)) if pixel > pyramid.cell_size else None
+    if level is not None and level < len(pyramid.levels):
+        # Pixel centres in world coordinates, rows from the top of the screen
+        xs = view.cx + (np.arange(width) + 0.5 - width / 2) * pixel
+        ys = view.cy - (np.arange(height) + 0.5 - height / 2) * pixel
+        dots, draw, travel = pyramid.sample(level, xs, ys)
+    else:
+        level = None
+        left, top = view.to_world(0, 0)
+        right, bottom = view.to_world(width, height)
+
+        def pixels(a):
+            # Job units to pixels, rows from the top of the screen
+            p = np.empty_like(a)
+            p[:, 0::2] = (a[:, 0::2] - left) * view.scale
+            p[:, 1::2] = (top - a[:, 1::2]) * view.scale
+            return p
+
+        d = toolpath.dots
+        d = d[(d[:, 0] >= left) & (d[:, 0] <= right) & (d[:, 1] >= bottom) & (d[:, 1] <= top)]
+        dots = rasterise_points(*pixels(d).T, width, height)
+        draw = rasterise_segments(pixels(in_view(toolpath.draw, left, bottom, right, top)), width, height)
+        travel = None
+        if show_travel:
+            travel = rasterise_segments(pixels(in_view(toolpath.travel, left, bottom, right, top)), width, height)
+
+    # Build an image of palette indices, then look the colours up in one go
+    index = np.zeros((height, width), dtype=np.uint8)
+    if show_travel:
+        index[travel > 0] = 1
+    index[draw > 0] = 2
+    has_dots = dots > 0
+    if has_dots.any():
+        # Darker red where more dots land in one pixel
+        most = dots.max()
+        shade = np.log(dots[has_dots]) / max(math.log(most), 1.0)
+        index[has_dots] = 3 + (shade * (DOT_SHADES - 1)).astype(np.uint8)
+    return PALETTE[index], level
+
+
+def to_ppm(image):
+    """An RGB image as a binary PPM file."""
+    height, width = image.shape[:2]
+    return b"P6 %d %d 255\n" % (width, height) + image.tobytes()
+
+
+# ---------------------------------------------------------------------
+# Viewer
+# ---------------------------------------------------------------------
+
+class PreviewWindow:
+    """
+    A Tk window showing the rendered view as a single PhotoImage. Redraws are
+    put off until Tk is idle, so a burst of drag or wheel events only costs
+    one render.
+    """
+
+    def __init__(self, tk, toolpath, pyramid, width, height, title):
+        self.tk = tk
+        self.toolpath = toolpath
+        self.pyramid = pyramid
+        self.view = View(width, height)
+        self.view.fit(toolpath.bounds())
+        self.show_travel = True
+        self.pending = None
+        self.drag = None
+
+        self.root = tk.Tk()
+        self.root.title(title)
+        self.canvas = tk.Canvas(self.root, width=width, height=height, highlightthickness=0,
+                                background="#%02x%02x%02x" % BACKGROUND)
+        self.canvas.pack(fill="both", expand=True)
+        self.status = tk.Label(self.root, anchor="w")
+        self.status.pack(fill="x")
+        self.photo = tk.PhotoImage(width=width, height=height)
+        self.item = self.canvas.create_image(0, 0, anchor="nw", image=self.photo)
+
+        self.canvas.bind("<ButtonPress-1>", self.on_press)
+        self.canvas.bind("<B1-Motion>", self.on_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_release)
+        self.canvas.bind("<MouseWheel>", lambda e: self.on_zoom(e, e.delta > 0))
+        self.canvas.bind("<Button-4>", lambda e: self.on_zoom(e, True))
+        self.canvas.bind("<Button-5>", lambda e: self.on_zoom(e, False))
+        self.canvas.bind("<Configure>", self.on_resize)
+        self.root.bind("<Key>", self.on_key)
+        self.schedule()
+
+    def schedule(self):
+        if self.pending is None:
+            self.pending = self.root.after_idle(self.redraw)
+
+    def redraw(self):
+        self.pending = None
+        start = time.perf_counter()
+        image, level = render(self.toolpath, self.pyramid, self.view, self.show_travel)
+        self.photo.configure(width=self.view.width, height=self.view.height, data=to_ppm(image), format="PPM")
+        self.canvas.coords(self.item, 0, 0)
+        elapsed = time.perf_counter() - start
+        source = f"pyramid level {level}" if level is not None else "job"
+        self.status.configure(text=f"{len(self.toolpath.dots)} dots  {len(self.toolpath.draw)} lines  "
+                                   f"{len(self.toolpath.travel)} travel  |  {self.view.scale:.4g} px/unit  "
+                                   f"from {source} in {elapsed * 1000:.0f}ms")
+
+    def on_press(self, event):
+        self.drag = (event.x, event.y, self.view.cx, self.view.cy)
+
+    def on_drag(self, event):
+        if self.drag is None:
+            return
+        x0, y0, cx, cy = self.drag
+        self.view.cx = cx - (event.x - x0) / self.view.scale
+        self.view.cy = cy + (event.y - y0) / self.view.scale
+        # Slide the old image along until the new one is ready
+        self.canvas.coords(self.item, event.x - x0, event.y - y0)
+        self.schedule()
+
+    def on_release(self, event):
+        self.on_drag(event)
+        self.drag = None
+
+    def on_zoom(self, event, zoom_in):
+        self.view.zoom(ZOOM_STEP if zoom_in else 1 / ZOOM_STEP, event.x, event.y)
+        self.schedule()
+
+    def on_resize(self, event):
+        if (event.width, event.height) != (self.view.width, self.view.height):
+            self.view.width, self.view.height = max(event.width, 1), max(event.height, 1)
+            self.schedule()
+
+    def on_key(self, event):
+        if event.keysym == "f":
+            self.view.fit(self.toolpath.bounds())
+        elif event.keysym == "t":
+            self.show_travel = not self.show_travel
+        elif event.keysym == "q":
+            self.root.destroy()
+            return
+        self.schedule()
+
+
+# ---------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Preview the dots, lines and travel moves of a GCODE job"
+    )
+    parser.add_argument("input", help="GCODE file to preview (use '-' for stdin)")
+    parser.add_argument("--size", default="900x700", help="Window size, WIDTHxHEIGHT")
+    parser.add_argument("--save", help="Write the fitted view to this PPM file and exit")
+    parser.add_argument("--no-travel", action="store_true", help="Start with travel moves hidden")
+    args = parser.parse_args()
+
+    try:
+        width, height = (int(v) for v in args.size.lower().split("x"))
+    except ValueError:
+        parser.error("--size must look like 900x700")
+
+    start = time.perf_counter()
+    if args.input == "-":
+        toolpath = parse_toolpath(sys.stdin)
+    else:
+        with open(args.input, "r") as f:
+            toolpath = parse_toolpath(f)
+    parsed = time.perf_counter()
+    pyramid = Pyramid(toolpath)
+    built = time.perf_counter()
+    print(f"{len(toolpath.dots)} dots, {len(toolpath.draw)} lines, {len(toolpath.travel)} travel moves. "
+          f"Parsed in {parsed - start:.2f}s, {len(pyramid.levels)} level pyramid built in {built - parsed:.2f}s",
+          file=sys.stderr)
+
+    if args.save:
+        view = View(width, height)
+        view.fit(toolpath.bounds())
+        image, level = render(toolpath, pyramid, view, not args.no_travel)
+        with open(args.save, "wb") as f:
+            f.write(to_ppm(image))
+        print("Wrote", args.save, file=sys.stderr)
+        return
+
+    import tkinter
+    window = PreviewWindow(tkinter, toolpath, pyramid, width, height, f"GCODE preview - {args.input}")
+    window.show_travel = not args.no_travel
+    window.root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+# grbl_sim.py - Revision 0.01
+#
+# A stand-in for a GRBL 1.1 controller on a pseudo-terminal, so the serial code in
+# oldGRBLdelta and utils can be tried out and benchmarked without a real board.
+#
+# - Emulates the 128 byte serial receive buffer. Characters sent when it is full
+#   are dropped, just as they are on the real hardware.
+# - Emulates the planner queue. "ok" is sent as each line is parsed into the
+#   planner, so it stalls when the planner is full and the timing of the "ok"
+#   responses follows the motion model (feed, maximum rate and acceleration).
+# - Supports G0/G1/G4, G90/G91, G53, G92, G10 L2/L20, G38.2/G38.3 probing against a
+#   configurable surface, $H, $X, $J= jogging, $I, $$, and M codes (ignored).
+# - Realtime commands: ? status report, ! feed hold, ~ resume, 0x18 soft reset
+#   and 0x85 jog cancel.
+# - Alarms lock out GCODE until $X, just like GRBL.
+#
+# Run it and then point the other utilities at the port it prints, or use --link
+# to give it a fixed name:
+#   grbl_sim.py --link /tmp/ttyGRBL --config ../maus/grbl_config_RAMPS_20250507.txt
+#   levelling_probe.py --port /tmp/ttyGRBL
+#
+# Units: 1 mm in GCODE = 1 micron in machine space.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import math
+import os
+import pty
+import random
+import re
+import select
+import sys
+import time
+import tty
+from collections import deque
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+RX_BUFFER_SIZE = 128     # GRBL serial receive buffer
+PLANNER_BLOCKS = 15      # Usable planner blocks (BLOCK_BUFFER_SIZE - 1)
+PARSE_TIME = 0.0015      # Seconds GRBL takes to parse a line on a 16MHz AVR
+HOMING_TIME = 2.0        # Seconds a homing cycle takes
+BANNER = "Grbl 1.1h ['$' for help]"
+VERSION = "[VER:1.1h.20190825:]"
+
+# Defaults match maus/grbl_config_RAMPS_20250507.txt
+DEFAULT_SETTINGS = {
+    10: 3,                                  # Status report: MPos and buffer state
+    22: 0,                                  # Homing cycle enable
+    100: 33.830, 101: 33.642, 102: 44.444,  # Steps per unit
+    110: 6000.0, 111: 6000.0, 112: 20000.0, # Maximum rates, units/min
+    120: 50.0, 121: 50.0, 122: 900.0,       # Accelerations, units/s^2
+}
+
+AXES = "XYZ"
+
+# Realtime command bytes
+STATUS_QUERY = ord("?")
+FEED_HOLD = ord("!")
+CYCLE_START = ord("~")
+SOFT_RESET = 0x18
+JOG_CANCEL = 0x85
+
+WORD_PATTERN = re.compile(r"([A-Z])\s*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))")
+
+
+def read_settings(file_path):
+    """
+    Read $n=value settings from a saved GRBL configuration, such as the ones
+    in the maus and oldGRBLdelta directories.
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    with open(file_path, "r") as f:
+        for line in f:
+            m = re.match(r"\s*\$(\d+)\s*=\s*([-+]?[0-9.]+)", line)
+            if m:
+                settings[int(m.group(1))] = float(m.group(2))
+    return settings
+
+
+class Surface:
+    """
+    The surface the probe touches, in machine coordinates:
+    z = z0 + slope_x*x + slope_y*y + bowl*(x^2 + y^2), plus optional gaussian noise
+    on every probe to mimic a real touch plate. A fraction of probes can also
+    trigger early, 1 to 5 above the surface, like a speck of dust on the plate.
+    """
+
+    def __init__(self, z0=0.0, slope_x=0.0, slope_y=0.0, bowl=0.0, noise=0.0, outliers=0.0):
+        self.z0, self.slope_x, self.slope_y, self.bowl = z0, slope_x, slope_y, bowl
+        self.noise = noise
+        self.outliers = outliers
+
+    def height(self, x, y):
+        return self.z0 + self.slope_x * x + self.slope_y * y + self.bowl * (x * x + y * y)
+
+    def touch(self, x, y):
+        z = self.height(x, y) + (random.gauss(0, self.noise) if self.noise else 0.0)
+        if self.outliers and random.random() < self.outliers:
+            z += random.uniform(1.0, 5.0)
+        return z
+
+
+class Block:
+    """
+    A planner block. Motion blocks move from start to end; other blocks (dwell,
+    probe, homing) just take up time and may have something to do at the end.
+    """
+
+    def __init__(self, start, end, duration, feed, jog=False, on_complete=None):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.feed = feed
+        self.jog = jog
+        self.on_complete = on_complete
+        self.started = None
+
+
+# ---------------------------------------------------------------------
+# Simulator
+# ---------------------------------------------------------------------
+
+class GRBLSimulator:
+    def __init__(self, fd, settings, surface, time_scale=1.0, verbose=False):
+        self.fd = fd
+        self.settings = settings
+        self.surface = surface
+        self.time_scale = time_scale
+        self.verbose = verbose
+        # Simulated time only advances while not in feed hold
+        self.clock = 0.0
+        self.last_wall = time.monotonic()
+        self.stats = {"lines": 0, "blocks": 0, "errors": 0, "alarms": 0,
+                      "dropped_bytes": 0, "max_rx": 0, "starved": 0, "status": 0}
+        self.reset()
+        self.state = "Alarm" if settings.get(22) else "Idle"
+
+    def reset(self):
+        """
+        Soft reset: throw away everything buffered and planned, keep position.
+        """
+        self.rx = bytearray()
+        self.planner = deque()
+        self.mpos = getattr(self, "mpos", [0.0, 0.0, 0.0])
+        self.planned = list(self.mpos)
+        self.g54 = getattr(self, "g54", [0.0, 0.0, 0.0])
+        self.g92 = [0.0, 0.0, 0.0]
+        self.absolute = True
+        self.rapid = True
+        self.feed = 0.0
+        self.hold = False
+        self.state = "Idle"
+        self.busy = False
+        self.next_parse = 0.0
+        self.reports_since_wco = 0
+        self.last_wco = None
+
+    # -----------------------------------------------------------------
+    # Output
+    # -----------------------------------------------------------------
+
+    def send(self, text):
+        if self.verbose:
+            print("<", text)
+        try:
+            os.write(self.fd, (text + "\r\n").encode("ascii"))
+        except OSError:
+            pass
+
+    def alarm(self, code):
+        self.state = "Alarm"
+        self.stats["alarms"] += 1
+        self.send(f"ALARM:{code}")
+
+    def wco(self):
+        return [a + b for a, b in zip(self.g54, self.g92)]
+
+    def current_position(self):
+        """
+        Machine position part way through the executing block.
+        """
+        if self.planner and self.planner[0].started is not None:
+            block = self.planner[0]
+            fraction = min(1.0, (self.clock - block.started) / block.duration) if block.duration > 0 else 1.0
+            return [s + (e - s) * fraction for s, e in zip(block.start, block.end)]
+        return list(self.mpos)
+
+    def status_report(self):
+        self.stats["status"] += 1
+        state = self.state
+        if self.hold:
+            state = "Hold:0"
+        pos = self.current_position()
+        mask = int(self.settings.get(10, 3))
+        fields = [state]
+        if mask & 1:
+            fields.append("MPos:" + ",".join(f"{v:.3f}" for v in pos))
+        else:
+            fields.append("WPos:" + ",".join(f"{p - o:.3f}" for p, o in zip(pos, self.wco())))
+        if mask & 2:
+            fields.append(f"Bf:{PLANNER_BLOCKS - len(self.planner)},{RX_BUFFER_SIZE - len(self.rx)}")
+        feed = self.planner[0].feed if self.planner and not self.hold else 0
+        fields.append(f"FS:{feed:.0f},0")
+        # GRBL sends the work coordinate offset in the first report, in the next
+        # one after it changes, and otherwise only every so often
+        wco = self.wco()
+        self.reports_since_wco += 1
+        if wco != self.last_wco or self.reports_since_wco >= 10:
+            fields.append("WCO:" + ",".join(f"{v:.3f}" for v in wco))
+            self.reports_since_wco = 0
+            self.last_wco = wco
+        self.send("<" + "|".join(fields) + ">")
+
+    # -----------------------------------------------------------------
+    # Motion model
+    # -----------------------------------------------------------------
+
+    def move_time(self, start, end, feed):
+        """
+        Time for a move starting and ending at rest with a trapezoidal velocity
+        profile, limited by each axis' maximum rate and acceleration.
+        """
+        delta = [e - s for s, e in zip(start, end)]
+        distance = math.sqrt(sum(d * d for d in delta))
+        if distance == 0:
+            return 0.0
+        rate = feed / 60.0
+        accel = float("inf")
+        for i, d in enumerate(delta):
+            fraction = abs(d) / distance
+            if fraction > 0:
+                rate = min(rate, self.settings[110 + i] / 60.0 / fraction)
+                accel = min(accel, self.settings[120 + i] / fraction)
+        if distance < rate * rate / accel:
+            # Never reaches full speed
+            return 2.0 * math.sqrt(distance / accel)
+        return distance / rate + rate / accel
+
+    def plan_move(self, end, feed, jog=False):
+        start = list(self.planned)
+        if feed <= 0:
+            # GRBL rejects G1 without a feed rate before we get here
+            feed = max(self.settings[110 + i] for i in range(3))
+        duration = self.move_time(start, end, feed)
+        self.planner.append(Block(start, list(end), duration, feed, jog))
+        self.planned = list(end)
+        self.stats["blocks"] += 1
+
+    def advance(self):
+        """
+        Run the clock forward and retire any completed planner blocks.
+        """
+        now = time.monotonic()
+        if not self.hold:
+            self.clock += (now - self.last_wall) * self.time_scale
+        self.last_wall = now
+        while self.planner:
+            block = self.planner[0]
+            if block.started is None:
+                block.started = self.clock
+                if self.state in ("Idle", "Run", "Jog"):
+                    self.state = "Jog" if block.jog else "Run"
+            if self.clock < block.started + block.duration:
+                break
+            self.planner.popleft()
+            self.mpos = list(block.end)
+            if self.planner:
+                # Next block carries straight on from where this one finished
+                self.planner[0].started = block.started + block.duration
+            elif self.rx and b"\n" in self.rx:
+                # There were lines waiting that could have kept us moving
+                self.stats["starved"] += 1
+            if block.on_complete:
+                block.on_complete()
+        if not self.planner and self.state in ("Run", "Jog"):
+            self.state = "Idle"
+            self.busy = False
+
+    def next_event(self):
+        """
+        Seconds of wall time until something interesting might happen.
+        """
+        if self.planner and not self.hold:
+            block = self.planner[0]
+            started = block.started if block.started is not None else self.clock
+            remaining = (started + block.duration - self.clock) / self.time_scale
+            return max(0.0, min(remaining, 0.05))
+        if self.rx and b"\n" in self.rx:
+            return max(0.0, self.next_parse - self.clock) / self.time_scale
+        return 0.5
+
+    # -----------------------------------------------------------------
+    # Input
+    # -----------------------------------------------------------------
+
+    def receive(self, data):
+        for byte in data:
+            if byte == STATUS_QUERY:
+                self.status_report()
+            elif byte == FEED_HOLD:
+                if self.planner:
+                    self.hold = True
+            elif byte == CYCLE_START:
+                self.hold = False
+            elif byte == SOFT_RESET:
+                alarmed = self.state == "Alarm" or bool(self.planner)
+                self.mpos = self.current_position()
+                self.reset()
+                if alarmed and self.settings.get(22):
+                    self.state = "Alarm"
+                self.send("")
+                self.send(BANNER)
+            elif byte == JOG_CANCEL:
+                self.cancel_jog()
+            elif byte >= 0x80:
+                # Other extended realtime commands (overrides etc.) aren't emulated
+                pass
+            elif len(self.rx) >= RX_BUFFER_SIZE:
+                self.stats["dropped_bytes"] += 1
+            else:
+                self.rx.append(byte)
+                self.stats["max_rx"] = max(self.stats["max_rx"], len(self.rx))
+
+    def cancel_jog(self):
+        if self.state != "Jog":
+            return
+        self.mpos = self.current_position()
+        self.planner.clear()
+        self.planned = list(self.mpos)
+        self.state = "Idle"
+        # GRBL also discards any jog lines still waiting in the receive buffer
+        lines = bytes(self.rx).split(b"\n")
+        kept = [l for l in lines[:-1] if not l.strip().upper().startswith(b"$J=")]
+        self.rx = bytearray(b"".join(l + b"\n" for l in kept) + lines[-1])
+
+    def process_lines(self):
+        """
+        Parse as many complete lines as the planner and parse time allow.
+        """
+        while b"\n" in self.rx and not self.busy and self.clock >= self.next_parse:
+            end = self.rx.index(b"\n")
+            raw = bytes(self.rx[:end]).decode("ascii", errors="ignore")
+            line = raw.split(";", 1)[0]
+            line = re.sub(r"\(.*?\)", "", line).strip().upper()
+            # Lines that move need a free planner block before GRBL will take them
+            if self.needs_planner(line) and len(self.planner) >= PLANNER_BLOCKS:
+                break
+            if self.needs_sync(line) and self.planner:
+                break
+            del self.rx[:end + 1]
+            self.stats["lines"] += 1
+            self.next_parse = self.clock + PARSE_TIME
+            if self.verbose:
+                print(">", raw.strip())
+            response = self.execute(line)
+            if response is not None:
+                if response.startswith("error"):
+                    self.stats["errors"] += 1
+                self.send(response)
+
+    def needs_planner(self, line):
+        return line.startswith("$J=") or (not line.startswith("$") and any(a in line for a in AXES))
+
+    def needs_sync(self, line):
+        return line.startswith("$H") or "G38" in line or "G92" in line or "G10" in line or "G4" in line
+
+    # -----------------------------------------------------------------
+    # Command execution. Returns the response, or None if it comes later.
+    # -----------------------------------------------------------------
+
+    def execute(self, line):
+        if not line:
+            return "ok"
+        if line.startswith("$"):
+            return self.execute_system(line)
+        if self.state == "Alarm":
+            return "error:9"
+        return self.execute_gcode(line)
+
+    def execute_system(self, line):
+        if line == "$X":
+            if self.state == "Alarm":
+                self.send("[MSG:Caution: Unlocked]")
+                self.state = "Idle"
+            return "ok"
+        if line == "$H":
+            self.state = "Home"
+            self.busy = True
+
+            def homed():
+                self.mpos = [0.0, 0.0, 0.0]
+                self.planned = list(self.mpos)
+                self.state = "Idle"
+                self.busy = False
+                self.send("ok")
+            self.planner.append(Block(self.mpos, [0.0, 0.0, 0.0], HOMING_TIME, 0, on_complete=homed))
+            return None
+        if line == "$I":
+            self.send(VERSION)
+            self.send(f"[OPT:V,{PLANNER_BLOCKS},{RX_BUFFER_SIZE}]")
+            return "ok"
+        if line == "$$":
+            for key in sorted(self.settings):
+                self.send(f"${key}={self.settings[key]:g}")
+            return "ok"
+        if line == "$G":
+            self.send(f"[GC:G{'0' if self.rapid else '1'} G54 G17 G21 G{'90' if self.absolute else '91'} G94 M5 M9 T0 F{self.feed:g} S0]")
+            return "ok"
+        if line == "$#":
+            self.send("[G54:" + ",".join(f"{v:.3f}" for v in self.g54) + "]")
+            self.send("[G92:" + ",".join(f"{v:.3f}" for v in self.g92) + "]")
+            return "ok"
+        if line.startswith("$J="):
+            if self.state not in ("Idle", "Jog"):
+                return "error:8"
+            return self.execute_jog(line[3:])
+        m = re.match(r"\$(\d+)=([-+]?[0-9.]+)$", line)
+        if m:
+            self.settings[int(m.group(1))] = float(m.group(2))
+            return "ok"
+        return "error:3"
+
+    def parse_words(self, line):
+        words = WORD_PATTERN.findall(line)
+        if not words or "".join(l + v for l, v in words) != re.sub(r"\s+", "", line):
+            return None
+        return words
+
+    def target(self, axis_words, absolute, machine=False):
+        end = list(self.planned)
+        wco = [0.0, 0.0, 0.0] if machine else self.wco()
+        absolute = absolute or machine
+        for i, axis in enumerate(AXES):
+            if axis in axis_words:
+                end[i] = axis_words[axis] + wco[i] if absolute else end[i] + axis_words[axis]
+        return end
+
+    def execute_jog(self, line):
+        words = self.parse_words(line)
+        if words is None:
+            return "error:2"
+        absolute = self.absolute
+        feed = None
+        axis_words = {}
+        for letter, value in words:
+            if letter == "G" and value in ("90", "91"):
+                absolute = value == "90"
+            elif letter == "F":
+                feed = float(value)
+            elif letter in AXES:
+                axis_words[letter] = float(value)
+            else:
+                return "error:16"
+        if feed is None:
+            return "error:22"
+        self.plan_move(self.target(axis_words, absolute), feed, jog=True)
+        return "ok"
+
+    def execute_gcode(self, line):
+        words = self.parse_words(line)
+        if words is None:
+            return "error:2"
+        g_codes = []
+        axis_words = {}
+        l_word = p_word = None
+        for letter, value in words:
+            if letter == "G":
+                g_codes.append(value.lstrip("0") or "0")
+            elif letter in AXES:
+                axis_words[letter] = float(value)
+            elif letter == "F":
+                self.feed = float(value)
+            elif letter == "L":
+                l_word = int(float(value))
+            elif letter == "P":
+                p_word = float(value)
+            elif letter in "MSTN":
+                pass
+            else:
+                return "error:20"
+
+        motion = None
+        machine = False
+        for g in g_codes:
+            if g == "90":
+                self.absolute = True
+            elif g == "91":
+                self.absolute = False
+            elif g in ("0", "1"):
+                self.rapid = g == "0"
+                motion = g
+            elif g == "53":
+                # This line's axis words are machine coordinates
+                machine = True
+            elif g in ("21", "17", "54", "94", "92.1"):
+                if g == "92.1":
+                    self.g92 = [0.0, 0.0, 0.0]
+            elif g in ("4", "10", "92", "38.2", "38.3"):
+                motion = g
+            else:
+                return "error:20"
+
+        if motion == "4":
+            self.planner.append(Block(self.planned, self.planned, p_word or 0.0, 0))
+            return "ok"
+        if motion == "10":
+            return self.set_g54(l_word, p_word, axis_words)
+        if motion == "92":
+            for i, axis in enumerate(AXES):
+                if axis in axis_words:
+                    self.g92[i] = self.planned[i] - self.g54[i] - axis_words[axis]
+            return "ok"
+        if motion in ("38.2", "38.3"):
+            return self.probe(axis_words, motion == "38.2")
+        if axis_words:
+            if not self.rapid and self.feed <= 0:
+                return "error:22"
+            feed = max(self.settings[110 + i] for i in range(3)) if self.rapid else self.feed
+            self.plan_move(self.target(axis_words, self.absolute, machine), feed)
+        return "ok"
+
+    def set_g54(self, l_word, p_word, axis_words):
+        if p_word not in (None, 0, 1):
+            return "ok"  # Other coordinate systems aren't used here
+        for i, axis in enumerate(AXES):
+            if axis not in axis_words:
+                continue
+            if l_word == 2:
+                self.g54[i] = axis_words[axis]
+            elif l_word == 20:
+                self.g54[i] = self.planned[i] - self.g92[i] - axis_words[axis]
+            else:
+                return "error:20"
+        return "ok"
+
+    def probe(self, axis_words, alarm_on_miss):
+        """
+        Probe towards the target and stop on the surface. GRBL reports the probe
+        position in machine coordinates, then "ok".
+        """
+        if self.feed <= 0:
+            return "error:22"
+        start = list(self.planned)
+        end = self.target(axis_words, self.absolute)
+        if start[2] <= self.surface.height(start[0], start[1]):
+            # Already touching
+            self.alarm(4)
+            self.send("[PRB:" + ",".join(f"{v:.3f}" for v in start) + ":0]")
+            return "ok"
+
+        # Find where the straight probing path first meets the surface, then
+        # narrow it down by bisection
+        def below(t):
+            p = [s + (e - s) * t for s, e in zip(start, end)]
+            return p[2] <= self.surface.height(p[0], p[1])
+
+        contact = None
+        steps = 200
+        for i in range(1, steps + 1):
+            if below(i / steps):
+                low, high = (i - 1) / steps, i / steps
+                for _ in range(50):
+                    mid = (low + high) / 2
+                    if below(mid):
+                        high = mid
+                    else:
+                        low = mid
+                p = [s + (e - s) * high for s, e in zip(start, end)]
+                z = self.surface.touch(p[0], p[1])
+                contact = [p[0], p[1], max(min(z, start[2]), end[2])]
+                break
+        stop = contact if contact else end
+        self.busy = True
+        self.state = "Run"
+
+        def probed():
+            self.busy = False
+            self.state = "Idle"
+            if contact:
+                self.send("[PRB:" + ",".join(f"{v:.3f}" for v in contact) + ":1]")
+            else:
+                if alarm_on_miss:
+                    self.alarm(5)
+                self.send("[PRB:" + ",".join(f"{v:.3f}" for v in end) + ":0]")
+            self.send("ok")
+
+        self.planner.append(Block(start, stop, self.move_time(start, stop, self.feed), self.feed,
+                                  on_complete=probed))
+        self.planned = list(stop)
+        self.stats["blocks"] += 1
+        return None
+
+    # -----------------------------------------------------------------
+
+    def run(self):
+        self.send("")
+        self.send(BANNER)
+        if self.state == "Alarm":
+            self.send("[MSG:'$H'|'$X' to unlock]")
+        start = time.monotonic()
+        try:
+            while True:
+                self.advance()
+                self.process_lines()
+                ready, _, _ = select.select([self.fd], [], [], self.next_event())
+                if ready:
+                    try:
+                        data = os.read(self.fd, 1024)
+                    except OSError:
+                        # Nobody has the port open right now
+                        time.sleep(0.1)
+                        continue
+                    self.receive(data)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.monotonic() - start
+        s = self.stats
+        print(f"\n{s['lines']} lines, {s['blocks']} planner blocks in {elapsed:.1f}s "
+              f"({s['lines'] / elapsed:.1f} lines/s)")
+        print(f"{s['errors']} errors, {s['alarms']} alarms, {s['status']} status reports")
+        print(f"Receive buffer peak {s['max_rx']}/{RX_BUFFER_SIZE} bytes, "
+              f"{s['dropped_bytes']} bytes dropped by overflow")
+        print(f"Planner ran dry {s['starved']} times with lines waiting")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate a GRBL 1.1 controller on a pseudo-terminal"
+    )
+    parser.add_argument("--link", help="Make a symlink to the simulated port here, e.g. /tmp/ttyGRBL")
+    parser.add_argument("--config", help="GRBL $$ settings file to take rates and accelerations from")
+    parser.add_argument("--surface", default="0,0,0,0",
+                        help="Probe surface z0,slope_x,slope_y,bowl in machine coordinates")
+    parser.add_argument("--noise", type=float, default=0.0,
+                        help="Standard deviation of probe results")
+    parser.add_argument("--outliers", type=float, default=0.0,
+                        help="Fraction of probes that trigger early, 1 to 5 above the surface")
+    parser.add_argument("--start-z", type=float, default=100.0,
+                        help="Machine Z position at power on")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Run the motion faster (>1) or slower (<1) than real time")
+    parser.add_argument("--verbose", action="store_true", help="Echo traffic to the console")
+    args = parser.parse_args()
+
+    settings = read_settings(args.config) if args.config else dict(DEFAULT_SETTINGS)
+    try:
+        surface = Surface(*[float(v) for v in args.surface.split(",")], noise=args.noise,
+                          outliers=args.outliers)
+    except (TypeError, ValueError):
+        parser.error("--surface needs up to four comma separated numbers")
+
+    master, slave = pty.openpty()
+    # Raw mode so there is no echo or newline translation. We keep our own
+    # handle to the slave open so the port survives clients opening and closing it.
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(port, args.link)
+        port = f"{args.link} -> {port}"
+    print(f"Simulated GRBL on {port}. Ctrl-C to stop.", file=sys.stderr)
+
+    sim = GRBLSimulator(master, settings, surface, args.time_scale, args.verbose)
+    sim.mpos = [0.0, 0.0, args.start_z]
+    sim.planned = list(sim.mpos)
+    try:
+        sim.run()
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.unlink(args.link)
+
+
+if __name__ == "__main__":
+    main()
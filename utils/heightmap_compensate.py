@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# heightmap_compensate.py - Revision 0.01
+#
+# Follows the surface when printing on a substrate that isn't flat. Reads GCODE,
+# such as dipify_gcode.py or png_to_gcode.py output, and a height map written
+# by levelling_probe.py --mesh, and adds the height of the surface under each
+# move to its Z:
+# - Heights between the probed grid points are interpolated bilinearly, or
+#   with a bicubic (Catmull-Rom) fit with --bicubic.
+# - A move across the surface is split into shorter moves wherever a straight
+#   line would stray from the surface by more than --tolerance.
+# - Offsets are relative to the surface height at the map origin, where
+#   levelling_probe started, so the job's draw_z still means the same thing
+#   there. --reference changes that.
+#
+# The file is processed in batches of lines. Working out where each move goes
+# has to be done a line at a time, but the interpolation and splitting are done
+# with NumPy for a whole batch at once, so memory use doesn't depend on the
+# size of the job and millions of lines take seconds.
+#
+# G0/G1 moves are compensated, in G90 or G91, following G92 offsets. Arcs are
+# passed through unchanged and counted. Moves are passed through unchanged
+# until there has been a Z word, and again after G10/G28/G30/G53/G38.x until
+# the position is known again, so no Z is added to a move from an unknown
+# height.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import itertools
+import json
+import sys
+import time
+import numpy as np
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+BATCH_LINES = 200000     # Lines read and compensated at a time
+TOLERANCE = 0.2          # Default largest gap between a move and the surface (microns)
+MAX_PIECES = 64          # Most pieces one move is split into
+CACHE_LINES = 100000     # Most different lines remembered between batches
+
+# ---------------------------------------------------------------------
+# Height map
+# ---------------------------------------------------------------------
+
+
+class HeightMap:
+    """
+    A regular grid of surface heights. grid[j][i] is the height at
+    (x0 + i*dx, y0 + j*dy). Outside the grid the edge heights carry on.
+    """
+
+    def __init__(self, x0, y0, dx, dy, grid, bicubic=False):
+        self.x0, self.y0, self.dx, self.dy = float(x0), float(y0), float(dx), float(dy)
+        self.grid = np.asarray(grid, dtype=float)
+        if self.grid.ndim != 2 or min(self.grid.shape) < 2:
+            raise ValueError("height map grid must be at least 2x2")
+        self.ny, self.nx = self.grid.shape
+        self.bicubic = bicubic
+        self.reference = 0.0
+        self.outside = 0
+
+    @classmethod
+    def load(cls, path, bicubic=False):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["x0"], data["y0"], data["dx"], data["dy"], data["grid"], bicubic)
+
+    def set_reference(self, how):
+        """Make offsets relative to the height at the origin, or the mean, min or max height."""
+        if how == "origin":
+            self.reference = float(self.height(np.array([self.x0]), np.array([self.y0]))[0])
+        else:
+            self.reference = float(getattr(np, how)(self.grid))
+
+    def _cells(self, xs, ys):
+        """Grid coordinates of the points, clamped to the grid."""
+        u = (xs - self.x0) / self.dx
+        v = (ys - self.y0) / self.dy
+        outside = (u < -1e-6) | (u > self.nx - 1 + 1e-6) | (v < -1e-6) | (v > self.ny - 1 + 1e-6)
+        self.outside += int(np.count_nonzero(outside))
+        return np.clip(u, 0, self.nx - 1), np.clip(v, 0, self.ny - 1)
+
+    def height(self, xs, ys):
+        u, v = self._cells(xs, ys)
+        if self.bicubic:
+            return self._bicubic(u, v)
+        return self._bilinear(u, v)
+
+    def offset(self, xs, ys):
+        """How far the surface is above the reference height at each point."""
+        return self.height(xs, ys) - self.reference
+
+    def _bilinear(self, u, v):
+        i = np.minimum(u.astype(int), self.nx - 2)
+        j = np.minimum(v.astype(int), self.ny - 2)
+        fu = u - i
+        fv = v - j
+        g = self.grid
+        bottom = g[j, i] + (g[j, i + 1] - g[j, i]) * fu
+        top = g[j + 1, i] + (g[j + 1, i + 1] - g[j + 1, i]) * fu
+        return bottom + (top - bottom) * fv
+
+    @staticmethod
+    def _cubic_weights(f):
+        """Catmull-Rom weights for the four grid points around fraction f."""
+        f2 = f * f
+        f3 = f2 * f
+        return (-0.5 * f3 + f2 - 0.5 * f,
+                1.5 * f3 - 2.5 * f2 + 1.0,
+                -1.5 * f3 + 2.0 * f2 + 0.5 * f,
+                0.5 * f3 - 0.5 * f2)
+
+    def _bicubic(self, u, v):
+        i = np.minimum(u.astype(int), self.nx - 2)
+        j = np.minimum(v.astype(int), self.ny - 2)
+        wu = self._cubic_weights(u - i)
+        wv = self._cubic_weights(v - j)
+        result = np.zeros(len(u))
+        for b in range(4):
+            row = np.clip(j + b - 1, 0, self.ny - 1)
+            across = np.zeros(len(u))
+            for a in range(4):
+                col = np.clip(i + a - 1, 0, self.nx - 1)
+                across += wu[a] * self.grid[row, col]
+            result += wv[b] * across
+        return result
+
+
+# ---------------------------------------------------------------------
+# Compensation
+# ---------------------------------------------------------------------
+
+# G words that start a move, and the motion they select
+MOTION_WORDS = {"G0": "G0", "G00": "G0", "G1": "G1", "G01": "G1",
+                "G2": "G2", "G02": "G2", "G3": "G3", "G03": "G3"}
+# G words with axis words that aren't a plain move, or a move we can't follow
+OTHER_AXIS_WORDS = {"G10", "G28", "G30", "G53", "G38.2", "G38.3", "G38.4", "G38.5"}
+
+
+class Compensator:
+    """
+    Follows the modal state through the file and compensates a batch of lines
+    at a time.
+
+    parse() finds the G0/G1 moves in a batch. Each move is a tuple of
+    (line index, motion, head, xy, tail) from parse_line, and its numbers go
+    in an array with a row of (start, end, G92 offset, relative) for each
+    move. Start and end are in map coordinates: the position as written in
+    the file is the map position minus the G92 offset.
+    """
+
+    def __init__(self, height_map, tolerance=TOLERANCE):
+        self.map = height_map
+        self.tolerance = tolerance
+        # Where the machine is, None on an axis until the file says. Moves
+        # are only compensated once Z is known, so a travel move before the
+        # first Z word isn't turned into a move to draw height.
+        self.position = (0.0, 0.0, None)
+        self.offset = (0.0, 0.0, 0.0)
+        self.absolute = True
+        self.motion = None
+        self.stats = {"lines": 0, "output": 0, "moves": 0, "split": 0, "arcs": 0, "unknown": 0}
+        # What parse_line made of each line. Dot jobs repeat the same Z moves
+        # over and over, so most lines are only taken apart once.
+        self.cache = {}
+
+    def parse(self, lines):
+        """Find the moves in a batch of lines, keeping track of where we are."""
+        moves = []
+        numbers = []
+        cache = self.cache
+        if len(cache) > CACHE_LINES:
+            cache.clear()
+        absolute, motion, offset = self.absolute, self.motion, self.offset
+        px, py, pz = self.position
+        for index, line in enumerate(lines):
+            parsed = cache.get(line)
+            if parsed is None:
+                parsed = cache[line] = parse_line(line)
+            if not parsed:
+                continue
+            line_motion, mode, special, target, head, xy, tail = parsed
+            if mode:
+                absolute = mode == "G90"
+            if line_motion:
+                motion = line_motion
+            if special and special != "G92":
+                # Moves we can't follow, with or without axis words (G28
+                # on its own goes home): forget where the machine is
+                px = py = pz = None
+                continue
+            if target is None:
+                continue
+            tx, ty, tz = target
+            if special == "G92":
+                # G92 makes the current position read as the given values.
+                # On an axis whose position isn't known, the offset can't
+                # be either, so the axis stays unknown.
+                offset = (offset[0] if tx is None or px is None else px - tx,
+                          offset[1] if ty is None or py is None else py - ty,
+                          offset[2] if tz is None or pz is None else pz - tz)
+                continue
+            if motion is None:
+                continue
+
+            sx, sy, sz = px, py, pz
+            if absolute:
+                if tx is not None:
+                    px = tx + offset[0]
+                if ty is not None:
+                    py = ty + offset[1]
+                if tz is not None:
+                    pz = tz + offset[2]
+            else:
+                if tx is not None and px is not None:
+                    px += tx
+                if ty is not None and py is not None:
+                    py += ty
+                if tz is not None and pz is not None:
+                    pz += tz
+            if motion in ("G2", "G3"):
+                self.stats["arcs"] += 1
+                continue
+            if px is None or py is None or pz is None:
+                # Passed through as it is until the position is known
+                self.stats["unknown"] += 1
+                continue
+            if sx is None or sy is None or sz is None:
+                # Nothing known to split along or take a difference from
+                if not absolute:
+                    self.stats["unknown"] += 1
+                    continue
+                sx, sy, sz = px, py, pz
+            moves.append((index, motion, head, xy, tail))
+            numbers.extend((sx, sy, sz, px, py, pz, offset[0], offset[1], offset[2], not absolute))
+        self.absolute, self.motion, self.offset = absolute, motion, offset
+        self.position = (px, py, pz)
+        return moves, np.array(numbers, dtype=float).reshape(-1, 10)
+
+    def process(self, lines):
+        """Returns the compensated lines of a batch."""
+        self.stats["lines"] += len(lines)
+        moves, numbers = self.parse(lines)
+        out = list(lines)
+        if not moves:
+            self.stats["output"] += len(out)
+            return out
+        self.stats["moves"] += len(moves)
+
+        start, end, offset = numbers[:, 0:3], numbers[:, 3:6], numbers[:, 6:9]
+        relative = numbers[:, 9] != 0
+        off_start = self.map.offset(start[:, 0], start[:, 1])
+        off_end = self.map.offset(end[:, 0], end[:, 1])
+        pieces = self.pieces(start, end, off_start, off_end)
+
+        # Moves left whole just get a new Z
+        z = np.where(relative, end[:, 2] - start[:, 2] + off_end - off_start,
+                     end[:, 2] - offset[:, 2] + off_end).tolist()
+        whole = pieces == 1
+        if whole.all():
+            for (index, motion, head, xy, tail), mz in zip(moves, z):
+                out[index] = f"{head}{xy}Z{mz:.3f}{tail}"
+        else:
+            for k in np.flatnonzero(whole).tolist():
+                index, motion, head, xy, tail = moves[k]
+                out[index] = f"{head}{xy}Z{z[k]:.3f}{tail}"
+
+        # The rest are split into pieces, all worked out together
+        split = np.flatnonzero(~whole)
+        if len(split):
+            counts = pieces[split]
+            coords = self.split_moves(split, counts, relative, start, end, offset, off_start).tolist()
+            first = 0
+            for k, n in zip(split.tolist(), counts.tolist()):
+                index, motion, head, xy, tail = moves[k]
+                px, py, pz = coords[first]
+                piece_lines = [f"{head}X{px:.3f} Y{py:.3f} Z{pz:.3f}{tail}"]
+                for px, py, pz in coords[first + 1:first + n]:
+                    piece_lines.append(f"{motion} X{px:.3f} Y{py:.3f} Z{pz:.3f}\n")
+                out[index] = "".join(piece_lines)
+                first += n
+            self.stats["split"] += len(split)
+        self.stats["output"] += len(out) + int(np.sum(pieces - 1))
+        return out
+
+    def pieces(self, start, end, off_start, off_end):
+        """
+        How many pieces to split each move into. The surface is sampled at
+        half the grid spacing along each move and compared with a straight
+        line between the offsets at its ends. Between grid lines the surface
+        is close to a quadratic, where splitting into n pieces cuts the gap
+        by n squared.
+        """
+        length = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+        step = min(self.map.dx, self.map.dy) / 2
+        samples = np.minimum(np.ceil(length / step).astype(int), MAX_PIECES)
+        pieces = np.ones(len(start), dtype=int)
+        long = np.flatnonzero(samples > 1)
+        if len(long) == 0:
+            return pieces
+
+        counts = samples[long] - 1
+        which, t = spread(long, counts, samples[long])
+        xs = start[which, 0] + (end[which, 0] - start[which, 0]) * t
+        ys = start[which, 1] + (end[which, 1] - start[which, 1]) * t
+        chord = off_start[which] + (off_end[which] - off_start[which]) * t
+        gap = np.abs(self.map.offset(xs, ys) - chord)
+        worst = np.maximum.reduceat(gap, np.cumsum(counts) - counts)
+        needed = np.ceil(np.sqrt(worst / self.tolerance)).astype(int)
+        pieces[long] = np.clip(needed, 1, samples[long])
+        return pieces
+
+    def split_moves(self, split, counts, relative, start, end, offset, off_start):
+        """
+        The coordinates to write for each piece of the moves being split, in
+        order: absolute positions for G90 moves, or steps for G91 ones.
+        """
+        which, t = spread(split, counts, counts)
+        points = start[which] + (end[which] - start[which]) * t[:, None]
+        offsets = self.map.offset(points[:, 0], points[:, 1])
+        # The offset at the end of the piece before, for relative moves
+        before = np.empty_like(offsets)
+        before[1:] = offsets[:-1]
+        firsts = np.cumsum(counts) - counts
+        before[firsts] = off_start[split]
+
+        coords = points - offset[which]
+        coords[:, 2] += offsets
+        steps = (end[which] - start[which]) / counts.repeat(counts)[:, None]
+        steps[:, 2] += offsets - before
+        return np.where(relative[which][:, None], steps, coords)
+
+
+def split_comment(line):
+    """
+    Split a line into its code and its comments. GRBL ignores "(...)" wherever
+    it is on the line, and everything after ";". The comments are returned
+    together, to go at the end of the line, as the code words are all that
+    GRBL sees. An unclosed "(" comments out the rest of the line.
+    """
+    code, semicolon, comment = line.partition(";")
+    comment = semicolon + comment
+    if "(" not in code:
+        return code, comment
+    parts, notes = [], []
+    while "(" in code:
+        before, paren, rest = code.partition("(")
+        inside, close, code = rest.partition(")")
+        parts.append(before)
+        notes.append(paren + inside + close)
+    parts.append(code)
+    if comment:
+        notes.append(comment)
+    return " ".join(parts), " ".join(notes)
+
+
+def parse_line(line):
+    """
+    Take a line apart. Returns an empty tuple if there's nothing on it but a
+    comment, or (motion word, G90/G91, other G word that takes axis words,
+    (x, y, z) or None if there are no axis words, head, xy, tail). A moved
+    line is written as head + xy + the new Z word + tail: head is the G and N
+    words at the front, xy the X and Y words as they were, and tail the rest
+    of the line.
+    """
+    code, comment = split_comment(line)
+    words = code.upper().split()
+    if not words:
+        return ()
+    motion = mode = special = None
+    x = y = z = None
+    front, back = [], []
+    for word in words:
+        letter = word[0]
+        if letter == "X":
+            x = word
+        elif letter == "Y":
+            y = word
+        elif letter == "Z":
+            z = word
+        elif letter in "GN" and not back:
+            front.append(word)
+        else:
+            back.append(word)
+        if letter == "G":
+            if word in MOTION_WORDS:
+                motion = MOTION_WORDS[word]
+            elif word in ("G90", "G91"):
+                mode = word
+            elif word == "G92" or word in OTHER_AXIS_WORDS:
+                special = word
+    target = None
+    if x or y or z:
+        try:
+            target = tuple(float(w[1:]) if w else None for w in (x, y, z))
+        except ValueError:
+            pass
+    comment = comment.rstrip("\r\n")
+    head = "".join(w + " " for w in front)
+    xy = "".join(w + " " for w in (x, y) if w)
+    tail = "".join(" " + w for w in back) + (" " + comment if comment else "") + "\n"
+    return (motion, mode, special, target, head, xy, tail)
+
+
+def spread(items, counts, divisions):
+    """
+    Repeat each item counts times, with the fractions 1/divisions,
+    2/divisions ... counts/divisions along it.
+    """
+    which = np.repeat(items, counts)
+    firsts = np.repeat(np.cumsum(counts) - counts, counts)
+    t = (np.arange(len(which)) - firsts + 1) / np.repeat(divisions, counts)
+    return which, t
+
+
+def compensate(input_stream, output_stream, compensator, batch_lines=BATCH_LINES):
+    while True:
+        lines = list(itertools.islice(input_stream, batch_lines))
+        if not lines:
+            break
+        output_stream.writelines(compensator.process(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the height of a probed surface to the Z of every move in a GCODE file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("heightmap", help="Height map JSON from levelling_probe.py --mesh")
+    parser.add_argument("input", nargs="?", default="-", help="Input GCODE file (use '-' for stdin)")
+    parser.add_argument("-o", "--output", default="-", help="Output GCODE file (use '-' for stdout)")
+    parser.add_argument("--bicubic", action="store_true", help="Interpolate bicubically rather than bilinearly")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Split moves that would stray this far from the surface (microns)")
+    parser.add_argument("--reference", choices=("origin", "mean", "min", "max"), default="origin",
+                        help="Surface height that gets no offset")
+    parser.add_argument("--batch", type=int, default=BATCH_LINES, help="Lines processed at a time")
+    args = parser.parse_args()
+
+    height_map = HeightMap.load(args.heightmap, args.bicubic)
+    height_map.set_reference(args.reference)
+    height_map.outside = 0
+    compensator = Compensator(height_map, args.tolerance)
+
+    start = time.perf_counter()
+    input_stream = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        output_stream.write(f"; Height compensated by heightmap_compensate.py from {args.heightmap}\n")
+        compensate(input_stream, output_stream, compensator, max(1, args.batch))
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    elapsed = time.perf_counter() - start
+
+    stats = compensator.stats
+    offsets = height_map.grid - height_map.reference
+    print(f"{stats['lines']} lines in, {stats['output']} out: {stats['moves']} moves compensated, "
+          f"{stats['split']} split", file=sys.stderr)
+    print(f"Offsets from {offsets.min():+.3f} to {offsets.max():+.3f} µm", file=sys.stderr)
+    if stats["arcs"]:
+        print(f"{stats['arcs']} arc moves passed through without compensation", file=sys.stderr)
+    if stats["unknown"]:
+        print(f"{stats['unknown']} moves passed through without compensation before the position was known",
+              file=sys.stderr)
+    if height_map.outside:
+        print(f"{height_map.outside} points were outside the height map and used its edge heights",
+              file=sys.stderr)
+    if elapsed > 0:
+        print(f"{elapsed:.2f}s, {stats['lines'] / elapsed:.0f} lines/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
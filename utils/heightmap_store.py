@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# heightmap_store.py - Revision 0.01
+#
+# Keeps the height maps levelling_probe.py --mesh makes, so a substrate that's
+# already been mapped doesn't need a full mesh probing again for every job:
+# - Each map is saved with the machine, substrate ID and time it was probed,
+#   alongside the probe statistics levelling_probe records.
+# - The latest map for a machine and substrate can be looked up, and is only
+#   offered if it's younger than a maximum age.
+# - A few check points spread over the map are picked to re-probe, and the
+#   new heights are compared with the stored ones. A map that has moved up or
+#   down as a whole is still good; one whose shape has changed is not.
+#
+# Run on its own it lists the maps in the store.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import copy
+import datetime
+import json
+import math
+import os
+import re
+import socket
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+DEFAULT_STORE = os.path.expanduser("~/.reprapmicron/heightmaps")
+DEFAULT_MACHINE = socket.gethostname()
+MAX_AGE = 24.0       # Default hours before a map is too old to reuse
+CHECK_POINTS = 5     # Default points re-probed to confirm a map still fits
+
+# ---------------------------------------------------------------------
+# Store
+# ---------------------------------------------------------------------
+
+
+def safe_name(text):
+    """Make a machine or substrate name safe to use in a file name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_") or "unnamed"
+
+
+def age(height_map, now=None):
+    """Seconds since the map was probed."""
+    probed = datetime.datetime.fromisoformat(height_map["meta"]["timestamp"])
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - probed).total_seconds()
+
+
+class HeightMapStore:
+    """
+    A directory of height maps, one JSON file each, named after the machine,
+    the substrate and when they were probed. The files are the same height
+    maps levelling_probe writes, with a "meta" section added, so
+    heightmap_compensate.py can read them directly.
+    """
+
+    def __init__(self, directory=DEFAULT_STORE):
+        self.directory = directory
+
+    def save(self, height_map, machine, substrate, **meta):
+        """
+        Stamp the map with the machine, substrate and time now, plus any other
+        meta given, and save it. Returns the path it was saved to.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        height_map["meta"] = dict(meta, machine=machine, substrate=substrate,
+                                  timestamp=now.isoformat(timespec="seconds"))
+        name = f"{safe_name(machine)}--{safe_name(substrate)}--{now:%Y%m%dT%H%M%SZ}.json"
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            json.dump(height_map, f)
+        return path
+
+    @staticmethod
+    def update(path, height_map):
+        """Write a map back, after adding to its meta."""
+        with open(path, "w") as f:
+            json.dump(height_map, f)
+
+    def paths(self, machine=None, substrate=None):
+        """Paths of the maps stored, oldest first, for a machine and substrate if given."""
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = ""
+        if machine is not None:
+            prefix = safe_name(machine) + "--"
+            if substrate is not None:
+                prefix += safe_name(substrate) + "--"
+        names = [n for n in os.listdir(self.directory) if n.startswith(prefix) and n.endswith(".json")]
+        # The time stamp at the end of the name sorts in time order
+        names.sort(key=lambda n: n.rsplit("--", 1)[-1])
+        return [os.path.join(self.directory, n) for n in names]
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def latest(self, machine, substrate, max_age=None):
+        """
+        The newest map for this machine and substrate, and its path, or
+        (None, None) if there isn't one or it's older than max_age hours.
+        """
+        for path in reversed(self.paths(machine, substrate)):
+            height_map = self.load(path)
+            meta = height_map.get("meta", {})
+            # Names are made safe, so check it really is this machine and substrate
+            if meta.get("machine") != machine or meta.get("substrate") != substrate:
+                continue
+            if max_age is not None and age(height_map) > max_age * 3600:
+                return None, None
+            return height_map, path
+        return None, None
+
+# ---------------------------------------------------------------------
+# Checking a stored map
+# ---------------------------------------------------------------------
+
+
+def check_points(height_map, count=CHECK_POINTS):
+    """
+    Pick count of the map's probed samples, spread over it as evenly as they
+    can be: the one nearest the middle, then each time the one furthest from
+    all those already picked. Returns [x, y, z] lists.
+    """
+    samples = [tuple(s) for s in height_map["samples"]]
+    if count >= len(samples):
+        return [list(s) for s in samples]
+    xs = [s[0] for s in samples]
+    ys = [s[1] for s in samples]
+    middle = ((min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2)
+    picked = [min(samples, key=lambda s: math.dist(s[:2], middle))]
+    gaps = {s: math.dist(s[:2], picked[0][:2]) for s in samples}
+    while len(picked) < count:
+        furthest = max(gaps, key=gaps.get)
+        picked.append(furthest)
+        for s in gaps:
+            gaps[s] = min(gaps[s], math.dist(s[:2], furthest[:2]))
+    return [list(s) for s in picked]
+
+
+def compare(points, heights):
+    """
+    Compare re-probed heights with the stored ones at points ([x, y, z]).
+    Returns the offset between them (the median difference, as the machine
+    Z may have moved as a whole) and the worst difference left once the
+    offset is taken off, which is what says whether the shape still fits.
+    """
+    differences = sorted(h - p[2] for p, h in zip(points, heights))
+    n = len(differences)
+    offset = (differences[(n - 1) // 2] + differences[n // 2]) / 2
+    worst = max(abs(d - offset) for d in differences)
+    return offset, worst
+
+
+def shift(height_map, offset):
+    """A copy of the map with every height moved by offset."""
+    moved = copy.deepcopy(height_map)
+    moved["grid"] = [[round(z + offset, 4) for z in row] for row in moved["grid"]]
+    moved["samples"] = [[x, y, round(z + offset, 4)] for x, y, z in moved["samples"]]
+    for key in ("min", "max"):
+        if key in moved.get("stats", {}):
+            moved["stats"][key] = round(moved["stats"][key] + offset, 4)
+    return moved
+
+# ---------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="List the height maps in the store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--store", default=DEFAULT_STORE, help="Height map store directory")
+    parser.add_argument("--machine", help="Only list maps for this machine")
+    parser.add_argument("--substrate", help="Only list maps for this substrate (needs --machine)")
+    args = parser.parse_args()
+
+    store = HeightMapStore(args.store)
+    paths = store.paths(args.machine, args.substrate)
+    if not paths:
+        print(f"No height maps in {args.store}")
+        return
+    print(f"{'machine':16} {'substrate':16} {'probed':25} {'age (h)':>8} {'points':>7} {'range':>8}")
+    for path in paths:
+        height_map = store.load(path)
+        meta = height_map.get("meta", {})
+        stats = height_map.get("stats", {})
+        print(f"{meta.get('machine', '?'):16} {meta.get('substrate', '?'):16} "
+              f"{meta.get('timestamp', '?'):25} {age(height_map) / 3600:8.1f} "
+              f"{stats.get('points', 0):7} {stats.get('range', 0):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
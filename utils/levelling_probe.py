@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# reprapmicron_probe_corners.py - Revision 0.02
+# reprapmicron_probe_corners.py - Revision 0.03
 #
 # RepRapMicron safe first-run bed probing utility
 # - Forces current position as (0,0,SAFE_Z) without moving
@@ -7,6 +7,14 @@
 # - Supports multiple probe attempts per corner with averaging
 # - Reports relative heights and identifies high/low corners
 # - Returns to (0,0,SAFE_Z) at end
+# - Waits for each probe result without polling, and gives up if the probe
+#   hasn't triggered by the time the move should have finished
+# - With --mesh, probes a coarse grid instead, adds points only where the
+#   surface isn't flat between them, and writes a height map
+# - With --substrate, keeps mesh height maps in a store (heightmap_store.py)
+#   and reuses a recent one after re-probing a few check points
+# - Can be imported: Prober runs a probing session on a port, and Mesh probes
+#   a height map with it
 #
 # Units: 1 mm in GCODE = 1 micron in machine space.
 #
@@ -30,196 +38,791 @@ import serial
 import time
 import re
 import argparse
+import datetime
+import json
+import math
+import queue
+import threading
+import numpy as np
+import heightmap_store
 
 # ---------------------------------------------------------------------
-# Argument parsing
+# Configuration
 # ---------------------------------------------------------------------
 
-parser = argparse.ArgumentParser(
-    description="Probe bed corners with optional averaging"
-)
+DEFAULT_PORT = "/dev/ttyACM0"
+DEFAULT_BAUD = 115200
+
+# How far each probe moves down looking for the surface
+PROBE_DISTANCE = 6000
+# The check that the probe starts clear only moves this far
+CHECK_DISTANCE = 1
+# A probe gets PROBE_TIME_FACTOR times as long as distance / feed says it should
+# take, plus PROBE_TIME_MARGIN seconds for acceleration and the serial round trip
+PROBE_TIME_FACTOR = 1.5
+PROBE_TIME_MARGIN = 2.0
+# Rate assumed for the rapid travel queued ahead of a probe when working out
+# its deadline. Well under the machine's max rates ($110-$112) so it's safe.
+TRAVEL_RATE = 1000
+# Predict the surface under a point from this many probed neighbours
+PREDICT_NEIGHBOURS = 6
+# With --ci, touches more than OUTLIER_LIMIT robust standard deviations from
+# the median are rejected. The robust standard deviation is 1.4826 times the
+# median absolute deviation, but never taken as less than MIN_SIGMA microns,
+# so a few touches that happen to agree exactly don't reject everything else.
+OUTLIER_LIMIT = 3.5
+MIN_SIGMA = 0.1
+# Two sided 95% points of Student's t for 1 to 10 degrees of freedom. It's
+# 2.09 at 20 and 1.96 at infinity, so 2.1 does beyond the table.
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228]
 
-parser.add_argument("--port", default="/dev/ttyACM0",
-                    help="Serial port for GRBL")
+# ---------------------------------------------------------------------
+# Serial reader
+# ---------------------------------------------------------------------
 
-parser.add_argument("--baud", type=int, default=115200,
-                    help="Serial baud rate")
+class LineReader(threading.Thread):
+    """
+    Reads lines from GRBL in the background and queues them, so waiting for
+    an answer blocks on the queue rather than spinning on ser.in_waiting.
+    It also counts the ok and error: answers, so we can tell when GRBL has
+    dealt with everything sent. Once it is running, nothing else should read
+    from the port. A line cut short by the port's read timeout is kept until
+    the rest of it arrives.
+    """
+
+    def __init__(self, ser):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.lines = queue.Queue()
+        self.acknowledged = 0
+        self.answered = threading.Condition()
+
+    def run(self):
+        partial = b""
+        while True:
+            try:
+                raw = self.ser.readline()
+            except (serial.SerialException, OSError, TypeError):
+                # The port has been closed
+                return
+            if not raw.endswith(b"\n"):
+                partial += raw
+                continue
+            line = (partial + raw).decode(errors="ignore").strip()
+            partial = b""
+            if line == "ok" or line.startswith("error:"):
+                with self.answered:
+                    self.acknowledged += 1
+                    self.answered.notify_all()
+            self.lines.put(line)
+
+    def wait_for(self, prefixes, timeout):
+        """
+        Return the first line starting with one of prefixes, or None if none
+        arrives within timeout seconds. Other lines are dropped.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if line.startswith(prefixes):
+                return line
+
+    def wait_acknowledged(self, count, timeout):
+        """Wait until count lines have been answered. Returns False on timeout."""
+        with self.answered:
+            return self.answered.wait_for(lambda: self.acknowledged >= count, timeout)
+
+    def discard(self):
+        """Drop anything already received."""
+        while True:
+            try:
+                self.lines.get_nowait()
+            except queue.Empty:
+                return
 
-parser.add_argument("--size", type=float, default=2000,
-                    help="Square size (microns)")
 
-parser.add_argument("--safe-z", type=float, default=100,
-                    help="Safe Z height")
+# ---------------------------------------------------------------------
+# Probing session
+# ---------------------------------------------------------------------
 
-parser.add_argument("--feed", type=float, default=1000,
-                    help="Probe feedrate")
+class ProbeError(Exception):
+    pass
+
+
+class Prober:
+    """
+    A probing session with GRBL on a serial port. connect() opens the port
+    and unlocks GRBL, begin() makes where the probe is now the work origin at
+    safe_z and checks it isn't touching, probe_path() probes points, finish()
+    takes it back to the origin, and close() lets the port go.
+
+    Anything that goes wrong raises ProbeError. abort() then stops the
+    machine as safely as it can and closes the port.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, baud=DEFAULT_BAUD, safe_z=100, feed=1000,
+                 fast_feed=3000, backoff=10, clearance=20, probes=1, ci=None, max_probes=10):
+        self.port = port
+        self.baud = baud
+        self.safe_z = safe_z
+        self.feed = feed
+        self.fast_feed = fast_feed
+        self.backoff = backoff
+        self.clearance = clearance
+        self.probes = max(1, probes)
+        self.ci = ci
+        self.min_probes = max(2, self.probes)
+        self.max_probes = max(self.min_probes, max_probes)
+        self.ser = None
+        self.reader = None
+        # Lines sent to GRBL since the reader started
+        self.sent = 0
+        # Machine Z of every point probed so far, keyed by work (x, y), and
+        # of the last contact. PRB results are in machine coordinates.
+        self.surface = {}
+        self.contact = None
+        # Work (x, y) the probe has been sent to
+        self.position = (0.0, 0.0)
+        # Furthest a prediction has been from the surface found, which is
+        # added to the clearance so a surface that bends more than expected
+        # isn't hit in travel
+        self.worst_miss = 0.0
+
+    def settings(self):
+        """The settings that affect the heights found, to record with them."""
+        return {"safe_z": self.safe_z, "feed": self.feed, "fast_feed": self.fast_feed,
+                "backoff": self.backoff, "clearance": self.clearance,
+                "probes": self.probes, "ci": self.ci, "max_probes": self.max_probes}
+
+    def connect(self):
+        self.ser = serial.Serial(self.port, self.baud, timeout=1)
+        time.sleep(2)
+
+        # flush startup messages
+        while self.ser.in_waiting:
+            self.ser.readline()
+
+        self.reader = LineReader(self.ser)
+        self.reader.start()
+
+        # unlock GRBL
+        self.send("$X\n")
+        self.reader.wait_acknowledged(self.sent, 1.0)
+
+    def close(self):
+        if self.ser:
+            self.ser.close()
+
+    def send(self, text):
+        """Send one or more lines to GRBL, counting them."""
+        self.sent += text.count("\n")
+        self.ser.write(text.encode())
+
+    def probe(self, distance, feed, command="G38.2", travel=0.0):
+        """
+        Probe down by distance, returning GRBL's PRB line and how long it took.
+        Returns as soon as the result arrives. travel is how far the moves queued
+        ahead of the probe still have to go, which is added to its deadline.
+        Raises ProbeError on an ALARM, or if there is no result by the time the
+        probe should have finished.
+        """
+        self.reader.discard()
+        start = time.monotonic()
+        self.send(f"G91\n{command} Z-{distance:.4f} F{feed}\nG90\n")
+        timeout = probe_timeout(distance, feed) + 60.0 * travel / TRAVEL_RATE
+        line = self.reader.wait_for(("[PRB:", "ALARM:"), timeout)
+        elapsed = time.monotonic() - start
+        if line is None:
+            raise ProbeError(f"no probe result after {elapsed:.1f}s")
+        if line.startswith("ALARM:"):
+            raise ProbeError(f"GRBL {line} after {elapsed:.1f}s")
+        return line, elapsed
+
+    def unlock(self):
+        """Clear an alarm and wait for GRBL to say so."""
+        self.send("$X\n")
+        # GRBL answers in order, so once $X is answered everything before it has
+        # been too. Lines queued behind an alarm may have been thrown away rather
+        # than answered, so start counting afresh from here.
+        if self.reader.wait_for(("[MSG:Caution: Unlocked]",), 1.0):
+            self.reader.wait_for(("ok", "error:"), 1.0)
+        self.sent = self.reader.acknowledged
+
+    def abort(self, error):
+        """After a ProbeError, get the probe clear if we can and close the port."""
+        if "ALARM:" in str(error):
+            # The machine has already stopped. Unlock it and retract safely
+            self.unlock()
+            self.send(f"G91\nG0 Z{self.safe_z}\nG90\n")
+            time.sleep(0.2)
+        else:
+            # Still moving, or not answering. Stop it where it is.
+            self.ser.write(b"!")
+            time.sleep(0.2)
+            self.ser.write(b"\x18")
+            print("GRBL has been reset. Check the probe before running again.")
+        self.close()
+
+    def check_probe_not_triggered(self):
+        # Do a tiny probe. This will fail instantly with ALARM:4 if it is already
+        # contacting. ALARM:5 means it moved and found nothing, which is what we want.
+        try:
+            self.probe(CHECK_DISTANCE, self.feed)
+        except ProbeError as e:
+            if "ALARM:4" in str(e):
+                raise ProbeError(f"Probe is already in contact at start ({e}). "
+                                 "Ensure probe is clear of the surface and try again.")
+            if "ALARM:5" not in str(e):
+                raise
+            self.unlock()
+
+    def begin(self):
+        # force current position as (0,0,SAFE_Z) without moving
+        self.send(f"G10 L20 P1 X0 Y0 Z{self.safe_z}\n")
+        self.position = (0.0, 0.0)
+
+        # Check probe state in case it is already touching
+        self.check_probe_not_triggered()
+
+    def finish(self):
+        """Lift clear and go back to the origin for the next run."""
+        self.send(f"G91\nG0 Z{self.safe_z}\nG90\n")
+        self.send(f"G0 X0 Y0 Z{self.safe_z}\n")
+        self.position = (0.0, 0.0)
+
+    def predict(self, x, y):
+        """
+        Guess the machine Z of the surface at (x, y) by fitting a plane through
+        the nearest points already probed. Returns the guess and whether it can
+        be trusted, which takes three points that aren't in a line; otherwise the
+        guess is just the height of the nearest point. (None, False) if nothing
+        has been probed yet.
+        """
+        if not self.surface:
+            return None, False
+        near = sorted(self.surface, key=lambda p: math.dist(p, (x, y)))[:PREDICT_NEIGHBOURS]
+        a = np.array([[px, py, 1.0] for px, py in near])
+        coeffs, _, rank, _ = np.linalg.lstsq(a, np.array([self.surface[p] for p in near]), rcond=None)
+        if rank < 3:
+            return self.surface[near[0]], False
+        return float(coeffs @ (x, y, 1.0)), True
+
+    def travel_to(self, x, y):
+        """
+        Queue the move from where the probe is to (x, y) without waiting for
+        it, lifting clear of both
+        the last contact and the surface predicted there first. Until there's a
+        prediction to trust, that means lifting safe_z. Returns the trusted
+        prediction (or None), how far the fast seek has to go from the top of
+        the move (None for a full seek) and how far the move travels.
+        """
+        here, self.position = self.position, (x, y)
+        if self.contact is None:
+            # Nothing probed yet. Go across at the starting height and seek all the way.
+            self.send(f"G0 X{x:.4f} Y{y:.4f}\n")
+            return None, None, math.dist(here, (x, y))
+        predicted, trusted = self.predict(x, y)
+        clearance = self.clearance + self.worst_miss if trusted else self.safe_z
+        top = max(self.contact, predicted) + clearance
+        self.send(f"G53 G0 Z{top:.4f}\nG0 X{x:.4f} Y{y:.4f}\n")
+        seek = top - predicted + clearance
+        return predicted if trusted else None, seek, top - self.contact + math.dist(here, (x, y))
+
+    def estimate(self, samples):
+        """
+        Returns the height from the slow touches at a point, the touches it was
+        taken from, and the half width of the 95% confidence interval on it (inf
+        from a single touch). With a ci target, touches that are outliers
+        against the median and median absolute deviation, which a stray one
+        can't drag about, are left out first.
+        """
+        z = np.array(samples)
+        if self.ci is not None and len(z) >= 3:
+            median = np.median(z)
+            sigma = max(1.4826 * np.median(abs(z - median)), MIN_SIGMA)
+            z = z[abs(z - median) <= OUTLIER_LIMIT * sigma]
+        n = len(z)
+        if n < 2:
+            return float(z.mean()), z.tolist(), math.inf
+        t = T95[n - 2] if n - 1 <= len(T95) else 2.1
+        return float(z.mean()), z.tolist(), t * float(z.std(ddof=1)) / math.sqrt(n)
+
+    def enough(self, samples):
+        """Whether a point has had enough slow touches."""
+        if self.ci is None:
+            return len(samples) >= self.probes
+        if len(samples) >= self.max_probes:
+            return True
+        return len(samples) >= self.min_probes and self.estimate(samples)[2] <= self.ci
+
+    def touch(self, seek, travel):
+        """
+        Find the surface under the probe: a fast seek down, then back off and
+        touch again slowly until there are enough samples. The fast seek looks
+        as far past the predicted surface as it started above it, with G38.3,
+        which doesn't alarm when it misses, and falls back to a full seek if it
+        does. Returns the slow touch heights.
+        """
+        if seek is None:
+            line, _ = self.probe(PROBE_DISTANCE, self.fast_feed, travel=travel)
+        else:
+            line, _ = self.probe(seek, self.fast_feed, "G38.3", travel)
+            if not line.rstrip().endswith(":1]"):
+                line, _ = self.probe(PROBE_DISTANCE, self.fast_feed)
+        samples = []
+        while not self.enough(samples):
+            self.send(f"G91\nG0 Z{self.backoff}\nG90\n")
+            line, _ = self.probe(2 * self.backoff, self.feed, travel=self.backoff)
+            samples.append(probe_z(line))
+        self.contact = samples[-1]
+        return samples
+
+    def probe_path(self, path):
+        """
+        Probe each (x, y) of path in turn, starting from wherever the probe
+        is, and yield (height, samples, kept, interval, seconds) for each, as
+        estimate() gives them. The move to the next point is queued as soon as a point's last
+        touch comes back, so GRBL is already on its way while the result is
+        dealt with.
+        """
+        path = list(path)
+        if not path:
+            return
+        start = time.monotonic()
+        predicted, seek, travel = self.travel_to(*path[0])
+        for k, (x, y) in enumerate(path):
+            samples = self.touch(seek, travel)
+            height, kept, interval = self.estimate(samples)
+            self.surface[(x, y)] = height
+            if predicted is not None:
+                self.worst_miss = max(self.worst_miss, abs(height - predicted))
+            if k + 1 < len(path):
+                predicted, seek, travel = self.travel_to(*path[k + 1])
+            now = time.monotonic()
+            yield height, samples, kept, interval, now - start
+            start = now
+
+    def describe(self, samples, kept, interval):
+        """How a point's height was arrived at, for the results."""
+        text = f"±{interval:.3f}" if math.isfinite(interval) else "single touch"
+        if len(samples) > 1:
+            text += f", {len(samples)} touches"
+        if len(kept) < len(samples):
+            text += f", {len(samples) - len(kept)} rejected"
+        if self.ci is not None and interval > self.ci:
+            text += ", interval not met"
+        return text
+
+
+def probe_timeout(distance, feed):
+    """How long a probe of this distance at this feed should take at most."""
+    return PROBE_TIME_FACTOR * 60.0 * abs(distance) / feed + PROBE_TIME_MARGIN
+
+
+def probe_z(line):
+    m = re.search(r'PRB:[^,]+,[^,]+,([^:]+)', line)
+    if not m:
+        raise ProbeError(f"could not read probe result {line}")
+    return float(m.group(1))
 
-parser.add_argument("--probes", type=int, default=1,
-                    help="Number of probe attempts per corner")
+# ---------------------------------------------------------------------
+# Mesh probing
+# ---------------------------------------------------------------------
 
-args = parser.parse_args()
+def nearest_neighbour_order(points, start):
+    """Order points so each is the nearest unvisited one to the point before."""
+    remaining = sorted(points)
+    ordered = []
+    here = start
+    while remaining:
+        nearest = min(range(len(remaining)), key=lambda i: math.dist(here, remaining[i]))
+        here = remaining.pop(nearest)
+        ordered.append(here)
+    return ordered
+
+
+class Mesh:
+    """
+    Probe heights over the square, with more points where the surface bends.
+
+    A coarse grid of cells is probed first. Then the centre of each cell is
+    probed and compared with the average of its corners, which is what
+    interpolating across the cell would have given. Where they differ by more
+    than the tolerance the cell is split in four, its edge midpoints are
+    probed, and the four new cells are checked the same way, down to min_cell.
+    Each round of probing is done nearest point first to keep travel down.
+    """
+
+    def __init__(self, prober, size, grid, tolerance, min_cell):
+        self.prober = prober
+        self.size = size
+        self.tolerance = tolerance
+        self.min_cell = min_cell
+        step = size / (grid - 1)
+        self.coarse = [(i * step, j * step) for j in range(grid) for i in range(grid)]
+        # Cells still to check and cells finished with, as (x, y, size)
+        self.active = [(i * step, j * step, step) for j in range(grid - 1) for i in range(grid - 1)]
+        self.leaves = []
+        self.heights = {}
+        self.order = []
+        self.times = []
+        self.touches = []
+        self.rejected = 0
+        self.intervals = []
+        self.travel = 0.0
+        # The probe may not be at the origin, such as after checking a stored map
+        self.position = prober.position
+
+    @staticmethod
+    def key(x, y):
+        return (round(x, 6), round(y, 6))
+
+    def height(self, x, y):
+        return self.heights[self.key(x, y)]
+
+    @staticmethod
+    def corners(cell):
+        x, y, s = cell
+        return [(x, y), (x + s, y), (x, y + s), (x + s, y + s)]
+
+    def probe_points(self, points):
+        """Probe any of these points not already probed, nearest first."""
+        todo = {self.key(x, y) for x, y in points} - set(self.heights)
+        path = nearest_neighbour_order(todo, self.position)
+        for (x, y), (avg, samples, kept, interval, elapsed) in zip(path, self.prober.probe_path(path)):
+            self.travel += math.dist(self.position, (x, y))
+            self.position = (x, y)
+            self.heights[(x, y)] = avg
+            self.order.append((x, y))
+            self.times.append(elapsed)
+            self.touches.append(len(samples))
+            self.rejected += len(samples) - len(kept)
+            self.intervals.append(interval)
+        return len(todo)
+
+    def refine(self):
+        """Probe the coarse grid, then keep refining until every cell is flat or too small to split."""
+        count = self.probe_points(self.coarse)
+        print(f"Coarse grid: {count} points")
+        while self.active:
+            testable = [c for c in self.active if c[2] / 2 >= self.min_cell]
+            self.leaves.extend(c for c in self.active if c[2] / 2 < self.min_cell)
+            count = self.probe_points([(x + s / 2, y + s / 2) for x, y, s in testable])
+
+            split = []
+            for cell in testable:
+                x, y, s = cell
+                predicted = sum(self.height(*c) for c in self.corners(cell)) / 4
+                if abs(self.height(x + s / 2, y + s / 2) - predicted) > self.tolerance:
+                    split.append(cell)
+                else:
+                    self.leaves.append(cell)
+            count += self.probe_points([p for x, y, s in split for p in
+                                        ((x + s / 2, y), (x, y + s / 2), (x + s, y + s / 2), (x + s / 2, y + s))])
+            if testable:
+                print(f"Cells of {testable[0][2]:g}: {len(testable)} checked, {len(split)} split, {count} points")
+            self.active = [(cx, cy, s / 2) for x, y, s in split for cy in (y, y + s / 2) for cx in (x, x + s / 2)]
+
+    def grid(self):
+        """
+        Interpolate across each cell onto a regular grid at the finest spacing
+        probed. Returns (spacing, grid) where grid[j][i] is the height at
+        (i * spacing, j * spacing).
+        """
+        step = min(s for x, y, s in self.leaves)
+        n = int(round(self.size / step)) + 1
+        grid = np.zeros((n, n))
+        # Biggest cells first, so smaller neighbours overwrite the shared edges
+        # with the points probed on them
+        for cell in sorted(self.leaves, key=lambda c: -c[2]):
+            i, j, k = (int(round(v / step)) for v in cell)
+            t = np.linspace(0.0, 1.0, k + 1)
+            z00, z10, z01, z11 = (self.height(*c) for c in self.corners(cell))
+            bottom = z00 + (z10 - z00) * t
+            top = z01 + (z11 - z01) * t
+            grid[j:j + k + 1, i:i + k + 1] = bottom + (top - bottom) * t[:, None]
+        return step, grid
+
+    def height_map(self):
+        """The height map as levelling_probe writes it, ready for JSON."""
+        step, grid = self.grid()
+        z = np.array(list(self.heights.values()))
+        stats = {
+            "points": len(self.heights),
+            "probes": sum(self.touches),
+            "max_probes_per_point": max(self.touches),
+            "rejected": self.rejected,
+            "worst_interval": round(max(self.intervals), 4) if math.isfinite(max(self.intervals)) else None,
+            "uniform_points": grid.size,
+            "min": round(float(z.min()), 4),
+            "max": round(float(z.max()), 4),
+            "range": round(float(z.max() - z.min()), 4),
+            "tolerance": self.tolerance,
+            "min_cell": self.min_cell,
+            "travel": round(self.travel, 1),
+            "probe_time": round(sum(self.times), 2),
+            "time_per_point": round(sum(self.times) / len(self.times), 3),
+        }
+        return {
+            "x0": 0.0,
+            "y0": 0.0,
+            "dx": step,
+            "dy": step,
+            "grid": grid.round(4).tolist(),
+            "samples": [[x, y, round(self.height(x, y), 4)] for x, y in self.order],
+            "stats": stats,
+        }
+
+
+def probe_mesh(prober, size, grid, tolerance, min_cell):
+    """Probe a mesh and return its height map."""
+    print(f"\n--- Probing mesh ({size}x{size}, tolerance {tolerance} µm)---\n")
+    mesh = Mesh(prober, size, grid, tolerance, min_cell)
+    mesh.refine()
+    height_map = mesh.height_map()
+    stats = height_map["stats"]
+
+    print(f"\nProbed {stats['points']} points, where a uniform grid at the finest "
+          f"spacing would need {stats['uniform_points']}")
+    print(f"Total variation: {stats['range']:.3f} µm")
+    print(f"Travel: {stats['travel']:.0f} µm  Probe time: {stats['probe_time']:.2f} s "
+          f"({stats['time_per_point']:.2f} s per point)")
+    print(f"Touches: {stats['probes']} ({stats['probes'] / stats['points']:.1f} per point, "
+          f"at most {stats['max_probes_per_point']}), {stats['rejected']} rejected")
+    if stats["worst_interval"] is not None:
+        print(f"Worst 95% confidence interval: ±{stats['worst_interval']:.3f} µm")
+    return height_map
 
-PORT = args.port
-BAUD = args.baud
-N = args.size
-SAFE_Z = args.safe_z
-PROBE_FEED = args.feed
-PROBE_COUNT = max(1, args.probes)
+# ---------------------------------------------------------------------
+# Reusing a stored height map
+# ---------------------------------------------------------------------
 
-points = {
-    "BL": (0, 0),
-    "BR": (N, 0),
-    "TR": (N, N),
-    "TL": (0, N)
-}
+def check_map(prober, height_map, count, tolerance):
+    """
+    Re-probe count of a stored map's sample points. Returns a record of the
+    check: when it was, the points, how far the surface has moved as a
+    whole (offset), the worst difference once that's taken off, whether
+    that's within tolerance, and how long it took.
+    """
+    points = heightmap_store.check_points(height_map, count)
+    order = nearest_neighbour_order([(x, y) for x, y, z in points], prober.position)
+    points.sort(key=lambda p: order.index((p[0], p[1])))
+    print(f"\n--- Checking stored map at {len(points)} points ---\n")
+    heights = []
+    seconds = 0.0
+    results = prober.probe_path([(x, y) for x, y, z in points])
+    for (x, y, z), (height, samples, kept, interval, elapsed) in zip(points, results):
+        heights.append(height)
+        seconds += elapsed
+        print(f"({x:g}, {y:g}): {height:8.3f} µm, stored {z:8.3f} µm  "
+              f"({prober.describe(samples, kept, interval)})  time {elapsed:.2f} s")
+    offset, worst = heightmap_store.compare(points, heights)
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "points": [[x, y, round(h, 4)] for (x, y, z), h in zip(points, heights)],
+        "offset": round(offset, 4),
+        "worst": round(worst, 4),
+        "tolerance": tolerance,
+        "passed": worst <= tolerance,
+        "probe_time": round(seconds, 2),
+    }
+
+
+def reuse_map(prober, store, machine, substrate, size, max_age, count, tolerance):
+    """
+    Find a recent enough map of this substrate and check it still fits. Returns
+    it, moved by the offset found, or None if a new one needs probing.
+    """
+    height_map, path = store.latest(machine, substrate, max_age)
+    if height_map is None:
+        print(f"\nNo height map of {substrate} on {machine} from the last {max_age:g} h")
+        return None
+    meta = height_map["meta"]
+    if meta.get("size") != size:
+        print(f"\nThe height map of {substrate} from {meta['timestamp']} covers "
+              f"{meta.get('size')} µm, not {size}")
+        return None
+    print(f"\nFound a height map of {substrate} from {meta['timestamp']} "
+          f"({heightmap_store.age(height_map) / 3600:.1f} h old)")
+
+    check = check_map(prober, height_map, count, tolerance)
+    meta.setdefault("checks", []).append(check)
+    store.update(path, height_map)
+
+    if not check["passed"]:
+        print(f"\nThe surface has changed by up to {check['worst']:.3f} µm, more than "
+              f"{tolerance:g}, so it needs probing again")
+        return None
+    print(f"\nStored map still fits: moved {check['offset']:+.3f} µm, worst {check['worst']:.3f} µm")
+    print(f"Checked in {check['probe_time']:.2f} s, where probing it took "
+          f"{height_map['stats']['probe_time']:.2f} s")
+    return heightmap_store.shift(height_map, check["offset"])
 
 # ---------------------------------------------------------------------
-# Serial setup
+# Corner probing
 # ---------------------------------------------------------------------
 
-ser = serial.Serial(PORT, BAUD, timeout=1)
-time.sleep(2)
+def probe_corners(prober, size):
+    points = {
+        "BL": (0, 0),
+        "BR": (size, 0),
+        "TR": (size, size),
+        "TL": (0, size)
+    }
+    heights = {}
+    probe_times = []
 
-# flush startup messages
-while ser.in_waiting:
-    ser.readline()
+    print(f"\n--- Probing corners ({size}x{size})---\n")
 
-# unlock GRBL
-ser.write(b"$X\n")
-time.sleep(0.1)
-while ser.in_waiting:
-    ser.readline()
+    results = prober.probe_path(points.values())
+    for name, (avg, samples, kept, interval, elapsed) in zip(points, results):
+        heights[name] = avg
+        probe_times.append(elapsed)
 
-# force current position as (0,0,SAFE_Z) without moving
-ser.write(f"G10 L20 P1 X0 Y0 Z{SAFE_Z}\n".encode())
-time.sleep(0.1)
+        print(f"{name}: {avg:8.3f} µm  ({prober.describe(samples, kept, interval)})  time {elapsed:.2f} s")
 
-# ---------------------------------------------------------------------
-#   Ensure probe is not already in contact before starting.
-# ---------------------------------------------------------------------
+    # Analysis
+    avg_height = sum(heights.values()) / 4
 
-def check_probe_not_triggered():
-    ser.write(b"G91\n")  # relative mode
-    # Do a tiny probe. This will fail instantly with ALARM if it is already contacting
-    ser.write(f"G38.2 Z-1 F{PROBE_FEED}\n".encode())
-    ser.write(b"G90\n")
+    print("\n--- Relative height to average ---")
+    for k, v in heights.items():
+        print(f"{k}: {v-avg_height:+8.3f} µm")
 
-    saw_prb = False
-    saw_alarm = False
+    high = max(heights, key=heights.get)
+    low = min(heights, key=heights.get)
 
-    start_time = time.time()
+    print(f"\nHighest corner: {high}")
+    print(f"Lowest corner : {low}")
+    print(f"Total variation: {heights[high]-heights[low]:.3f} µm")
+    print(f"Probe time: {sum(probe_times):.2f} s for {len(probe_times)} points, "
+          f"longest {max(probe_times):.2f} s")
 
-    while time.time() - start_time < 2:
-        if ser.in_waiting:
-            line = ser.readline().decode(errors="ignore").strip()
+# ---------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------
 
-            if "PRB:" in line:
-                saw_prb = True
+def main():
+    parser = argparse.ArgumentParser(
+        description="Probe bed corners with optional averaging"
+    )
 
-            elif "ALARM:" in line:
-                saw_alarm = True
+    parser.add_argument("--port", default=DEFAULT_PORT,
+                        help="Serial port for GRBL")
 
-    # Clear alarm state if triggered (which it should be one way or another)
-    if saw_alarm:
-        ser.write(b"$X\n")
-        time.sleep(0.1)
-        while ser.in_waiting:
-            ser.readline()
+    parser.add_argument("--baud", type=int, default=DEFAULT_BAUD,
+                        help="Serial baud rate")
 
-    # If we saw a PRB, then a probe happened.
-    # A PRB would not execute if the probe were already in contact, because
-    # that would instantly cause an ALARM
-    if not saw_prb:
-        print("\nERROR: Probe is already in contact at start!")
-        print("Ensure probe is clear of the surface and try again.\n")
+    parser.add_argument("--size", type=float, default=2000,
+                        help="Square size (microns)")
 
-        # retract safely
-        ser.write(f"G91\nG0 Z{SAFE_Z}\nG90\n".encode())
-        time.sleep(0.2)
+    parser.add_argument("--safe-z", type=float, default=100,
+                        help="Safe Z height")
 
-        ser.close()
-        exit(1)
+    parser.add_argument("--feed", type=float, default=1000,
+                        help="Feedrate for the slow, precise touch")
 
-# ---------------------------------------------------------------------
-# Probe function
-# ---------------------------------------------------------------------
+    parser.add_argument("--fast-feed", type=float, default=3000,
+                        help="Feedrate for the fast seek down to the surface")
 
-def probe_once():
-    ser.write(b"G91\n")
-    ser.write(f"G38.2 Z-6000 F{PROBE_FEED}\n".encode())
-    ser.write(b"G90\n")
+    parser.add_argument("--backoff", type=float, default=10,
+                        help="How far to back off after the fast seek before the slow touch (microns)")
 
-    z = None
-    while z is None:
-        if ser.in_waiting:
-            line = ser.readline().decode(errors="ignore").strip()
-            if "PRB:" in line:
-                m = re.search(r'PRB:[^,]+,[^,]+,([^:]+)', line)
-                if m:
-                    z = float(m.group(1))
+    parser.add_argument("--clearance", type=float, default=20,
+                        help="Height above the predicted surface to travel at and seek from (microns)")
 
-    # retract
-    ser.write(f"G91\nG0 Z{SAFE_Z}\nG90\n".encode())
-    return z
+    parser.add_argument("--probes", type=int, default=1,
+                        help="Number of slow touches per point (the least taken with --ci)")
 
+    parser.add_argument("--ci", type=float, default=None,
+                        help="Keep touching each point until the 95%% confidence interval on its "
+                             "height is within this many microns, rejecting outliers")
 
-def probe_average():
-    results = []
-    for i in range(PROBE_COUNT):
-        z = probe_once()
-        results.append(z)
+    parser.add_argument("--max-probes", type=int, default=10,
+                        help="Most slow touches per point with --ci")
 
-    avg = sum(results) / len(results)
-    span = max(results) - min(results) if len(results) > 1 else 0.0
+    parser.add_argument("--mesh", metavar="FILE",
+                        help="Probe a mesh over the square and write the height map to this JSON file")
 
-    return avg, results, span
+    parser.add_argument("--grid", type=int, default=5,
+                        help="Points along each side of the coarse mesh grid")
 
+    parser.add_argument("--tolerance", type=float, default=1.0,
+                        help="Refine mesh cells where the surface is this far (microns) from flat")
 
-# ---------------------------------------------------------------------
-# Main probing loop
-# ---------------------------------------------------------------------
+    parser.add_argument("--min-cell", type=float, default=None,
+                        help="Smallest mesh cell to refine to (microns, default size/16)")
 
-heights = {}
+    parser.add_argument("--substrate", metavar="ID",
+                        help="Keep the --mesh height map in the store under this substrate ID, "
+                             "and reuse a recent one if it still fits")
 
-# force current position as (0,0,SAFE_Z) without moving
-ser.write(f"G10 L20 P1 X0 Y0 Z{SAFE_Z}\n".encode())
-time.sleep(0.1)
+    parser.add_argument("--machine", default=heightmap_store.DEFAULT_MACHINE,
+                        help="Machine name to store height maps under (default this computer's name)")
 
-# Check probe state in case it is already touching
-check_probe_not_triggered()
+    parser.add_argument("--store", default=heightmap_store.DEFAULT_STORE,
+                        help="Height map store directory")
 
-print(f"\n--- Probing corners ({N}x{N})---\n")
+    parser.add_argument("--max-age", type=float, default=heightmap_store.MAX_AGE,
+                        help="Hours a stored height map can be reused for")
 
-for name, (x, y) in points.items():
-    ser.write(f"G0 X{x} Y{y}\n".encode())
-    time.sleep(0.1)
+    parser.add_argument("--check-points", type=int, default=heightmap_store.CHECK_POINTS,
+                        help="Points re-probed to check a stored height map still fits")
 
-    avg, samples, span = probe_average()
-    heights[name] = avg
+    parser.add_argument("--check-tolerance", type=float, default=None,
+                        help="How far (microns) the check points may differ from a stored map, "
+                             "after any shift of the whole surface (default --tolerance)")
 
-    print(f"{name}: {avg:8.3f} µm  (span {span:.3f})")
+    parser.add_argument("--reprobe", action="store_true",
+                        help="Probe a new mesh even if a stored one would do")
 
-# ---------------------------------------------------------------------
-# Analysis
-# ---------------------------------------------------------------------
+    args = parser.parse_args()
+    if args.substrate and not args.mesh:
+        parser.error("--substrate needs --mesh")
 
-avg_height = sum(heights.values()) / 4
+    size = args.size
+    prober = Prober(args.port, args.baud, args.safe_z, args.feed, args.fast_feed, args.backoff,
+                    args.clearance, args.probes, args.ci, args.max_probes)
+    prober.connect()
 
-print("\n--- Relative height to average ---")
-for k, v in heights.items():
-    print(f"{k}: {v-avg_height:+8.3f} µm")
+    try:
+        prober.begin()
 
-high = max(heights, key=heights.get)
-low = min(heights, key=heights.get)
+        if args.mesh:
+            store = heightmap_store.HeightMapStore(args.store)
+            height_map = None
+            if args.substrate and not args.reprobe:
+                check_tolerance = args.check_tolerance if args.check_tolerance else args.tolerance
+                height_map = reuse_map(prober, store, args.machine, args.substrate, size,
+                                       args.max_age, max(1, args.check_points), check_tolerance)
+            if height_map is None:
+                min_cell = args.min_cell if args.min_cell else size / 16
+                height_map = probe_mesh(prober, size, max(2, args.grid), args.tolerance, min_cell)
+                if args.substrate:
+                    path = store.save(height_map, args.machine, args.substrate, size=size,
+                                      grid=max(2, args.grid), tolerance=args.tolerance,
+                                      min_cell=min_cell, port=args.port, probe=prober.settings())
+                    print(f"Stored as {path}")
+            with open(args.mesh, "w") as f:
+                json.dump(height_map, f)
+            print(f"Height map written to {args.mesh}")
+        else:
+            probe_corners(prober, size)
 
-print(f"\nHighest corner: {high}")
-print(f"Lowest corner : {low}")
-print(f"Total variation: {heights[high]-heights[low]:.3f} µm")
+        prober.finish()
+    except ProbeError as e:
+        print(f"\nERROR: {e}")
+        prober.abort(e)
+        exit(1)
 
-# ---------------------------------------------------------------------
-# Return to origin
-# ---------------------------------------------------------------------
+    prober.close()
+    print(f"\nReturned to (0,0,{args.safe_z}) for next run\n")
 
-ser.write(f"G0 X0 Y0 Z{SAFE_Z}\n".encode())
 
-print(f"\nReturned to (0,0,{SAFE_Z}) for next run\n")
+if __name__ == "__main__":
+    main()
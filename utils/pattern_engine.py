@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# pattern_engine.py - Revision 0.01
+#
+# Builds calibration patterns and writes the GCODE to draw them, so
+# grid_gcode.py, backlash_vernier.py and anything else that draws test
+# patterns move the probe the same way:
+# - A pattern is a NumPy array of primitives: lines, and dots (lines that
+#   start and end in the same place), each with its own drawing height and
+#   a group. Grids, vernier scales, dot arrays, spirals and step height
+#   ladders are built whole, without a Python loop per primitive.
+# - order() sorts each group to cut travel, drawing lines from whichever end
+#   is nearer. Groups whose order matters, such as the vernier scales, where
+#   the direction lines are approached from is the point, are left as given.
+# - PatternWriter writes the moves. Lines that carry on from the end of the
+#   last one are drawn without lifting the probe, the probe only lifts to
+#   the skim height between primitives close together if asked to, and runs
+#   of primitives that move the same way are written with one format
+#   operation each, so arrays of a million dots take seconds.
+#
+# Run on its own it writes a dot array, spiral or step height ladder.
+#
+# Units: 1 mm in GCODE = 1 micron in machine space.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import math
+import sys
+
+import numpy as np
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+SAFE_Z = 45.0        # Safe Z height between primitives
+DRAW_Z = 0.0         # Drawing height
+SKIM_Z = 5.0         # Height to hop between neighbouring primitives with --skim
+APPROACH = 2.0       # Height above the drawing height to slow down for touchdown
+
+FAST_XY = 8000       # Rapid XY motion speed
+SLOW_XY = 4000       # Drawing speed
+FAST_Z = 8000        # Z movement speed
+SLOW_Z = 1000        # Lift off and touchdown speed for Z
+
+GREEDY_LIMIT = 2000  # Largest group ordered by always going to the nearest primitive
+CHUNK = 10000        # Most primitives formatted at a time
+
+# One drawing primitive. A dot has start == end. z is the drawing height
+# relative to the writer's draw_z. Primitives are drawn group by group, and
+# a fixed group is drawn in the order and direction given.
+PRIMITIVE = np.dtype([("start", "f8", (2,)), ("end", "f8", (2,)), ("z", "f8"),
+                      ("group", "i4"), ("fixed", "?")])
+
+# ---------------------------------------------------------------------
+# Patterns
+# ---------------------------------------------------------------------
+
+
+def primitives(starts, ends=None, z=0.0, fixed=False):
+    """
+    A pattern of one group from arrays of start and end points (dots if no
+    ends are given) and a drawing height for each, or for all of them.
+    """
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    pattern = np.zeros(len(starts), dtype=PRIMITIVE)
+    pattern["start"] = starts
+    pattern["end"] = starts if ends is None else np.asarray(ends, dtype=float).reshape(-1, 2)
+    pattern["z"] = z
+    pattern["fixed"] = fixed
+    return pattern
+
+
+def combine(*patterns):
+    """Patterns one after another, each group keeping a number of its own."""
+    parts = []
+    groups = 0
+    for pattern in patterns:
+        part = pattern.copy()
+        if len(part):
+            numbers, part["group"] = np.unique(part["group"], return_inverse=True)
+            part["group"] += groups
+            groups += len(numbers)
+        parts.append(part)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=PRIMITIVE)
+
+
+def grid(size, spacing, length):
+    """Horizontal lines from bottom to top, then vertical lines from left to right."""
+    offsets = np.arange(int(size / spacing) + 1) * float(spacing)
+    zeros = np.zeros_like(offsets)
+    across = np.full_like(offsets, float(length))
+    return combine(
+        primitives(np.column_stack((zeros, offsets)), np.column_stack((across, offsets))),
+        primitives(np.column_stack((offsets, zeros)), np.column_stack((offsets, across))),
+    )
+
+
+def vernier(num_lines, spacing, delta, length, top, bottom, axis="x"):
+    """
+    The backlash vernier: a top set of lines at spacing + delta more apart
+    each time, drawn from the far end back towards the origin, then a bottom
+    set at spacing + (num_lines - 1) * delta / 2, drawn away from it. Both
+    are fixed, as the direction the axis approaches each line from is what
+    shows the backlash. For axis "y" the pattern is turned through 90
+    degrees.
+    """
+    index = np.arange(num_lines)
+    offset = (num_lines - 1) * delta / 2
+    sets = []
+    for positions, y in (((index * spacing + index * delta)[::-1], top),
+                         (index * (spacing + offset), bottom)):
+        starts = np.column_stack((positions, np.full(num_lines, float(y))))
+        ends = starts + (0.0, length)
+        if axis == "y":
+            starts, ends = starts[:, ::-1], ends[:, ::-1]
+        sets.append(primitives(starts, ends, fixed=True))
+    return combine(*sets)
+
+
+def dot_array(columns, rows, pitch, origin=(0.0, 0.0)):
+    """A rectangular array of dots, row by row."""
+    x, y = np.meshgrid(np.arange(columns) * float(pitch), np.arange(rows) * float(pitch))
+    return primitives(np.column_stack((x.ravel(), y.ravel())) + origin)
+
+
+def spiral(turns, pitch, segment, centre=(0.0, 0.0)):
+    """
+    An Archimedean spiral, pitch apart each turn, drawn outwards from the
+    centre as one line of straight segments about segment long.
+    """
+    b = pitch / (2 * math.pi)
+    theta_max = 2 * math.pi * turns
+    # Arc length is close to b * theta^2 / 2 away from the middle
+    length = b * theta_max ** 2 / 2
+    theta = np.sqrt(2 * np.append(np.arange(0.0, length, segment), length) / b)
+    points = np.column_stack((b * theta * np.cos(theta), b * theta * np.sin(theta))) + centre
+    return primitives(points[:-1], points[1:], fixed=True)
+
+
+def ladder(steps, step, spacing, length, top=None):
+    """
+    A row of lines (the rungs), each drawn step lower than the one before,
+    starting top above the drawing height (centred on it by default). The
+    first rung to leave a mark shows where the surface really is.
+    """
+    if top is None:
+        top = step * (steps - 1) / 2
+    x = np.arange(steps) * float(spacing)
+    starts = np.column_stack((x, np.zeros(steps)))
+    ends = np.column_stack((x, np.full(steps, float(length))))
+    return primitives(starts, ends, z=top - np.arange(steps) * step)
+
+# ---------------------------------------------------------------------
+# Ordering
+# ---------------------------------------------------------------------
+
+
+def nearest_order(starts, ends, here):
+    """
+    Always go to the nearest start or end of the primitives not yet drawn.
+    Returns the order and which primitives to draw backwards.
+    """
+    n = len(starts)
+    done = np.zeros(n, dtype=bool)
+    sequence = np.empty(n, dtype=int)
+    flip = np.zeros(n, dtype=bool)
+    here = np.asarray(here, dtype=float)
+    for k in range(n):
+        to_start = np.hypot(*(starts - here).T)
+        to_end = np.hypot(*(ends - here).T)
+        to_start[done] = np.inf
+        to_end[done] = np.inf
+        i = np.argmin(np.minimum(to_start, to_end))
+        sequence[k] = i
+        flip[i] = to_end[i] < to_start[i]
+        done[i] = True
+        here = starts[i] if flip[i] else ends[i]
+    return sequence, flip
+
+
+def band_order(starts, ends, here):
+    """
+    Sweep back and forth in bands across the primitives, from the corner
+    nearest here. Rows of primitives at the same height are a band each;
+    scattered ones are cut into bands as far apart as the primitives are
+    on average. Returns the order and which primitives to draw backwards.
+    """
+    n = len(starts)
+    middles = (starts + ends) / 2
+    low, high = middles.min(axis=0), middles.max(axis=0)
+    # Start from the corner nearest here
+    sense = np.where(np.abs(here - high) < np.abs(here - low), -1.0, 1.0)
+    x, y = (middles * sense).T
+    rows = np.unique(y)
+    if len(rows) * 2 <= n:
+        band = np.searchsorted(rows, y)
+    else:
+        area = max(np.prod(high - low), 1e-9)
+        band = np.floor((y - y.min()) / math.sqrt(area / n)).astype(int)
+    way = np.where(band % 2, -1.0, 1.0)
+    sequence = np.lexsort((x * way, band))
+    # Draw each line in the direction of the sweep
+    along = (ends - starts) * sense
+    flip = np.where(along[:, 0] != 0, along[:, 0] * way < 0, along[:, 1] < 0)
+    return sequence, flip
+
+
+def order(pattern, here=(0.0, 0.0)):
+    """
+    The pattern reordered to cut travel, group by group, starting from here.
+    Fixed groups are left as they are.
+    """
+    parts = []
+    here = np.asarray(here, dtype=float)
+    for group in np.unique(pattern["group"]):
+        part = pattern[pattern["group"] == group]
+        if not part["fixed"].any():
+            starts, ends = part["start"], part["end"]
+            if len(part) <= GREEDY_LIMIT:
+                sequence, flip = nearest_order(starts, ends, here)
+            else:
+                sequence, flip = band_order(starts, ends, here)
+            part = part.copy()
+            part["start"][flip], part["end"][flip] = ends[flip], starts[flip]
+            part = part[sequence]
+        parts.append(part)
+        if len(part):
+            here = part["end"][-1]
+    return np.concatenate(parts) if parts else pattern
+
+# ---------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------
+
+
+class PatternWriter:
+    """
+    Writes the moves to draw a pattern, and adds up how far the probe draws
+    and travels and how long that should take at the feeds given
+    (acceleration isn't allowed for). With no output_stream nothing is
+    written, so a different plan can be costed.
+
+    Each primitive is moved to at the height the last one lifted to, lowered
+    quickly to APPROACH above its drawing height then slowly onto it, drawn,
+    lifted slowly to APPROACH and then quickly to safe_z. With skim_z, the
+    probe only lifts that far when the next primitive starts no more than
+    hop away. A line that starts where the last one in its group ended, at
+    the same height, carries on from it without lifting.
+    """
+
+    def __init__(self, output_stream, safe_z=SAFE_Z, draw_z=DRAW_Z, fast_xy=FAST_XY,
+                 slow_xy=SLOW_XY, fast_z=FAST_Z, slow_z=SLOW_Z, skim_z=None, hop=0.0):
+        self.output_stream = output_stream
+        self.safe_z = safe_z
+        self.draw_z = draw_z
+        self.fast_xy = fast_xy
+        self.slow_xy = slow_xy
+        self.fast_z = fast_z
+        self.slow_z = slow_z
+        self.skim_z = skim_z
+        self.hop = hop
+        self.position = np.array([0.0, 0.0, safe_z])
+        self.drawn = 0.0
+        self.travel = 0.0
+        self.time = 0.0
+        self.moves = 0
+        self.touchdowns = 0
+
+    def moves_for(self, dot, joined_in, joined_out, high):
+        """
+        The moves for a primitive, as (code, feed, comment, drawing, the
+        columns its X, Y and Z come from, and the axes written).
+        """
+        moves = []
+        if not joined_in:
+            moves += [("G0", self.fast_xy, "Move to dot" if dot else "Move to line start", False,
+                       ("sx", "sy", "previous"), "XY"),
+                      ("G1", self.fast_z, "Lower probe", False, ("sx", "sy", "approach"), "Z"),
+                      ("G1", self.slow_z, "Lower probe", False, ("sx", "sy", "z"), "Z")]
+        if not dot:
+            moves.append(("G1", self.slow_xy, "Draw line", True, ("ex", "ey", "z"), "XY"))
+        if not joined_out:
+            moves.append(("G1", self.slow_z, "Raise probe", False, ("ex", "ey", "approach"), "Z"))
+            if high:
+                moves.append(("G1", self.fast_z, "Raise probe", False, ("ex", "ey", "lift"), "Z"))
+        return moves
+
+    def move(self, code, feed, comment, x=None, y=None, z=None):
+        """Write a single move outside a pattern and add it to the totals."""
+        words = ""
+        target = self.position.copy()
+        for i, (axis, value) in enumerate((("X", x), ("Y", y), ("Z", z))):
+            if value is not None:
+                words += f"{axis}{value:.3f} "
+                target[i] = value
+        if self.output_stream:
+            self.output_stream.write(f"{code} {words}F{feed:.3f} ; {comment}\n")
+        distance = float(np.linalg.norm(target - self.position))
+        self.travel += distance
+        self.time += 60.0 * distance / feed
+        self.moves += 1
+        self.position = target
+
+    def write(self, pattern):
+        """Move to safe height and the origin, then draw the pattern."""
+        self.move("G1", self.fast_z, "Move to safe height", z=self.safe_z)
+        self.move("G0", self.fast_xy, "Move to origin", x=0.0, y=0.0)
+        n = len(pattern)
+        if not n:
+            return
+
+        starts, ends = pattern["start"], pattern["end"]
+        z = self.draw_z + pattern["z"]
+        dot = (starts == ends).all(axis=1)
+        joined_in = np.zeros(n, dtype=bool)
+        joined_in[1:] = ((pattern["group"][1:] == pattern["group"][:-1]) & ~dot[1:] & ~dot[:-1]
+                         & (starts[1:] == ends[:-1]).all(axis=1) & (z[1:] == z[:-1]))
+        joined_out = np.append(joined_in[1:], False)
+        lift = np.full(n, float(self.safe_z))
+        if self.skim_z is not None:
+            gaps = np.hypot(*(starts[1:] - ends[:-1]).T)
+            lift[:-1][gaps <= self.hop] = self.skim_z
+        approach = z + APPROACH
+        high = lift > approach
+        columns = {"sx": starts[:, 0], "sy": starts[:, 1], "ex": ends[:, 0], "ey": ends[:, 1],
+                   "z": z, "approach": approach, "lift": lift,
+                   "previous": np.append(self.position[2], lift[:-1])}
+        # Where the probe is when each primitive starts
+        previous = np.column_stack((np.append(self.position[0], ends[:-1, 0]),
+                                    np.append(self.position[1], ends[:-1, 1]),
+                                    np.where(joined_in, np.append(z[0], z[:-1]), columns["previous"])))
+
+        # Primitives that move the same way are written and added up together
+        shape = dot * 8 + joined_in * 4 + joined_out * 2 + high
+        edges = np.flatnonzero(np.diff(shape)) + 1
+        for first, last in zip(np.append(0, edges), np.append(edges, n)):
+            moves = self.moves_for(*(bool(flag) for flag in
+                                     (dot[first], joined_in[first], joined_out[first], high[first])))
+            for chunk in range(first, last, CHUNK):
+                run = slice(chunk, min(chunk + CHUNK, last))
+                self.add_up(moves, columns, previous[run], run)
+                if self.output_stream:
+                    self.output_stream.write(self.format(moves, columns, run))
+            self.touchdowns += 0 if joined_in[first] else last - first
+        self.position = np.array([ends[-1, 0], ends[-1, 1], lift[-1]])
+
+    def add_up(self, moves, columns, previous, run):
+        """Add the moves for a run of primitives to the totals."""
+        path = [previous] + [np.column_stack([columns[c][run] for c in source])
+                             for _, _, _, _, source, _ in moves]
+        for (_, feed, _, drawing, _, _), here, there in zip(moves, path, path[1:]):
+            distance = float(np.linalg.norm(there - here, axis=1).sum())
+            if drawing:
+                self.drawn += distance
+            else:
+                self.travel += distance
+            self.time += 60.0 * distance / feed
+        self.moves += len(moves) * len(previous)
+
+    @staticmethod
+    def format(moves, columns, run):
+        """The GCODE for a run of primitives, all formatted in one go."""
+        template = ""
+        values = []
+        for code, feed, comment, _, source, axes in moves:
+            words = []
+            for axis, column in zip("XYZ", source):
+                if axis in axes:
+                    words.append(f"{axis}%.3f")
+                    values.append(columns[column][run])
+            template += f"{code} {' '.join(words)} F{feed:.3f} ; {comment}\n"
+        values = np.column_stack(values)
+        return (template * len(values)) % tuple(values.ravel().tolist())
+
+# ---------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------
+
+
+def main():
+    # Options every pattern takes, given after the pattern name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-o", "--output", default="-", help="Output GCODE file (use '-' for stdout)")
+    common.add_argument("--safe-z", type=float, default=SAFE_Z, help="Safe Z height between primitives")
+    common.add_argument("--draw-z", type=float, default=DRAW_Z, help="Drawing height")
+    common.add_argument("--fast-xy", type=float, default=FAST_XY, help="Rapid XY motion speed")
+    common.add_argument("--slow-xy", type=float, default=SLOW_XY, help="Drawing speed")
+    common.add_argument("--fast-z", type=float, default=FAST_Z, help="Z movement speed")
+    common.add_argument("--slow-z", type=float, default=SLOW_Z, help="Lift off and touchdown speed for Z")
+    common.add_argument("--skim", nargs="?", type=float, const=SKIM_Z, default=None, metavar="Z",
+                        help=f"Hop between neighbouring primitives at this height instead of SAFE_Z "
+                             f"({SKIM_Z:g} if no height is given)")
+    common.add_argument("--given-order", action="store_true",
+                        help="Draw in the order the pattern is built instead of ordering it for less travel")
+
+    parser = argparse.ArgumentParser(
+        description="Generate GCODE for a calibration pattern",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    patterns = parser.add_subparsers(dest="pattern", required=True)
+
+    dots = patterns.add_parser("dots", help="Rectangular array of dots",
+                               parents=[common], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    dots.add_argument("--columns", type=int, default=10, help="Dots across")
+    dots.add_argument("--rows", type=int, default=10, help="Dots down")
+    dots.add_argument("--pitch", type=float, default=50.0, help="Distance between dots")
+
+    spiral_parser = patterns.add_parser("spiral", help="Archimedean spiral line", parents=[common],
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    spiral_parser.add_argument("--turns", type=float, default=5.0, help="Turns")
+    spiral_parser.add_argument("--pitch", type=float, default=50.0, help="Distance between turns")
+    spiral_parser.add_argument("--segment", type=float, default=5.0, help="Length of each straight segment")
+
+    ladder_parser = patterns.add_parser("ladder", help="Lines drawn a step lower each time", parents=[common],
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ladder_parser.add_argument("--steps", type=int, default=11, help="Number of rungs")
+    ladder_parser.add_argument("--step", type=float, default=0.5, help="Height difference between rungs")
+    ladder_parser.add_argument("--spacing", type=float, default=50.0, help="Distance between rungs")
+    ladder_parser.add_argument("--length", type=float, default=200.0, help="Length of each rung")
+    ladder_parser.add_argument("--top", type=float, default=None,
+                               help="Height of the first rung above DRAW_Z (centred on DRAW_Z by default)")
+    args = parser.parse_args()
+
+    if args.pattern == "dots":
+        pattern, hop = dot_array(args.columns, args.rows, args.pitch), args.pitch
+        description = f"{args.columns} x {args.rows} dots, pitch {args.pitch:g}"
+    elif args.pattern == "spiral":
+        pattern, hop = spiral(args.turns, args.pitch, args.segment), args.segment
+        description = f"Spiral of {args.turns:g} turns, pitch {args.pitch:g}"
+    else:
+        pattern, hop = ladder(args.steps, args.step, args.spacing, args.length, args.top), args.spacing
+        top = args.step * (args.steps - 1) / 2 if args.top is None else args.top
+        description = (f"Ladder of {args.steps} rungs, {args.step:g} apart in height "
+                       f"from {top:g} above DRAW_Z")
+    if not args.given_order:
+        pattern = order(pattern)
+
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+    outfile.write("; Calibration pattern generator\n")
+    outfile.write("; Units: 1 mm = 1 micron\n")
+    outfile.write("; Expected machine state: homed\n")
+    outfile.write(f"; {description}\n")
+    if args.skim is not None:
+        outfile.write(f"; Skim height: {args.skim:g}\n")
+    outfile.write("\n")
+
+    writer = PatternWriter(outfile, safe_z=args.safe_z, draw_z=args.draw_z, fast_xy=args.fast_xy,
+                           slow_xy=args.slow_xy, fast_z=args.fast_z, slow_z=args.slow_z,
+                           skim_z=args.skim, hop=hop)
+    writer.write(pattern)
+    if outfile is not sys.stdout:
+        outfile.close()
+
+    print(f"Primitives: {len(pattern)}, touchdowns {writer.touchdowns}, moves {writer.moves}",
+          file=sys.stderr)
+    print(f"Drawn {writer.drawn:.0f}, travel {writer.travel:.0f}", file=sys.stderr)
+    print(f"Estimated time: {writer.time:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
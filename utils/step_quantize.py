@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# step_quantize.py - Revision 0.01
+#
+# Snaps a GCODE job, such as dipify_gcode.py or png_to_gcode.py output, to the
+# motor steps the machine can actually reach, and takes out the moves and dots
+# that snapping shows up as repeats:
+# - GRBL rounds every target to the nearest whole step, using the steps per
+#   unit in $100-$102 (read from a saved GRBL configuration). Every X, Y and
+#   Z written out is moved onto that step, so the file says where the
+#   machine really goes.
+# - A move that ends on the same step on every axis as where the machine
+#   already is does nothing but cost a line to send and plan, and is
+#   dropped. Its feed and motion words are carried on to the next move.
+# - A dot is a run of Z only moves down to a single lowest point and back
+#   up. A dot that lands on the same step in X, Y and Z as an earlier one
+#   would just touch down on it again, so its moves are dropped, leaving Z
+#   where the run would have left it. Anything else happening while the
+#   probe is down, such as a dwell or the UV LED when dipping the probe in
+#   the reservoir, means the run isn't a dot and it's left alone.
+#
+# The steps are counted from machine zero, so give the work offset (WCO in a
+# GRBL status report) with --origin if work zero isn't on a whole step.
+# Otherwise dots that differ by less than a step can be merged, or not, a
+# step out. G0/G1 moves are snapped, in G90 or G91, following G92 offsets.
+# Arcs are passed through as they are. G10/G28/G30/G53/G38.x leave the
+# position unknown until the next move on each axis.
+#
+# Units: 1 mm in GCODE = 1 micron in machine space.
+#
+# Copyright (C) 2026 Vik Olliver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import itertools
+import os
+import re
+import sys
+import time
+
+from heightmap_compensate import MOTION_WORDS, OTHER_AXIS_WORDS, split_comment
+
+# ---------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "..", "maus", "grbl_config_RAMPS_20250507.txt")
+BATCH_LINES = 200000     # Lines read and written at a time
+CACHE_LINES = 100000     # Most different lines remembered between batches
+
+AXES = "XYZ"
+# Words a move can have and still be dropped
+PLAIN_LETTERS = set("NFXYZ")
+
+# ---------------------------------------------------------------------
+# Steps
+# ---------------------------------------------------------------------
+
+
+def read_steps(path):
+    """The X, Y and Z steps per unit ($100-$102) from a GRBL configuration or $$ dump."""
+    steps = [None, None, None]
+    with open(path) as f:
+        for line in f:
+            match = re.match(r"\s*\$10([012])\s*=\s*([-+\d.]+)", line)
+            if match:
+                steps[int(match.group(1))] = float(match.group(2))
+    if None in steps:
+        missing = ", ".join(f"${100 + i}" for i, s in enumerate(steps) if s is None)
+        raise ValueError(f"{path} has no {missing}")
+    return steps
+
+
+class StepQuantizer:
+    """
+    Follows the job through, knowing both where the file says each axis is
+    (position) and where GRBL has been told it is by what has been written
+    out (written), in work coordinates. offset is the G92 offset and origin
+    the work offset, so an axis is on step round((v + offset + origin) *
+    steps per unit).
+
+    The Z only moves of a possible dot are held back in run until a line
+    that isn't one arrives, when they're written out, or not.
+    """
+
+    def __init__(self, steps, origin=(0.0, 0.0, 0.0)):
+        self.steps = list(steps)
+        self.origin = list(origin)
+        self.offset = [0.0, 0.0, 0.0]
+        self.position = [None, None, None]
+        self.written = [None, None, None]
+        self.written_steps = [None, None, None]
+        self.absolute = True
+        self.motion = None
+        self.feed = None
+        # Modal motion and feed as GRBL has them from the lines written out
+        self.written_motion = None
+        self.written_feed = None
+        self.run = []
+        self.dots = set()
+        self.stats = {"lines": 0, "output": 0, "moves": 0, "snapped": 0, "dropped": 0,
+                      "touchdowns": 0, "merged": 0, "arcs": 0}
+        # What parse made of each line, and what each absolute move snaps to
+        self.cache = {}
+        self.snapped = {}
+
+    def step(self, i, value):
+        """The step an axis ends up on for a value in work coordinates."""
+        return round((value + self.offset[i] + self.origin[i]) * self.steps[i])
+
+    def at_step(self, i, step):
+        """The work coordinate of a step."""
+        return step / self.steps[i] - self.offset[i] - self.origin[i]
+
+    def process(self, lines):
+        """Returns the quantized lines of a batch."""
+        cache = self.cache
+        if len(cache) > CACHE_LINES:
+            cache.clear()
+        if len(self.snapped) > CACHE_LINES:
+            self.snapped.clear()
+        out = []
+        for line in lines:
+            parsed = cache.get(line)
+            if parsed is None:
+                parsed = cache[line] = parse_line(line)
+            if self.run:
+                if not parsed or self.z_only(parsed):
+                    self.run.append((line, parsed))
+                    continue
+                self.end_run(out)
+            if parsed and self.z_only(parsed):
+                self.run.append((line, parsed))
+                continue
+            self.line(line, parsed, out)
+        self.stats["lines"] += len(lines)
+        self.stats["output"] += len(out)
+        return out
+
+    def finish(self):
+        """The lines still held back at the end of the job."""
+        out = []
+        if self.run:
+            self.end_run(out)
+        self.stats["output"] += len(out)
+        return out
+
+    def z_only(self, parsed):
+        """Whether a line is a plain G0/G1 move of Z alone, which a dot is made of."""
+        motion, mode, special, feed, axes, words, comment, plain = parsed
+        return (plain and len(axes) == 1 and axes[0][0] == 2
+                and (motion or self.run_motion()) in ("G0", "G1"))
+
+    def run_motion(self):
+        """The modal motion at the end of the run so far."""
+        for line, parsed in reversed(self.run):
+            if parsed and parsed[0]:
+                return parsed[0]
+        return self.motion
+
+    def end_run(self, out):
+        """
+        Write out a run of Z only moves, unless it's a dot on the same step
+        as an earlier one, when only a move to where it would have left Z
+        is written, if that's somewhere else.
+        """
+        run, self.run = self.run, []
+        merge = False
+        x, y, z = self.position
+        if x is not None and y is not None and z is not None:
+            start = self.step(2, z)
+            if self.absolute:
+                # Dot jobs repeat the same few runs over and over
+                key = (start,) + tuple(line for line, parsed in run)
+                bottom = self.snapped.get(key)
+                if bottom is None:
+                    bottom = self.snapped[key] = self.touchdown(start, run)
+            else:
+                bottom = self.touchdown(start, run)
+            if bottom is not False:
+                self.stats["touchdowns"] += 1
+                dot = (self.step(0, x), self.step(1, y), bottom)
+                if dot in self.dots:
+                    merge = True
+                    self.stats["merged"] += 1
+                else:
+                    self.dots.add(dot)
+        last = max(k for k, (line, parsed) in enumerate(run) if parsed)
+        for k, (line, parsed) in enumerate(run):
+            if not parsed:
+                out.append(line)
+            elif merge and k != last:
+                self.follow(parsed)
+                self.stats["dropped"] += 1
+            else:
+                self.line(line, parsed, out)
+
+    def touchdown(self, start, run):
+        """
+        The step Z touches down on if a run starting on step start goes down
+        to a single lowest point and back up, otherwise False.
+        """
+        heights = [start]
+        z = self.position[2]
+        for line, parsed in run:
+            if parsed:
+                value = parsed[4][0][1]
+                z = value if self.absolute else z + value
+                heights.append(self.step(2, z))
+        bottom = min(heights)
+        if not bottom < start or not bottom < heights[-1]:
+            return False
+        first = heights.index(bottom)
+        last = len(heights) - 1 - heights[::-1].index(bottom)
+        if (all(a >= b for a, b in zip(heights[:first], heights[1:first + 1]))
+                and all(h == bottom for h in heights[first:last + 1])
+                and all(a <= b for a, b in zip(heights[last:], heights[last + 1:]))):
+            return bottom
+        return False
+
+    def follow(self, parsed):
+        """Follow the modal state and position through a line that isn't written out."""
+        motion, mode, special, feed, axes, words, comment, plain = parsed
+        if mode:
+            self.absolute = mode == "G90"
+        if motion:
+            self.motion = motion
+        if feed is not None:
+            self.feed = feed
+        position = self.position
+        targets = []
+        for i, value, slot in axes:
+            if self.absolute:
+                position[i] = value
+            elif position[i] is not None:
+                position[i] += value
+            targets.append((i, value, position[i], slot))
+        return targets
+
+    def line(self, line, parsed, out):
+        """Write out a line, snapped, or drop it if it moves less than a step."""
+        if not parsed:
+            out.append(line)
+            return
+        motion, mode, special, feed, axes, words, comment, plain = parsed
+        targets = self.follow(parsed)
+        written = self.written
+
+        if special == "G92":
+            # G92 makes the current position read as the given values,
+            # without moving, so the steps stay where they were
+            for i, value, target, slot in targets:
+                if written[i] is not None:
+                    self.offset[i] += written[i] - value
+                self.position[i] = written[i] = value
+            self.snapped.clear()
+            self.written_modal(parsed)
+            out.append(line)
+            return
+        if special == "G92.1":
+            for i in range(3):
+                if written[i] is not None:
+                    written[i] += self.offset[i]
+                if self.position[i] is not None:
+                    self.position[i] += self.offset[i]
+            self.offset = [0.0, 0.0, 0.0]
+            self.snapped.clear()
+            self.written_modal(parsed)
+            out.append(line)
+            return
+        if special:
+            # Moves we can't follow: forget where the axes are
+            self.position = [None, None, None]
+            self.written = [None, None, None]
+            self.written_steps = [None, None, None]
+            self.written_modal(parsed)
+            out.append(line)
+            return
+        if not axes:
+            self.written_modal(parsed)
+            out.append(line)
+            return
+        if self.motion not in ("G0", "G1"):
+            # Arcs go through as they are
+            if self.motion in ("G2", "G3"):
+                self.stats["arcs"] += 1
+            for i, value, target, slot in targets:
+                written[i] = value if self.absolute else None if written[i] is None else written[i] + value
+                self.written_steps[i] = None if written[i] is None else self.step(i, written[i])
+            self.written_modal(parsed)
+            out.append(line)
+            return
+
+        self.stats["moves"] += 1
+        written_steps = self.written_steps
+        if self.absolute:
+            # Absolute moves snap the same way every time
+            snapped = self.snapped.get(line)
+            if snapped is None:
+                snapped = self.snapped[line] = self.snap(targets, words)
+            steps, values, words = snapped
+            if plain and all(written_steps[i] == s for i, s in steps):
+                # Ends on the step the machine is already on
+                self.stats["dropped"] += 1
+                return
+            for (i, s), value in zip(steps, values):
+                written[i] = value
+                written_steps[i] = s
+        else:
+            steps = [(i, None if target is None else self.step(i, target)) for i, value, target, slot in targets]
+            if plain and all(s is not None and written_steps[i] == s for i, s in steps):
+                self.stats["dropped"] += 1
+                return
+            # Relative moves are written as the difference from where GRBL
+            # thinks the axis is, so rounding to the decimals written
+            # doesn't add up over many moves
+            words = list(words)
+            for (i, value, target, slot), (i, s) in zip(targets, steps):
+                if s is None or written[i] is None:
+                    written[i] = written_steps[i] = None
+                    continue
+                text = number(self.at_step(i, s) - written[i])
+                written[i] += float(text)
+                written_steps[i] = self.step(i, written[i])
+                words[slot] = AXES[i] + text
+
+        # Carry on the motion and feed of any lines dropped before this one
+        if (not motion and self.written_motion != self.motion) or \
+                (feed is None and self.feed is not None and self.written_feed != self.feed):
+            words = list(words)
+            if not motion and self.written_motion != self.motion:
+                words.insert(1 if words[0].startswith("N") else 0, self.motion)
+            if feed is None and self.feed is not None and self.written_feed != self.feed:
+                words.append(f"F{self.feed:g}")
+        self.written_motion, self.written_feed = self.motion, self.feed
+        text = " ".join(words) + comment
+        if text != line:
+            self.stats["snapped"] += 1
+        out.append(text)
+
+    def snap(self, targets, words):
+        """
+        The steps an absolute move goes to, the values written for them and
+        the line's words with them in.
+        """
+        steps, values = [], []
+        words = list(words)
+        for i, value, target, slot in targets:
+            s = self.step(i, target)
+            text = number(self.at_step(i, s))
+            steps.append((i, s))
+            values.append(float(text))
+            words[slot] = AXES[i] + text
+        return steps, values, words
+
+    def written_modal(self, parsed):
+        """Note the modal words of a line written out as it is."""
+        motion, feed = parsed[0], parsed[3]
+        if motion:
+            self.written_motion = motion
+        if feed is not None:
+            self.written_feed = feed
+
+
+def number(value):
+    """A coordinate as written out, without a minus sign on zero."""
+    text = f"{value:.3f}"
+    return "0.000" if text == "-0.000" else text
+
+
+def parse_line(line):
+    """
+    Take a line apart. Returns an empty tuple if there's nothing on it but a
+    comment, or (motion word, G90/G91, other G word that takes axis words,
+    feed or None, axes, words, comment with the line ending, plain), where
+    axes are (axis, value, word index) for the X, Y and Z words and plain
+    says there is nothing on the line but N, G0/G1, F and axis words.
+    """
+    code, comment = split_comment(line)
+    words = code.upper().split()
+    if not words:
+        return ()
+    motion = mode = special = feed = None
+    axes = []
+    plain = True
+    for k, word in enumerate(words):
+        letter = word[0]
+        try:
+            if letter in AXES:
+                axes.append((AXES.index(letter), float(word[1:]), k))
+                continue
+            if letter == "F":
+                feed = float(word[1:])
+                continue
+        except ValueError:
+            return (None, None, "unknown", None, (), words, "", False)
+        if letter == "G":
+            if word in MOTION_WORDS:
+                motion = MOTION_WORDS[word]
+                if motion in ("G0", "G1"):
+                    continue
+            elif word in ("G90", "G91"):
+                mode = word
+            elif word in ("G92", "G92.1") or word in OTHER_AXIS_WORDS:
+                special = word
+        if letter not in PLAIN_LETTERS:
+            plain = False
+    comment = comment.rstrip("\r\n")
+    comment = (" " + comment if comment else "") + "\n"
+    return (motion, mode, special, feed, tuple(axes), words, comment, plain)
+
+
+def quantize(input_stream, output_stream, quantizer, batch_lines=BATCH_LINES):
+    while True:
+        lines = list(itertools.islice(input_stream, batch_lines))
+        if not lines:
+            break
+        output_stream.writelines(quantizer.process(lines))
+    output_stream.writelines(quantizer.finish())
+
+
+def parse_triple(text, parser, name):
+    """Read X,Y,Z from an option."""
+    try:
+        values = [float(v) for v in text.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != 3:
+        parser.error(f"{name} wants X,Y,Z, not {text}")
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Snap a GCODE job to the motor steps and drop repeated dots and sub-step moves",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("input", nargs="?", default="-", help="Input GCODE file (use '-' for stdin)")
+    parser.add_argument("-o", "--output", default="-", help="Output GCODE file (use '-' for stdout)")
+    parser.add_argument("--config", default=DEFAULT_CONFIG,
+                        help="GRBL configuration or $$ dump to read $100-$102 steps per unit from")
+    parser.add_argument("--steps", metavar="X,Y,Z", help="Steps per unit, instead of reading --config")
+    parser.add_argument("--origin", default="0,0,0", metavar="X,Y,Z",
+                        help="Work offset from machine zero (WCO in a GRBL status report)")
+    parser.add_argument("--batch", type=int, default=BATCH_LINES, help="Lines processed at a time")
+    args = parser.parse_args()
+
+    if args.steps:
+        steps = parse_triple(args.steps, parser, "--steps")
+    else:
+        try:
+            steps = read_steps(args.config)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't read steps per unit: {e}")
+    if min(steps) <= 0:
+        parser.error("steps per unit must be more than zero")
+    quantizer = StepQuantizer(steps, parse_triple(args.origin, parser, "--origin"))
+
+    start = time.perf_counter()
+    input_stream = sys.stdin if args.input == "-" else open(args.input, "r")
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        output_stream.write("; Snapped to motor steps by step_quantize.py: "
+                            + " ".join(f"{a}{s:g}" for a, s in zip(AXES, steps)) + " steps per unit\n")
+        quantize(input_stream, output_stream, quantizer, max(1, args.batch))
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    elapsed = time.perf_counter() - start
+
+    stats = quantizer.stats
+    print(f"{stats['lines']} lines in, {stats['output']} out: {stats['moves']} moves, "
+          f"{stats['snapped']} snapped, {stats['dropped']} dropped", file=sys.stderr)
+    print(f"Touchdowns: {stats['touchdowns']}, {stats['merged']} on the same step as an earlier one "
+          f"eliminated", file=sys.stderr)
+    if stats["arcs"]:
+        print(f"{stats['arcs']} arc moves passed through unsnapped", file=sys.stderr)
+    if elapsed > 0:
+        print(f"{elapsed:.2f}s, {stats['lines'] / elapsed:.0f} lines/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()